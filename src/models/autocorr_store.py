@@ -0,0 +1,122 @@
+"""
+Persistent, memory-mapped store of the two-point autocorrelations of the dataset images.
+
+The store of a dataset lives in data/<dataset>/autocorr_store:
+    autocorrs.npy  (N, H, W) float16 or float32, row i holding the autocorrelation of the i-th image of labels.csv
+    index.json     the name and content hash of the image of every row, the dtype and the preprocessing
+update_autocorr_store only computes the rows of new or changed images and copies the others over, and
+AutocorrelationStore reads rows from the memory map, so only the requested autocorrelations are loaded.
+It is written by transform_to_autocorrs.py.
+"""
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from spatial_statistics_loss import TwoPointAutocorrelation
+from utils import check_mkdir
+
+
+class AutocorrelationStore(object):
+    def __init__(self, root):
+        """
+        root: store directory holding autocorrs.npy and index.json
+        """
+        with open(os.path.join(root, 'index.json')) as f:
+            self.index = json.load(f)
+        self.root = root
+        self.names = [entry['name'] for entry in self.index['entries']]
+        self.rows = {name: row for row, name in enumerate(self.names)}
+        self.autocorrs = np.load(os.path.join(root, 'autocorrs.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, rows):
+        """
+        rows: int, slice, or sequence / Torch tensor of row indices (the dataset indices)
+
+        Returns: float32 Torch tensor of shape (1, H, W) for an int, (k, 1, H, W) otherwise
+        """
+        if torch.is_tensor(rows):
+            rows = rows.cpu().numpy()
+        if isinstance(rows, (list, tuple, np.ndarray)):
+            rows = np.asarray(rows)
+            # the memory map reads fastest in increasing row order
+            order = np.argsort(rows, kind='stable')
+            autocorrs = np.empty((len(rows), *self.autocorrs.shape[1:]), dtype=self.autocorrs.dtype)
+            autocorrs[order] = self.autocorrs[rows[order]]
+        else:
+            autocorrs = np.array(self.autocorrs[rows])
+        return torch.from_numpy(autocorrs).float().unsqueeze(-3)
+
+    def get(self, names):
+        """Autocorrelations of the images with these file names, Torch tensor of shape (k, 1, H, W)."""
+        return self[[self.rows[name] for name in names]]
+
+
+def file_hashes(img_dir, names):
+    hashes = []
+    for name in names:
+        with open(os.path.join(img_dir, name), 'rb') as f:
+            hashes.append(hashlib.sha1(f.read()).hexdigest())
+    return hashes
+
+
+def update_autocorr_store(dataset, csv_file, img_dir, root, preprocess, dtype='float16', batch_size=64, num_workers=4):
+    """
+    Brings the store in root up to date with the images listed in csv_file, computing only the
+    autocorrelations of the images that are new or whose content changed.
+
+    dataset: Dataset over csv_file yielding (uint8 image, label), see preprocessing.image_transform
+    preprocess: the BatchPreprocess the images are read with
+    dtype: 'float16' or 'float32'
+
+    Returns: the number of autocorrelations computed
+    """
+    assert dtype in ['float16', 'float32'], "dtype should be 'float16' or 'float32'"
+    names = list(pd.read_csv(csv_file).iloc[:, 0])
+    hashes = file_hashes(img_dir, names)
+
+    old = None
+    if os.path.exists(os.path.join(root, 'index.json')):
+        old = AutocorrelationStore(root)
+        if old.index['dtype'] != dtype or old.index['preprocess'] != repr(preprocess):
+            old = None
+    old_rows = {} if old is None else {(entry['name'], entry['hash']): row for row, entry in enumerate(old.index['entries'])}
+    reused = [(row, old_rows[key]) for row, key in enumerate(zip(names, hashes)) if key in old_rows]
+    missing = [row for row, key in enumerate(zip(names, hashes)) if key not in old_rows]
+    if old is not None and not missing and len(old) == len(names) and all(row == old_row for row, old_row in reused):
+        return 0
+
+    check_mkdir(root)
+    height, width = preprocess.res_size, preprocess.res_size
+    tmp_path = os.path.join(root, 'autocorrs.tmp.npy')
+    autocorrs = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(len(names), height, width))
+    for row, old_row in reused:
+        autocorrs[row] = old.autocorrs[old_row]
+
+    autocorrelation = TwoPointAutocorrelation()
+    loader = DataLoader(Subset(dataset, missing), batch_size=batch_size, num_workers=num_workers, collate_fn=preprocess.collate)
+    start = 0
+    with torch.no_grad():
+        for X, *_ in loader:
+            rows = missing[start:start + len(X)]
+            autocorrs[rows] = autocorrelation.batch_forward(X).squeeze(1).numpy().astype(dtype)
+            start += len(X)
+    autocorrs.flush()
+    del autocorrs, old
+
+    # drop the old index first, an interrupted update then leaves no store rather than a mismatched one
+    if os.path.exists(os.path.join(root, 'index.json')):
+        os.remove(os.path.join(root, 'index.json'))
+    os.replace(tmp_path, os.path.join(root, 'autocorrs.npy'))
+    index = {'dtype': dtype, 'preprocess': repr(preprocess), 'height': height, 'width': width,
+             'entries': [{'name': name, 'hash': h} for name, h in zip(names, hashes)]}
+    with open(os.path.join(root, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    return len(missing)
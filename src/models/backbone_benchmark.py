@@ -0,0 +1,155 @@
+# Compares the cost of the encoder backbones of ResNet_VAE (see backbones.py) on this machine.
+# Run from the repository root: python src/models/backbone_benchmark.py
+# For every backbone it prints the parameters of the backbone and of the whole VAE, the FLOPs of the
+# backbone forward per image, the images/s of the backbone forward and of a VAE training step (pretrained
+# backbones frozen as in run_training), and the peak memory of that training step.
+import time
+import argparse
+import resource
+import multiprocessing
+
+import torch
+import torch.nn as nn
+
+from resnet_vae import ResNet_VAE
+
+
+BENCHMARKED = [
+    ('resnet152', {}),
+    ('resnet50', {}),
+    ('resnet34', {}),
+    ('resnet18', {}),
+    ('truncated_resnet', {'depth': 50, 'num_stages': 3}),
+    ('truncated_resnet', {'depth': 50, 'num_stages': 2}),
+    ('truncated_resnet', {'depth': 18, 'num_stages': 2}),
+    ('small_vae', {}),
+]
+
+
+def count_parameters(module):
+    return sum(param.numel() for param in module.parameters())
+
+
+def count_flops(model, forward, x):
+    """
+    FLOPs of forward(x), a method of model, counted from the convolutions and linear layers (2 per multiply-add), which
+    dominate the cost of these networks. Normalizations, activations and pooling are left out.
+    """
+    flops = [0]
+
+    def hook(module, inputs, output):
+        if isinstance(module, nn.Conv2d):
+            # every output element takes in_channels / groups x kernel multiply-adds
+            flops[0] += 2 * output.numel() * module.in_channels // module.groups * module.kernel_size[0] * module.kernel_size[1]
+        elif isinstance(module, nn.ConvTranspose2d):
+            # every input element is spread over out_channels / groups x kernel outputs
+            flops[0] += 2 * inputs[0].numel() * module.out_channels // module.groups * module.kernel_size[0] * module.kernel_size[1]
+        elif isinstance(module, nn.Linear):
+            flops[0] += 2 * output.numel() * module.in_features
+
+    handles = [module.register_forward_hook(hook) for module in model.modules() if isinstance(module, (nn.Conv2d, nn.ConvTranspose2d, nn.Linear))]
+    with torch.no_grad():
+        forward(x)
+    for handle in handles:
+        handle.remove()
+    return flops[0]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def images_per_second(func, batch_size, repeats, device):
+    func()  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return batch_size * repeats / (time.perf_counter() - start)
+
+
+def benchmark_backbone(backbone, backbone_kwargs, batch_size, input_size, repeats, num_threads):
+    """
+    Measures one backbone, run in its own process so the peak memory of the others does not count.
+
+    Returns: dict of the measurements
+    """
+    torch.set_num_threads(num_threads)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # the weights do not change the cost, random ones spare the download
+    vae = ResNet_VAE(CNN_embed_dim=256, device=device, backbone=backbone, backbone_kwargs=backbone_kwargs, pretrained=False).to(device)
+    # frozen as run_training freezes them with their ImageNet weights, only small_vae trains from scratch
+    if backbone != 'small_vae':
+        vae.resnet.requires_grad_(False)
+    optimizer = torch.optim.Adam([param for param in vae.parameters() if param.requires_grad], lr=1e-3)
+    x = (torch.rand(batch_size, 1, input_size, input_size, device=device) > 0.5).float()
+
+    vae.eval()
+    flops = count_flops(vae, vae.backbone_features, x[:1])
+    with torch.no_grad():
+        forward = images_per_second(lambda: vae.backbone_features(x), batch_size, repeats, device)
+
+    def training_step():
+        x_reconst, _, mu, logvar = vae(x)
+        loss = nn.functional.mse_loss(x_reconst, x, reduction='sum') - 0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp())
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    vae.train()
+    before = peak_rss_mb()
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    training = images_per_second(training_step, batch_size, repeats, device)
+    if device.type == 'cuda':
+        peak = (torch.cuda.max_memory_allocated() - base) / 2**20
+    else:
+        peak = peak_rss_mb() - before
+
+    name = backbone + "".join(f" {key}={value}" for key, value in backbone_kwargs.items())
+    return {
+        'backbone': name,
+        'backbone params (M)': count_parameters(vae.resnet) / 1e6,
+        'VAE params (M)': count_parameters(vae) / 1e6,
+        'backbone GFLOPs/img': flops / 1e9,
+        'backbone fwd img/s': forward,
+        'train step img/s': training,
+        'train step peak MB': peak,
+    }
+
+
+def print_table(rows):
+    columns = list(rows[0])
+    widths = [max(len(column), *(len(format_value(row[column])) for row in rows)) for column in columns]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(format_value(row[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+def format_value(value):
+    return value if isinstance(value, str) else f"{value:.2f}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the parameters, FLOPs, throughput and peak memory of the encoder backbones.")
+    parser.add_argument('--bs', type=int, default=16, help="Batch size.")
+    parser.add_argument('--input_size', type=int, default=224, help="Edge length of the square input images.")
+    parser.add_argument('--repeats', type=int, default=3, help="Number of timed repetitions.")
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(), help="Number of CPU threads.")
+    parser.add_argument('--backbones', type=str, nargs='*', default=None, help="Only these backbone names.")
+    args = parser.parse_args()
+
+    rows = []
+    context = multiprocessing.get_context('spawn')
+    for backbone, backbone_kwargs in BENCHMARKED:
+        if args.backbones and backbone not in args.backbones:
+            continue
+        with context.Pool(1) as pool:
+            rows.append(pool.apply(benchmark_backbone, (backbone, backbone_kwargs, args.bs, args.input_size, args.repeats, args.threads)))
+        print(f"{rows[-1]['backbone']} done")
+    print_table(rows)
@@ -0,0 +1,132 @@
+"""
+Registry of the encoder backbones of ResNet_VAE.
+
+A backbone maps the input images to a flat feature vector per image, which the fully connected heads
+of ResNet_VAE turn into mu and logvar. Every entry of BACKBONES builds an nn.Module and describes it
+with a BackboneSpec:
+    resnet18, resnet34, resnet50, resnet152  torchvision ResNets without their classifier (ImageNet weights)
+    truncated_resnet                         the stem and the first num_stages stages of a ResNet of depth 18,
+                                             34, 50 or 152, average pooled
+    small_vae                                the convolutional stack of the SmallVAE encoder (small_vae.py),
+                                             flattened, trained from scratch on the single channel images
+ResNets read 3-channel, ImageNet normalized images, ResNet_VAE then expands the input channel first.
+
+Register a new backbone with:
+    @register_backbone('name')
+    def build(pretrained=True, **kwargs):
+        return BackboneSpec(module, out_features, in_channels=3, pretrained=pretrained)
+
+backbone_benchmark.py compares the parameters, FLOPs, throughput and peak memory of the backbones.
+"""
+import torch.nn as nn
+import torch.nn.functional as F
+import torchvision.models as models
+
+
+BACKBONES = {}
+
+
+class BackboneSpec(object):
+    def __init__(self, module, out_features, in_channels=3, pretrained=False):
+        """
+        module: nn.Module mapping images of shape (bs, in_channels, H, W) to features of shape (bs, out_features, ...)
+        out_features: number of features per image once flattened
+        in_channels: 3 for ImageNet normalized RGB images, 1 for the raw single channel images
+        pretrained: whether the module holds pretrained weights, which training keeps frozen
+        """
+        self.module = module
+        self.out_features = out_features
+        self.in_channels = in_channels
+        self.pretrained = pretrained
+
+
+def register_backbone(name):
+    def register(build):
+        assert name not in BACKBONES, f"Backbone {name} is already registered"
+        BACKBONES[name] = build
+        return build
+    return register
+
+
+def build_backbone(name, pretrained=True, **kwargs):
+    """
+    name: one of BACKBONES
+    pretrained: load the ImageNet weights of the ResNets (ignored by backbones trained from scratch)
+    kwargs: options of the backbone, e.g. depth and num_stages of truncated_resnet
+
+    Returns: BackboneSpec
+    """
+    assert name in BACKBONES, f"Unknown backbone {name}, should be one of {sorted(BACKBONES)}"
+    return BACKBONES[name](pretrained=pretrained, **kwargs)
+
+
+RESNETS = {
+    18: (models.resnet18, "ResNet18_Weights.DEFAULT"),
+    34: (models.resnet34, "ResNet34_Weights.DEFAULT"),
+    50: (models.resnet50, "ResNet50_Weights.DEFAULT"),
+    152: (models.resnet152, "ResNet152_Weights.DEFAULT"),
+}
+
+
+def load_resnet(depth, pretrained):
+    assert depth in RESNETS, f"ResNet depth should be one of {sorted(RESNETS)}"
+    constructor, weights = RESNETS[depth]
+    return constructor(weights=weights if pretrained else None)
+
+
+def stage_channels(stage):
+    # output channels of a ResNet stage, its last block ending with bn3 (Bottleneck) or bn2 (BasicBlock)
+    block = stage[-1]
+    return block.bn3.num_features if hasattr(block, 'bn3') else block.bn2.num_features
+
+
+def resnet_backbone(depth, pretrained):
+    resnet = load_resnet(depth, pretrained)
+    modules = list(resnet.children())[:-1]      # delete the last fc layer.
+    return BackboneSpec(nn.Sequential(*modules), resnet.fc.in_features, in_channels=3, pretrained=pretrained)
+
+
+for depth in RESNETS:
+    register_backbone(f'resnet{depth}')(lambda pretrained=True, depth=depth: resnet_backbone(depth, pretrained))
+
+
+@register_backbone('truncated_resnet')
+def truncated_resnet_backbone(pretrained=True, depth=50, num_stages=2):
+    """
+    The stem and the first num_stages (1 to 4) stages of a ResNet, average pooled. Lower stages see
+    local texture rather than ImageNet objects and cost a fraction of the full network.
+    """
+    assert 1 <= num_stages <= 4, "num_stages should be between 1 and 4"
+    resnet = load_resnet(depth, pretrained)
+    stages = [resnet.layer1, resnet.layer2, resnet.layer3, resnet.layer4][:num_stages]
+    module = nn.Sequential(resnet.conv1, resnet.bn1, resnet.relu, resnet.maxpool, *stages, resnet.avgpool)
+    return BackboneSpec(module, stage_channels(stages[-1]), in_channels=3, pretrained=pretrained)
+
+
+class SmallVAEConvolutions(nn.Module):
+    def __init__(self):
+        """
+        The convolutional stack of small_vae.Encoder, (bs, 1, 224, 224) -> (bs, 256, 14, 14).
+        """
+        super(SmallVAEConvolutions, self).__init__()
+        self.conv1 = nn.Conv2d(1, 32, kernel_size=4, stride=2, padding=1)  # 112x112
+        self.bn1 = nn.BatchNorm2d(32)
+        self.conv2 = nn.Conv2d(32, 64, kernel_size=4, stride=2, padding=1)  # 56x56
+        self.bn2 = nn.BatchNorm2d(64)
+        self.conv3 = nn.Conv2d(64, 128, kernel_size=4, stride=2, padding=1)  # 28x28
+        self.bn3 = nn.BatchNorm2d(128)
+        self.conv4 = nn.Conv2d(128, 256, kernel_size=4, stride=2, padding=1)  # 14x14
+        self.bn4 = nn.BatchNorm2d(256)
+
+    def forward(self, x):
+        x = F.relu(self.bn1(self.conv1(x)))
+        x = F.relu(self.bn2(self.conv2(x)))
+        x = F.relu(self.bn3(self.conv3(x)))
+        x = F.relu(self.bn4(self.conv4(x)))
+        return x
+
+
+@register_backbone('small_vae')
+def small_vae_backbone(pretrained=True, input_size=224):
+    # trained from scratch, pretrained does not apply
+    return BackboneSpec(SmallVAEConvolutions(), 256 * (input_size // 16)**2, in_channels=1, pretrained=False)
@@ -0,0 +1,222 @@
+"""
+Asynchronous, atomic checkpoints of a training run.
+
+CheckpointManager.save snapshots the state to CPU on the training thread (a memory copy) and hands the
+writes to a background thread, so training goes on while they reach the disk. Every file is written to
+a temporary name and renamed into place, and the index checkpoints.json only lists a checkpoint once all
+its files are written: a run killed mid-write resumes from the previous checkpoint. It keeps the last
+keep_last checkpoints plus the keep_best ones with the lowest metric and deletes the files of the others.
+
+The files of the checkpoint of epoch N, in the run directory:
+    model_epoch{N}.pth       the model state_dict, as load_model_and_save_results.py reads it
+    checkpoint_epoch{N}.pt   the rest of the training state: optimizer, schedulers, RNG states, data split...
+plus any extra arrays given to save, which are kept when the checkpoint is pruned.
+
+Within an epoch, save_step overwrites step_checkpoint.pt with the model and training state after a given
+number of batches (see StepCheckpoint), and load resumes from it when it is more recent than the last
+epoch checkpoint.
+"""
+import os
+import json
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def to_cpu(obj):
+    """Copies the tensors nested in dicts, lists and tuples of obj to the CPU, the snapshot of a checkpoint."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointManager(object):
+    def __init__(self, directory, keep_last=3, keep_best=1, read_only=False):
+        """
+        directory: run directory the checkpoints are written to
+        keep_last: number of most recent checkpoints kept, None to keep them all
+        keep_best: number of checkpoints with the lowest metric kept on top of those
+        read_only: only load, save and save_step do nothing. For the ranks of a distributed run other than rank 0
+        """
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.read_only = read_only
+        self.index_path = os.path.join(directory, 'checkpoints.json')
+        self.entries = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.entries = json.load(f)['checkpoints']
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def model_path(self, epoch):
+        return os.path.join(self.directory, f'model_epoch{epoch}.pth')
+
+    def state_path(self, epoch):
+        return os.path.join(self.directory, f'checkpoint_epoch{epoch}.pt')
+
+    def step_path(self):
+        return os.path.join(self.directory, 'step_checkpoint.pt')
+
+    def save(self, epoch, model_state, training_state, metric=None, arrays=None):
+        """
+        Snapshots a checkpoint and queues its writing, returns without waiting for the disk.
+
+        epoch: number of epochs done
+        model_state: state_dict of the model
+        training_state: dict of the rest of the state to resume from (optimizer state_dict, ...)
+        metric: value ranking the checkpoints for keep_best, e.g. the validation loss (lower is better)
+        arrays: dict of file name -> NumPy array, saved next to the checkpoint and never pruned
+        """
+        if self.read_only:
+            return
+        self.raise_error()
+        snapshot = (epoch, to_cpu(model_state), to_cpu(training_state), metric,
+                    {name: np.array(array, copy=True) for name, array in (arrays or {}).items()})
+        self.queue.put(lambda: self.write(*snapshot))
+
+    def save_step(self, model_state, training_state):
+        """
+        Snapshots a checkpoint within an epoch and queues its writing over the previous one.
+
+        training_state: as for save, with 'epoch' the number of epochs done and 'step' the number of batches
+        done in the current one
+        """
+        if self.read_only:
+            return
+        self.raise_error()
+        snapshot = {'model': to_cpu(model_state), 'training': to_cpu(training_state)}
+        self.queue.put(lambda: self.atomic_write(self.step_path(), lambda path: torch.save(snapshot, path)))
+
+    def writer(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if self.error is None:
+                    job()
+            except Exception as e:  # reraised on the training thread
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def write(self, epoch, model_state, training_state, metric, arrays):
+        for name, array in arrays.items():
+            self.atomic_write(os.path.join(self.directory, name), lambda path: np.save(path, array))
+        self.atomic_write(self.model_path(epoch), lambda path: torch.save(model_state, path))
+        self.atomic_write(self.state_path(epoch), lambda path: torch.save(training_state, path))
+
+        self.entries = [entry for entry in self.entries if entry['epoch'] != epoch]
+        self.entries.append({'epoch': epoch, 'metric': metric})
+        kept = self.kept_entries()
+        removed = [entry for entry in self.entries if entry not in kept]
+        self.entries = kept
+        # the index drops the pruned checkpoints before their files go
+        self.atomic_write(self.index_path, lambda path: self.write_index(path))
+        for entry in removed:
+            for path in [self.model_path(entry['epoch']), self.state_path(entry['epoch'])]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def kept_entries(self):
+        if self.keep_last is None:
+            return self.entries
+        kept = self.entries[-self.keep_last:] if self.keep_last > 0 else []
+        ranked = sorted((entry for entry in self.entries if entry['metric'] is not None), key=lambda entry: entry['metric'])
+        kept += [entry for entry in ranked[:self.keep_best] if entry not in kept]
+        return [entry for entry in self.entries if entry in kept]
+
+    def write_index(self, path):
+        with open(path, 'w') as f:
+            json.dump({'checkpoints': self.entries}, f)
+
+    @staticmethod
+    def atomic_write(path, write):
+        # np.save appends .npy to names without it, so the temporary name keeps the extension
+        root, extension = os.path.splitext(path)
+        tmp_path = f"{root}.tmp{extension}"
+        write(tmp_path)
+        os.replace(tmp_path, path)
+
+    def raise_error(self):
+        if self.error is not None:
+            raise RuntimeError("Writing a checkpoint failed") from self.error
+
+    def wait(self):
+        """Blocks until every queued checkpoint is written."""
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
+    def latest_epoch(self):
+        """Epoch of the most recent complete checkpoint, None if there is none."""
+        return self.entries[-1]['epoch'] if self.entries else None
+
+    def load(self, epoch=None, map_location=None):
+        """
+        epoch: epoch of the checkpoint, None for the latest, the step checkpoint included
+
+        Returns: (model_state, training_state) of the checkpoint, None if there is none
+        """
+        self.wait()
+        if epoch is None:
+            latest = self.latest_epoch()
+            if os.path.exists(self.step_path()):
+                step = torch.load(self.step_path(), map_location=map_location)
+                # within the epoch after latest (or later), so more recent
+                if latest is None or step['training']['epoch'] >= latest:
+                    return step['model'], step['training']
+            epoch = latest
+        if epoch is None or not os.path.exists(self.state_path(epoch)):
+            return None
+        return torch.load(self.model_path(epoch), map_location=map_location), torch.load(self.state_path(epoch), map_location=map_location)
+
+
+class StepCheckpoint(object):
+    def __init__(self, checkpoints, every_n_steps, state_fn):
+        """
+        Checkpoints the training every every_n_steps batches within the epochs, see train.
+
+        checkpoints: CheckpointManager
+        state_fn: called as state_fn(batches_done, losses) with the LossAccumulator of the epoch,
+        returns the (model_state, training_state) to save
+        """
+        self.checkpoints = checkpoints
+        self.every_n_steps = every_n_steps
+        self.state_fn = state_fn
+
+    def due(self, batches_done):
+        return batches_done % self.every_n_steps == 0
+
+    def __call__(self, batches_done, losses):
+        self.checkpoints.save_step(*self.state_fn(batches_done, losses))
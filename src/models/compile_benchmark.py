@@ -0,0 +1,93 @@
+# Compares eager NCHW, eager channels-last and compiled channels-last training steps of the VAEs
+# (see compiled_execution.py). Run from the repository root: python src/models/compile_benchmark.py
+# The compile time (the warm-up step) is printed apart from the steady-state images/s of the
+# training step (forward, loss and backward), and the reason when torch.compile falls back.
+import time
+import argparse
+import multiprocessing
+
+import torch
+
+from resnet_vae import ResNet_VAE
+from small_vae import SmallVAE
+from training_utils import MaterialSimilarityLoss, run_model
+from compiled_execution import prepare_compiled_training
+
+
+EXECUTION_MODES = [
+    ('eager NCHW', {'channels_last': False, 'compile': False}),
+    ('eager channels-last', {'channels_last': True, 'compile': False}),
+    ('compiled channels-last', {'channels_last': True, 'compile': True}),
+]
+
+
+def build_model(model_name, backbone, device):
+    if model_name == 'small_vae':
+        return SmallVAE(bottleneck_size=9).to(device)
+    # the weights do not change the cost, random ones spare the download
+    vae = ResNet_VAE(CNN_embed_dim=9, device=device, backbone=backbone, pretrained=False).to(device)
+    if backbone != 'small_vae':
+        vae.resnet.requires_grad_(False)
+    return vae
+
+
+def time_execution(model_name, backbone, execution, batch_size, input_size, repeats, model_precision, num_threads):
+    """
+    Times the training steps of one model and execution mode, in its own process so the compilation
+    caches of the other modes do not carry over.
+
+    Returns: dict of the compile seconds, the steady-state images/s and the fallback reason
+    """
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(0)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = build_model(model_name, backbone, device)
+    optimizer = torch.optim.Adam([param for param in model.parameters() if param.requires_grad], lr=1e-3)
+    criterion = MaterialSimilarityLoss(device, -1.9e-09, 0.04, spatial_stat_loss_reduction='sum', normalize_spatial_stat_tensors=True)
+    X = (torch.rand(batch_size, 1, input_size, input_size, device=device) > 0.5).float()
+    y = torch.zeros(batch_size)
+
+    runner, info = prepare_compiled_training(model, criterion, [(X, y)], device, model_precision, **EXECUTION_MODES[execution][1])
+
+    def step():
+        X_reconst, z, mu, logvar = run_model(runner, X, device, model_precision)
+        loss = criterion(X, X_reconst, mu, logvar, 0.15, 0, 0, 0.85, 1, return_autocorrs=False)[5]
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    model.train()
+    step()  # warm up, e.g. the Adam state
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    info['img/s'] = batch_size * repeats / (time.perf_counter() - start)
+    return info
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare eager and compiled channels-last training steps of the VAEs.")
+    parser.add_argument('--models', type=str, nargs='*', default=['resnet_vae', 'small_vae'], help="resnet_vae and / or small_vae.")
+    parser.add_argument('--backbone', type=str, default='resnet18', help="Encoder backbone of resnet_vae, see backbones.py.")
+    parser.add_argument('--bs', type=int, default=16, help="Batch size.")
+    parser.add_argument('--input_size', type=int, default=224, help="Edge length of the square input images.")
+    parser.add_argument('--repeats', type=int, default=5, help="Number of timed training steps.")
+    parser.add_argument('--model_precision', type=str, default='float32', help="float32 or bfloat16.")
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(), help="Number of CPU threads.")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    for model_name in args.models:
+        name = f"{model_name} ({args.backbone})" if model_name == 'resnet_vae' else model_name
+        reference = None
+        for execution, (execution_name, _) in enumerate(EXECUTION_MODES):
+            with context.Pool(1) as pool:
+                info = pool.apply(time_execution, (model_name, args.backbone, execution, args.bs, args.input_size, args.repeats, args.model_precision, args.threads))
+            reference = reference or info['img/s']
+            compile_time = f", compile {info['compile seconds']:.1f} s" if info['compiled'] else ""
+            fallback = f" (fell back to eager: {info['fallback reason']})" if info['fallback reason'] else ""
+            print(f"{name} {execution_name}: {info['img/s']:.2f} img/s ({info['img/s'] / reference:.2f}x){compile_time}{fallback}")
@@ -0,0 +1,102 @@
+"""
+Compiled, channels-last execution of the VAE and its loss.
+
+prepare_compiled_training converts the model to the channels-last memory format, which the oneDNN / cuDNN
+convolutions run without the NCHW layout conversions, and compiles the model forward and the MSE / KLD loss
+terms with torch.compile, which fuses the elementwise ops around the convolutions and matmuls
+(normalization, BatchNorm + ReLU, sigmoid, the KLD). AOTAutograd compiles their backward too. The spatial
+stats loss stays eager, see MaterialSimilarityLoss.compile_terms.
+
+Compilation happens on the first call, so it runs a warm-up step on the first batch and returns its time
+apart from the steady-state epochs. If compiling the loss terms fails only the model is compiled, and when
+torch.compile is missing or fails (torch < 2.0, Python 3.11 on torch 2.0, no C++ compiler for the CPU
+backend, ...) it falls back to eager execution, still channels-last, and says why:
+
+    runner, compile_info = prepare_compiled_training(vae, loss_function, train_loader, device)
+    train(log_interval, runner, loss_function, ...)  # runner is vae itself after a fallback
+
+Keep saving the state_dict of the model itself, the compiled module prefixes its keys with _orig_mod.
+"""
+import time
+
+import torch
+
+from training_utils import run_model
+
+
+def compile_unavailable_reason():
+    """Returns why torch.compile cannot be used here, None if it can."""
+    if not hasattr(torch, 'compile'):
+        return f"torch {torch.__version__} has no torch.compile"
+    try:
+        torch.compile(torch.nn.Identity())
+    except RuntimeError as e:  # e.g. Python 3.11+ on torch 2.0
+        return str(e)
+    return None
+
+
+def warm_up(runner, model, criterion, batch, device, model_precision='float32'):
+    """
+    Runs the forward, the loss and the backward of a training step on batch, which compiles them, and leaves
+    the model as it was: its BatchNorm statistics are restored and its gradients cleared.
+
+    Returns: the seconds the step took
+    """
+    state = {name: tensor.clone() for name, tensor in model.state_dict().items()}
+    X, y, *extra = batch
+    X = X.to(device)
+    X_idx = extra[0] if extra else None
+    features = extra[1].to(device) if len(extra) > 1 else None
+
+    model.train()
+    try:
+        start = time.perf_counter()
+        X_reconst, z, mu, logvar = run_model(runner, X, device, model_precision, features)
+        # same keyword arguments as the training batches, so their graph is the one compiled
+        loss = criterion(X, X_reconst, mu, logvar, 1, 0, 0, 1, 1, x_idx=X_idx, return_autocorrs=False)[5]
+        loss.backward()
+        if torch.device(device).type == 'cuda':
+            torch.cuda.synchronize()
+        return time.perf_counter() - start
+    finally:
+        model.load_state_dict(state)
+        model.zero_grad(set_to_none=True)
+
+
+def prepare_compiled_training(model, criterion, train_loader, device, model_precision='float32', channels_last=True, compile=True, mode=None):
+    """
+    model: the VAE, ResNet_VAE or SmallVAE
+    criterion: MaterialSimilarityLoss, its loss terms are compiled in place
+    train_loader: its first batch is the warm-up batch
+    mode: torch.compile mode, e.g. 'max-autotune' for long runs
+
+    Returns: the module to train with (the compiled model, or model after a fallback) and a dict with
+    'compiled' (bool), 'loss terms compiled' (bool), 'compile seconds' (the warm-up step) and
+    'fallback reason' (None if compiled)
+    """
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    info = {'compiled': False, 'loss terms compiled': False, 'compile seconds': 0.0, 'fallback reason': None}
+    if not compile:
+        return model, info
+
+    reason = compile_unavailable_reason()
+    if reason is None:
+        # the model and the loss terms, else the model alone, else eager
+        for compile_terms in [True, False]:
+            runner = torch.compile(model, mode=mode)
+            if compile_terms:
+                criterion.compile_terms(mode)
+            try:
+                info['compile seconds'] = warm_up(runner, model, criterion, next(iter(train_loader)), device, model_precision)
+                info['compiled'] = True
+                info['loss terms compiled'] = compile_terms
+                return runner, info
+            except Exception as e:  # compilation only fails on the first call
+                reason = f"{type(e).__name__}: {e}".split('\n')[0]
+                print(f"torch.compile failed ({reason})")
+                criterion.compiled_terms = None
+                torch._dynamo.reset()
+    print(f"torch.compile unavailable, running eagerly ({reason})")
+    info['fallback reason'] = reason
+    return model, info
@@ -0,0 +1,68 @@
+"""
+Data-parallel training across processes on the gloo backend, which needs no GPU and no network beyond the
+loopback interface of a single node (or a plain TCP connection between nodes).
+
+Every process (rank) trains a DistributedDataParallel replica of the model on its shard of the training set
+(utils.ResumableRandomSampler with num_replicas and rank), the backward averages the gradients over the ranks
+by all-reduce, and LossAccumulator.mean sums the losses of every rank. Rank 0 alone logs, checkpoints and
+saves the images, see run_training(distributed=True). Launch one process per rank with torchrun, e.g. 4 local
+processes of 2 threads each:
+
+    OMP_NUM_THREADS=2 torchrun --standalone --nproc_per_node 4 src/models/distributed_train.py --config <sweep yaml>
+
+distributed_benchmark.py measures the scaling efficiency for 1, 2, 4 and 8 ranks.
+"""
+from contextlib import contextmanager
+
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def init_distributed(backend='gloo'):
+    """
+    Joins the process group described by the environment variables torchrun sets (RANK, WORLD_SIZE,
+    MASTER_ADDR, MASTER_PORT), unless the process already is in one.
+
+    Returns: rank, world_size
+    """
+    if not is_distributed():
+        dist.init_process_group(backend)
+    return get_rank(), get_world_size()
+
+
+@contextmanager
+def main_process_first():
+    """Rank 0 runs the block before the other ranks, e.g. to build a cache they then read."""
+    if get_rank() != 0:
+        dist.barrier()
+    yield
+    if get_rank() == 0 and is_distributed():
+        dist.barrier()
+
+
+def gather_per_rank(obj):
+    """
+    Returns: obj, or in a distributed run the list of the obj of every rank, a collective. For the per-rank
+    state of a checkpoint rank 0 writes, such as the RNG states.
+    """
+    if not is_distributed():
+        return obj
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, obj)
+    return gathered
+
+
+def select_rank(gathered):
+    """The obj of this rank in the result of gather_per_rank, the same obj for every rank if it was not a list."""
+    return gathered[get_rank() % len(gathered)] if isinstance(gathered, list) else gathered
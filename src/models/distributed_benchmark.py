@@ -0,0 +1,101 @@
+# Measures the scaling of the data-parallel CPU training (see distributed.py) on this machine.
+# Run from the repository root: python src/models/distributed_benchmark.py
+# For 1, 2, 4 and 8 local ranks on the gloo backend it times DistributedDataParallel training steps
+# (forward, loss, backward with the gradient all-reduce, optimizer step) of a fixed batch per rank,
+# the CPU threads split evenly over the ranks, and prints the images/s and the scaling efficiency:
+# the images/s over world_size times the images/s of one rank with all the threads.
+import os
+import time
+import socket
+import argparse
+import multiprocessing
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+from training_utils import MaterialSimilarityLoss, run_model
+from compile_benchmark import build_model
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def time_rank(rank, world_size, port, model_name, backbone, batch_size, input_size, repeats, num_threads, results):
+    """Times the training steps of one rank, rank 0 puts the images/s of all the ranks in results."""
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(0)  # the same initial replicas
+    device = torch.device("cpu")
+    model = DistributedDataParallel(build_model(model_name, backbone, device))
+    optimizer = torch.optim.Adam([param for param in model.parameters() if param.requires_grad], lr=1e-3)
+    criterion = MaterialSimilarityLoss(device, -1.9e-09, 0.04, spatial_stat_loss_reduction='sum', normalize_spatial_stat_tensors=True)
+    torch.manual_seed(rank)  # a different shard per rank
+    X = (torch.rand(batch_size, 1, input_size, input_size) > 0.5).float()
+
+    def step():
+        X_reconst, z, mu, logvar = run_model(model, X, device)
+        loss = criterion(X, X_reconst, mu, logvar, 0.15, 0, 0, 0.85, 1, return_autocorrs=False)[5]
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    model.train()
+    step()  # warm up, e.g. the Adam state and the DDP buckets
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    dist.barrier()
+    if rank == 0:
+        results.put(world_size * batch_size * repeats / (time.perf_counter() - start))
+    dist.destroy_process_group()
+
+
+def time_world(world_size, args):
+    """Returns: the images/s of world_size local ranks"""
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    num_threads = max(args.threads // world_size, 1)
+    port = free_port()
+    processes = [
+        context.Process(target=time_rank, args=(rank, world_size, port, args.model, args.backbone, args.bs, args.input_size, args.repeats, num_threads, results))
+        for rank in range(world_size)
+        ]
+    for process in processes:
+        process.start()
+    # a failed rank leaves the others waiting in a collective, so they are stopped with it
+    while any(process.is_alive() for process in processes):
+        if any(process.exitcode not in (None, 0) for process in processes):
+            for process in processes:
+                process.terminate()
+        time.sleep(0.1)
+    failed = [rank for rank, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Ranks {failed} of the run with {world_size} ranks failed, see their tracebacks above")
+    return results.get(timeout=10)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the scaling efficiency of the data-parallel CPU training.")
+    parser.add_argument('--world_sizes', type=int, nargs='*', default=[1, 2, 4, 8], help="Numbers of local ranks.")
+    parser.add_argument('--model', type=str, default='small_vae', help="resnet_vae or small_vae.")
+    parser.add_argument('--backbone', type=str, default='resnet18', help="Encoder backbone of resnet_vae, see backbones.py.")
+    parser.add_argument('--bs', type=int, default=16, help="Batch size per rank.")
+    parser.add_argument('--input_size', type=int, default=224, help="Edge length of the square input images, 224 as the VAEs decode to.")
+    parser.add_argument('--repeats', type=int, default=10, help="Number of timed training steps.")
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help="Number of CPU threads shared by the ranks.")
+    args = parser.parse_args()
+    assert args.input_size == 224, "The VAEs decode to 224 x 224 images (and SmallVAE only encodes those)"
+
+    reference = None
+    for world_size in args.world_sizes:
+        images_per_second = time_world(world_size, args)
+        reference = reference or images_per_second / world_size
+        efficiency = images_per_second / (world_size * reference)
+        print(f"{world_size} ranks ({max(args.threads // world_size, 1)} threads each): {images_per_second:.2f} img/s, scaling efficiency {efficiency:.2f}")
@@ -0,0 +1,45 @@
+# Trains one configuration of a sweep YAML (the value, or the first of the values, of every parameter) data-parallel
+# on the CPU, see distributed.py. Launch one process per rank with torchrun from the repository root, e.g.
+#   OMP_NUM_THREADS=2 torchrun --standalone --nproc_per_node 4 src/models/distributed_train.py --config src/models/config_files/test.yaml
+# Rank 0 logs to W&B, the other ranks run it disabled.
+import os
+import yaml
+import argparse
+import wandb
+import torch.distributed as dist
+
+from wandb_train import run_training
+from sweep import run_training_kwargs
+from distributed import init_distributed
+
+
+def single_configuration(sweep_configuration):
+    """The parameters of a sweep configuration, the first of their values for those swept over."""
+    config = {}
+    for name, parameter in sweep_configuration['parameters'].items():
+        config[name] = parameter['value'] if 'value' in parameter else parameter['values'][0]
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train one configuration of a sweep YAML data-parallel on the CPU, launched with torchrun.")
+    parser.add_argument('--config', type=str, required=True, help="Sweep YAML, e.g. src/models/config_files/test.yaml")
+    parser.add_argument('--wandb_mode', type=str, default='online', help="W&B mode of rank 0: online, offline or disabled.")
+    args = parser.parse_args()
+
+    with open(os.path.join(os.getcwd(), args.config), "r") as yaml_file:
+        config = single_configuration(yaml.safe_load(yaml_file))
+
+    rank, world_size = init_distributed()
+    wandb.init(
+        project='sweep-vae-loss-alphas-and-neural-layers',
+        config=dict(config, world_size=world_size),
+        mode=args.wandb_mode if rank == 0 else 'disabled',
+        )
+    run_training(**run_training_kwargs(config), distributed=True)
+    wandb.finish()
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Vectorised training of several seeds of a ResNet_VAE in one process.
+
+The replicas share the frozen backbone (ResNet_VAE.freeze_backbone) of the first one, expand_channels
+included, which runs once per batch, or not at all with the backbone feature cache. Each replica is thus
+what training its seed with a frozen backbone would give, except for that backbone. The parameters and
+buffers of the rest of the replicas (the heads and the decoders) are stacked along a first dimension of
+size K, and ModelEnsemble runs the K heads at once with torch.func.vmap over torch.func.functional_call. One optimizer over the stacked
+parameters trains every replica: Adam is elementwise, so it is the same as K separate Adams.
+
+    replicas = [vae_seed_110, vae_seed_125, vae_seed_127]  # backbone frozen
+    ensemble = ModelEnsemble(replicas)
+    optimizer = torch.optim.Adam(ensemble.parameters(), lr=1e-3)
+    results = train_ensemble(..., ensemble, ...)  # one train result per replica, as train returns
+    vae_125 = ensemble.replica(1)  # a plain ResNet_VAE with the trained weights of the second replica
+
+See run_training(ensemble_seeds=...).
+"""
+import torch
+import torch.nn as nn
+from torch.func import functional_call, vmap
+
+from training_utils import LossAccumulator, run_model, mark_last
+
+
+SHARED_MODULES = ('expand_channels', 'resnet')
+
+
+def is_shared(name):
+    """Whether the parameter or buffer name belongs to the backbone the replicas share."""
+    return name.split('.')[0] in SHARED_MODULES
+
+
+class ModelEnsemble(nn.Module):
+    def __init__(self, replicas):
+        """
+        replicas: ResNet_VAEs with frozen backbones, initialized with different seeds. They are made to share
+        the backbone modules of the first one, so their own backbones are dropped.
+        """
+        super(ModelEnsemble, self).__init__()
+        assert all(replica.backbone_frozen for replica in replicas), "The replicas need frozen backbones to share"
+        for replica in replicas[1:]:
+            replica.expand_channels, replica.resnet = replicas[0].expand_channels, replicas[0].resnet
+        # a plain list, so the parameters of the ensemble are only the stacked ones
+        self.replicas = list(replicas)
+        self.num_replicas = len(replicas)
+
+        heads = [dict(replica.named_parameters()) for replica in replicas]
+        self.param_names = [name for name in heads[0] if not is_shared(name)]
+        self.stacked_params = nn.ParameterList([
+            nn.Parameter(torch.stack([head[name].detach() for head in heads]))
+            for name in self.param_names
+            ])
+        buffers = [dict(replica.named_buffers()) for replica in replicas]
+        # the BatchNorm running statistics, updated in place by the vmapped forward. Registered under their
+        # index, buffer names cannot contain dots
+        self.buffer_names = [name for name in buffers[0] if not is_shared(name)]
+        for i, name in enumerate(self.buffer_names):
+            self.register_buffer(f'stacked_buffer_{i}', torch.stack([buffer[name] for buffer in buffers]))
+
+    @property
+    def stacked_buffers(self):
+        # looked up every time, .to() replaces the buffers
+        return {name: getattr(self, f'stacked_buffer_{i}') for i, name in enumerate(self.buffer_names)}
+
+    def train(self, mode=True):
+        super(ModelEnsemble, self).train(mode)
+        # the vmapped forward runs the first replica's modules
+        self.replicas[0].train(mode)
+        return self
+
+    def head(self, params, buffers, x, features):
+        return functional_call(self.replicas[0], {**params, **buffers}, (x,), {'features': features})
+
+    def forward(self, x, features=None):
+        """
+        x: Torch tensor of shape (bs, 1, 224, 224)
+        features: precomputed backbone features of x, see feature_cache.py
+
+        Returns: x_reconst, z, mu, logvar of every replica, stacked along a first dimension of size K
+        """
+        if features is None:
+            with torch.no_grad():
+                features = self.replicas[0].backbone_features(x)
+        params = dict(zip(self.param_names, self.stacked_params))
+        return vmap(self.head, in_dims=(0, 0, None, None), randomness='different')(params, self.stacked_buffers, x, features)
+
+    def replica(self, k):
+        """
+        Returns: the ResNet_VAE of replica k, its head and decoder set to the trained weights. For its
+        state_dict, reconstruct_images and generate_from_noise.
+        """
+        replica = self.replicas[k]
+        params, buffers = dict(replica.named_parameters()), dict(replica.named_buffers())
+        with torch.no_grad():
+            for name, stacked in zip(self.param_names, self.stacked_params):
+                params[name].copy_(stacked[k])
+            for name, stacked in self.stacked_buffers.items():
+                buffers[name].copy_(stacked[k])
+        return replica
+
+    def replica_optimizer_state_dict(self, k, optimizer):
+        """
+        Returns: the state_dict of the optimizer replica k would have been trained with on its own, over all its
+        parameters as in run_training, from the optimizer of the stacked parameters. Their per-parameter state
+        is sliced, the scalars (e.g. the step of Adam) copied.
+        """
+        replica_optimizer = type(optimizer)(self.replicas[k].parameters(), **optimizer.defaults)
+        replica_optimizer.param_groups[0].update({key: value for key, value in optimizer.param_groups[0].items() if key != 'params'})
+        params = dict(self.replicas[k].named_parameters())
+        for name, stacked in zip(self.param_names, self.stacked_params):
+            if stacked in optimizer.state:
+                replica_optimizer.state[params[name]] = {
+                    key: value[k].clone() if torch.is_tensor(value) and value.dim() > 0 and value.shape[0] == self.num_replicas else value
+                    for key, value in optimizer.state[stacked].items()
+                    }
+        return replica_optimizer.state_dict()
+
+
+def replica_losses(criterion, X, outputs, a_mse, a_content, a_style, a_spst, beta, x_idx=None, return_autocorrs=True):
+    """
+    Returns: the outputs of criterion for every replica. The input autocorrelations are the same for all of them,
+    with an autocorrelation cache (x_idx) only the first replica computes them.
+    """
+    X_reconst, z, mu, logvar = outputs
+    return [
+        criterion(X, X_reconst[k], mu[k], logvar[k], a_mse, a_content, a_style, a_spst, beta, x_idx=x_idx, return_autocorrs=return_autocorrs)
+        for k in range(len(X_reconst))
+        ]
+
+
+def train_ensemble(log_interval, ensemble, criterion, device, train_loader, optimizer, epoch, a_mse, a_content, a_style, a_spst, beta, testing, log_autocorrs=True, model_precision='float32'):
+    # as train, for a ModelEnsemble. Returns the list of the train results of every replica, without grad_stats
+    ensemble.train()
+
+    num_replicas = ensemble.num_replicas
+    losses = LossAccumulator(6 * num_replicas, device)
+    N_count = 0   # counting total trained sample in one epoch
+    num_batches = len(train_loader)
+
+    for batch_idx, ((X, y, *extra), is_last) in enumerate(mark_last(train_loader)):
+        # distribute data to device
+        X, y = X.to(device, non_blocking=True), y.to(device, non_blocking=True).view(-1, )
+        X_idx = extra[0] if extra else None
+        features = extra[1].to(device, non_blocking=True) if len(extra) > 1 else None
+        N_count += X.size(0)
+        last_batch = is_last or (testing and batch_idx > 1)
+
+        outputs = run_model(ensemble, X, device, model_precision, features)  # every VAE at once
+        terms = replica_losses(criterion, X, outputs, a_mse, a_content, a_style, a_spst, beta, x_idx=X_idx, return_autocorrs=log_autocorrs and last_batch)
+
+        optimizer.zero_grad()
+        # the replicas do not share trained parameters, so the gradient of the sum is that of the loss of each
+        sum(replica_terms[5] for replica_terms in terms).backward()
+        optimizer.step()
+
+        losses.update([value for replica_terms in terms for value in criterion.per_sample_terms(replica_terms[:5], (a_mse, a_content, a_style, a_spst, beta), X.size(0))], X.size(0))
+        if (batch_idx + 1) % log_interval == 0:
+            window = losses.log_window()
+            if window is not None:
+                print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss per replica: {}'.format(
+                    epoch + 1, N_count, len(train_loader.dataset), 100. * (batch_idx + 1) / num_batches,
+                    ', '.join('{:.6f}'.format(loss) for loss in window.reshape(num_replicas, 6)[:, -1])))
+
+        if testing and batch_idx > 1:
+            break
+
+    losses = losses.mean().reshape(num_replicas, 6)
+    X_reconst, z, mu, logvar = outputs
+    return [
+        (X.data.cpu().numpy(), y.data.cpu().numpy(), z[k].data.cpu().numpy(), mu[k].data.cpu().numpy(), logvar[k].data.cpu().numpy(), losses[k], terms[k][6], terms[k][7], {})
+        for k in range(num_replicas)
+        ]
+
+
+def validation_ensemble(ensemble, criterion, device, test_loader, a_mse, a_content, a_style, a_spst, beta, testing, log_autocorrs=True, model_precision='float32'):
+    # as validation, for a ModelEnsemble. Returns the list of the validation results of every replica
+    ensemble.eval()
+    num_replicas = ensemble.num_replicas
+    losses = LossAccumulator(6 * num_replicas, device)
+    with torch.no_grad():
+        for batch_idx, ((X, y, *extra), is_last) in enumerate(mark_last(test_loader)):
+            # distribute data to device
+            X, y = X.to(device, non_blocking=True), y.to(device, non_blocking=True).view(-1, )
+            X_idx = extra[0] if extra else None
+            features = extra[1].to(device, non_blocking=True) if len(extra) > 1 else None
+            last_batch = is_last or (testing and batch_idx > 1)
+            outputs = run_model(ensemble, X, device, model_precision, features)
+
+            terms = replica_losses(criterion, X, outputs, a_mse, a_content, a_style, a_spst, beta, x_idx=X_idx, return_autocorrs=log_autocorrs and last_batch)
+            losses.update([value for replica_terms in terms for value in criterion.per_sample_terms(replica_terms[:5], (a_mse, a_content, a_style, a_spst, beta), X.size(0))], X.size(0))
+
+            if testing and batch_idx > 1:
+                break
+
+    losses = losses.mean().reshape(num_replicas, 6)
+
+    # show information
+    print('\nTest set ({:d} samples): Average loss per replica: {}\n'.format(len(test_loader.dataset), ', '.join('{:.4f}'.format(loss) for loss in losses[:, -1])))
+    X_reconst, z, mu, logvar = outputs
+    return [
+        (X.data.cpu().numpy(), y.data.cpu().numpy(), z[k].data.cpu().numpy(), mu[k].data.cpu().numpy(), logvar[k].data.cpu().numpy(), losses[k], terms[k][6], terms[k][7])
+        for k in range(num_replicas)
+        ]
@@ -0,0 +1,111 @@
+"""
+Cache of the frozen ResNet_VAE backbone features of a dataset.
+
+With a frozen backbone (ResNet_VAE.freeze_backbone), expand_channels / normalize / resnet map every
+dataset image to the same pooled features at every epoch. load_feature_cache runs the backbone
+once over the dataset and keeps the features in a memory-mapped features.npy, and FeatureCacheDataset
+yields them next to the images, so training starts at fc1 and only the heads and the decoder run:
+
+    vae.freeze_backbone()
+    features = load_feature_cache(vae, dataset, cache_dir, collate_fn, device)
+    dataset = FeatureCacheDataset(dataset, features)  # yields (image, label, idx, features)
+
+The cache is rebuilt when the images, the preprocessing or the backbone weights change. expand_channels
+is randomly initialized, so it is keyed to the run's seed (and checkpoint) as well.
+"""
+import os
+import json
+import hashlib
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from utils import check_mkdir
+
+
+def backbone_hash(vae):
+    """
+    sha256 of the weights and buffers of the backbone of a ResNet_VAE.
+    """
+    digest = hashlib.sha256()
+    for module_name in ['expand_channels', 'resnet']:
+        state = getattr(vae, module_name).state_dict()
+        for name, tensor in state.items():
+            digest.update(f'{module_name}.{name}'.encode())
+            digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    for tensor in [vae.normalize.mean, vae.normalize.std]:
+        digest.update(tensor.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+class FeatureCacheDataset(Dataset):
+    def __init__(self, dataset, features_path):
+        """
+        Wraps a dataset yielding (image, label) so that it yields (image, label, idx, features),
+        idx being the index in the wrapped dataset as with utils.IndexedDataset.
+
+        features_path: the features.npy of the dataset, see load_feature_cache
+        """
+        self.dataset = dataset
+        self.features_path = features_path
+        # opened lazily so every DataLoader worker maps the file itself
+        self.features = None
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        if self.features is None:
+            self.features = np.load(self.features_path, mmap_mode='r')
+        image, label = self.dataset[idx]
+        return image, label, idx, torch.from_numpy(np.array(self.features[idx]))
+
+
+def build_feature_cache(vae, dataset, cache_dir, digest, collate_fn=None, device='cpu', batch_size=64, num_workers=4):
+    """
+    Runs the backbone of vae in eval mode over dataset, in order, and writes its features.
+    """
+    check_mkdir(cache_dir)
+    tmp_path = os.path.join(cache_dir, 'features.tmp.npy')
+    features = None
+    start = 0
+    training = vae.training
+    vae.eval()
+    with torch.no_grad():
+        for X, *_ in DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=collate_fn):
+            batch_features = vae.backbone_features(X.to(device)).float().cpu().numpy()
+            if features is None:
+                features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(len(dataset), batch_features.shape[1]))
+            features[start:start + len(X)] = batch_features
+            start += len(X)
+    vae.train(training)
+    features.flush()
+    del features
+
+    os.replace(tmp_path, os.path.join(cache_dir, 'features.npy'))
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+        json.dump({'hash': digest, 'num_images': len(dataset)}, f)
+
+
+def load_feature_cache(vae, dataset, cache_dir, data_hash, collate_fn=None, device='cpu'):
+    """
+    Returns the path of the features of dataset in cache_dir, (re)building them if they are missing or stale.
+
+    vae: ResNet_VAE with a frozen backbone
+    dataset: Dataset yielding (image, label), collated by collate_fn
+    data_hash: hash of the images and their preprocessing, e.g. packed_dataset.source_hash
+    """
+    assert vae.backbone_frozen, "The feature cache needs a frozen backbone, call vae.freeze_backbone() first"
+    digest = hashlib.sha256((data_hash + backbone_hash(vae)).encode()).hexdigest()
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['hash'] == digest and meta['num_images'] == len(dataset):
+            return os.path.join(cache_dir, 'features.npy')
+        # drop the stale index first, an interrupted rebuild then leaves no cache rather than a mismatched one
+        os.remove(meta_path)
+    print(f"Building the backbone feature cache in {cache_dir}")
+    build_feature_cache(vae, dataset, cache_dir, digest, collate_fn, device)
+    return os.path.join(cache_dir, 'features.npy')
@@ -0,0 +1,98 @@
+"""
+Per-loss-term gradient statistics, computed on the device.
+
+GradientDiagnostics takes the gradients of every loss term with torch.autograd.grad, restricted to the
+trainable parameters, and reduces them per parameter group (the top-level modules of the model) to
+four sums. Only these are kept between batches and the summary reads them back once, so the logger
+gets a few scalars per term and group instead of every gradient element.
+"""
+from collections import OrderedDict
+
+import torch
+
+
+class GradientDiagnostics(object):
+    def __init__(self, model, every_n_batches=None, groups=None):
+        """
+        model: the model whose trainable parameters (requires_grad) are tracked
+        every_n_batches: measure every n batches, None for the first batch of every epoch only
+        groups: dict of group name -> list of parameter names, defaults to grouping by top-level module
+        """
+        self.every_n_batches = every_n_batches
+        named_parameters = OrderedDict((name, param) for name, param in model.named_parameters() if param.requires_grad)
+        if groups is None:
+            groups = OrderedDict()
+            for name in named_parameters:
+                groups.setdefault(name.split('.')[0], []).append(name)
+        self.group_names = list(groups)
+        self.params = list(named_parameters.values())
+        # group index of every tracked parameter
+        group_of = {name: g for g, group in enumerate(groups.values()) for name in group}
+        self.param_groups = [group_of[name] for name in named_parameters]
+        self.reset()
+
+    def reset(self):
+        """Forgets the measurements, call it at the start of every epoch."""
+        self.measurements = OrderedDict()
+
+    def due(self, batch_idx):
+        if self.every_n_batches is None:
+            return batch_idx == 0
+        return batch_idx % self.every_n_batches == 0
+
+    def sums(self, grads):
+        """
+        Returns: float64 tensor of shape (num_groups + 1, 4), the sum, sum of absolute values, sum of squares
+        and number of the gradient elements of every group and, in the last row, of all of them
+        """
+        sums = torch.zeros(len(self.group_names) + 1, 4, dtype=torch.float64, device=self.params[0].device)
+        for group, grad in zip(self.param_groups, grads):
+            if grad is None:
+                continue
+            grad = grad.detach().to(torch.float64)
+            row = torch.stack([grad.sum(), grad.abs().sum(), (grad**2).sum(), grad.new_tensor(grad.numel())])
+            sums[group] += row
+            sums[-1] += row
+        return sums
+
+    def measure(self, losses):
+        """
+        losses: dict of loss term name -> scalar loss tensor, whose graph is kept for the training backward
+        """
+        for term, loss in losses.items():
+            grads = torch.autograd.grad(loss, self.params, retain_graph=True, allow_unused=True)
+            self.measurements.setdefault(term, []).append(self.sums(grads))
+
+    def measure_params(self, term):
+        """Measures the gradients currently stored in the .grad of the parameters, e.g. after backward."""
+        self.measurements.setdefault(term, []).append(self.sums([param.grad for param in self.params]))
+
+    def summary(self):
+        """
+        Returns: dict of '<term> gradients <statistic>' (all groups) and '<term> gradients/<group> <statistic>'
+        -> float, with the statistics norm, mean (of the absolute values) and std, averaged over the
+        measured batches. Groups without gradients for a term are left out.
+        """
+        summary = {}
+        if not self.measurements:
+            return summary
+        terms = list(self.measurements)
+        # (terms, batches, groups + 1, 4) read back at once
+        sums = torch.stack([torch.stack(self.measurements[term]) for term in terms]).cpu()
+        total, total_abs, total_sq, count = sums.unbind(-1)
+        measured = count > 0
+        count = count.clamp(min=1)
+        statistics = {
+            'norm': total_sq.sqrt(),
+            'mean': total_abs / count,
+            'std': (total_sq / count - (total / count)**2).clamp(min=0).sqrt(),
+        }
+        for t, term in enumerate(terms):
+            for g, group in enumerate(self.group_names + [None]):
+                batches = measured[t, :, g]
+                if not batches.any():
+                    continue
+                prefix = f'{term} gradients' if group is None else f'{term} gradients/{group}'
+                for statistic, values in statistics.items():
+                    summary[f'{prefix} {statistic}'] = values[t, batches, g].mean().item()
+        return summary
@@ -1,17 +1,18 @@
 import os
 import torch
 from torch.utils.data import DataLoader
-from torchvision import transforms
 import numpy as np
 import argparse
 
 from resnet_vae import ResNet_VAE
 from training_utils import seed_everything, reconstruct_images
 from lines_dataset import LinesDataset
-from utils import ThresholdTransform
+from preprocessing import BatchPreprocess, image_transform
+from autocorr_store import AutocorrelationStore
+from utils import IndexedDataset
 
 # Define main function
-def main(save_model_path, epoch):
+def main(save_model_path, epoch, backbone='resnet152'):
     # Your existing code here
     seed = 127
     seed_everything(seed)
@@ -22,24 +23,25 @@ def main(save_model_path, epoch):
     device = torch.device("cuda" if use_cuda else "cpu")
 
     model_path = os.path.join(save_model_path, f"model_epoch{epoch}.pth")
-    vae = ResNet_VAE(CNN_embed_dim=CNN_embed_dim, device=device).to(device)
-    vae.resnet.requires_grad_(False)
+    vae = ResNet_VAE(CNN_embed_dim=CNN_embed_dim, device=device, backbone=backbone).to(device)
+    if vae.backbone_pretrained:
+        vae.resnet.requires_grad_(False)
     vae.load_state_dict(torch.load(model_path))
 
     data_dir = 'lines'
     dataset_path = os.path.join(os.getcwd(), "data")
-    transform = transforms.Compose([
-            transforms.ToTensor(),  # Convert the image to tensor
-            transforms.Normalize((0.5,), (0.5,)), 
-            transforms.Resize([res_size, res_size], antialias=True),
-            ThresholdTransform(thr_255=240),
-        ])
-    dataset = LinesDataset(f'{dataset_path}/{data_dir}/labels.csv', f'{dataset_path}/{data_dir}/images', transform)
+    preprocess = BatchPreprocess(res_size=res_size, thr_255=240)
+    dataset = LinesDataset(f'{dataset_path}/{data_dir}/labels.csv', f'{dataset_path}/{data_dir}/images', image_transform())
+    # read the original autocorrelations from the store written by transform_to_autocorrs.py if there is one
+    autocorr_store = None
+    if os.path.exists(f'{dataset_path}/{data_dir}/autocorr_store/index.json'):
+        autocorr_store = AutocorrelationStore(f'{dataset_path}/{data_dir}/autocorr_store')
+        dataset = IndexedDataset(dataset)
     _, valid_dataset = torch.utils.data.random_split(dataset, [int(len(dataset)*0.7), int(len(dataset)) - int(len(dataset)*0.7)])
-    valid_loader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=False)
+    valid_loader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=False, collate_fn=preprocess.collate)
 
     # save 100 pairs of images
-    orig, recon, orig_autocorr, recon_autocorr = reconstruct_images(vae, valid_loader, device, num_examples=100)
+    orig, recon, orig_autocorr, recon_autocorr = reconstruct_images(vae, valid_loader, device, num_examples=100, autocorr_store=autocorr_store)
     np.save(os.path.join(save_model_path, 'original_images_epoch{}.npy'.format(epoch)), orig.numpy())
     np.save(os.path.join(save_model_path, 'reconstructed_images_epoch{}.npy'.format(epoch)), recon.numpy())
     np.save(os.path.join(save_model_path, 'original_autocorr_epoch{}.npy'.format(epoch)), orig_autocorr.numpy())
@@ -51,9 +53,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run VAE model reconstruction")
     parser.add_argument("save_model_path", type=str, help="Path to save the model")
     parser.add_argument("epoch", type=int, help="Epoch number")
+    parser.add_argument("--backbone", type=str, default='resnet152', help="Encoder backbone the model was trained with")
 
     args = parser.parse_args()
 
     # Call main function with parsed arguments
-    main(args.save_model_path, args.epoch)
+    main(args.save_model_path, args.epoch, args.backbone)
 
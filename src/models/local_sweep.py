@@ -0,0 +1,266 @@
+"""
+Runs a sweep of config_files/ (the W&B sweep schema) on this machine, without the W&B sweep service or a
+network connection. Run from the repository root:
+
+    python src/models/local_sweep.py --config src/models/config_files/tune_mean_reduction_spst_lr.yaml --threads_per_trial 4
+
+method grid runs every combination of the values of the parameters, random draws run_cap (or --max_trials)
+of them, values uniformly and distributions uniform, int_uniform, log_uniform_values and q_uniform between
+min and max. Every trial runs in a process of its own, as many at once as the CPU threads fit trials of
+threads_per_trial torch threads, with W&B disabled (or offline). Unlike the workers of a multiprocessing.Pool
+these processes are not daemonic, so the DataLoaders of run_training can start their worker processes.
+
+early_terminate hyperband stops the trials by asynchronous successive halving: at every rung epoch (min_iter,
+min_iter * eta, ..., s of them, or max_iter / eta^s, ..., max_iter / eta) a trial goes on only when its metric
+is among the best 1 / eta of those the trials reached at that epoch so far. A trial whose metric is not finite
+is stopped at once.
+
+Every finished trial is appended to sweep_results.jsonl in models/sweeps/<config name>: its configuration, its
+status (completed, stopped or failed), its metric after every epoch and its best. Running the sweep again skips
+the configurations already there, and the rungs start from their metrics.
+"""
+import os
+import json
+import math
+import time
+import queue
+import random
+import argparse
+import itertools
+import multiprocessing
+
+import yaml
+import numpy as np
+import torch
+import wandb
+
+from wandb_train import run_training
+from sweep import run_training_kwargs
+from utils import check_mkdir
+
+
+# the sweeps name the validation loss overall_loss, run_training logs its mean per sample as overall_validation_loss_per_sample
+METRIC_ALIASES = {'overall_loss': 'overall_validation_loss_per_sample', 'overall_validation_loss': 'overall_validation_loss_per_sample'}
+
+
+def grid_configurations(parameters):
+    """Every combination of the values of the parameters."""
+    names = list(parameters)
+    values = [parameters[name]['values'] if 'values' in parameters[name] else [parameters[name]['value']] for name in names]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def sample_value(parameter, rng):
+    if 'value' in parameter:
+        return parameter['value']
+    if 'values' in parameter:
+        return parameter['values'][rng.randrange(len(parameter['values']))]
+    distribution = parameter.get('distribution', 'uniform')
+    low, high = parameter['min'], parameter['max']
+    if distribution == 'int_uniform':
+        return rng.randint(low, high)
+    if distribution == 'log_uniform_values':
+        return math.exp(rng.uniform(math.log(low), math.log(high)))
+    if distribution == 'q_uniform':
+        return round(rng.uniform(low, high) / parameter.get('q', 1)) * parameter.get('q', 1)
+    assert distribution == 'uniform', f"Unsupported distribution {distribution}"
+    return rng.uniform(low, high)
+
+
+def random_configurations(parameters, num_trials, seed=0):
+    """num_trials configurations drawn at random, the same ones for the same seed."""
+    rng = random.Random(seed)
+    return [{name: sample_value(parameter, rng) for name, parameter in parameters.items()} for _ in range(num_trials)]
+
+
+def rung_epochs(early_terminate, epochs):
+    """The epochs hyperband compares the trials at, see the module docstring."""
+    eta = early_terminate.get('eta', 3)
+    if 'max_iter' in early_terminate:
+        return [int(early_terminate['max_iter'] / eta**i) for i in range(early_terminate.get('s', 1), 0, -1)]
+    rungs = []
+    epoch = early_terminate['min_iter']
+    while epoch < epochs and len(rungs) < early_terminate.get('s', float('inf')):
+        rungs.append(int(epoch))
+        epoch *= eta
+    return rungs
+
+
+class SuccessiveHalving(object):
+    def __init__(self, rungs, eta, goal='minimize', records=None, lock=None):
+        """
+        Asynchronous successive halving of the trials of a sweep, shared by the processes running them.
+
+        rungs: epochs at which the trials are compared
+        records: dict of rung -> metrics the trials reached there (lower is better), a multiprocessing.Manager
+        dict with its lock to share it between the trials
+        """
+        self.rungs = set(rungs)
+        self.eta = eta
+        self.sign = 1 if goal == 'minimize' else -1
+        self.records = {} if records is None else records
+        self.lock = lock
+
+    def should_stop(self, epoch, value):
+        """Records the metric a trial reached after epoch epochs, returns whether it should stop."""
+        if not math.isfinite(value):
+            return True
+        if epoch not in self.rungs:
+            return False
+        value = self.sign * value
+        if self.lock is not None:
+            self.lock.acquire()
+        try:
+            values = self.records.get(epoch, []) + [value]
+            self.records[epoch] = values
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+        return sorted(values).index(value) >= math.ceil(len(values) / self.eta)
+
+
+def run_trial(trial, config, metric_name, halving, threads, wandb_mode, project):
+    """
+    Trains one configuration, in a process of its own.
+
+    Returns: the record of the trial for the results store
+    """
+    torch.set_num_threads(threads)
+    history = []
+    stopped = [False]
+
+    def epoch_callback(epochs_done, metrics):
+        history.append(float(np.mean(metrics[metric_name])))
+        stopped[0] = halving is not None and halving.should_stop(epochs_done, history[-1])
+        return stopped[0]
+
+    record = {'trial': trial, 'config': config}
+    start = time.time()
+    wandb.init(project=project, config=config, name=f"trial_{trial}", mode=wandb_mode, reinit=True)
+    try:
+        run_training(**run_training_kwargs(config), epoch_callback=epoch_callback)
+        record['status'] = 'stopped' if stopped[0] else 'completed'
+    except Exception as error:
+        record['status'], record['error'] = 'failed', repr(error)
+    finally:
+        wandb.finish()
+    record.update({'epochs': len(history), 'history': history, 'seconds': time.time() - start})
+    return record
+
+
+def run_trial_process(results, *args):
+    results.put(run_trial(*args))
+
+
+def read_results(results_path):
+    if not os.path.exists(results_path):
+        return []
+    with open(results_path, 'r') as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+
+def config_key(config):
+    return json.dumps(config, sort_keys=True)
+
+
+def run_sweep(sweep_configuration, sweep_dir, threads_per_trial=1, processes=None, max_trials=None, seed=0, wandb_mode='disabled', project='local-sweep'):
+    """
+    Runs the trials of sweep_configuration not yet in sweep_dir/sweep_results.jsonl, see the module docstring.
+
+    processes: number of trials run at once, defaults to the CPU threads over threads_per_trial
+    max_trials: number of configurations of a random search, defaults to the run_cap of the sweep
+
+    Returns: the records of all the trials of the sweep, the ones of earlier runs included
+    """
+    parameters = sweep_configuration['parameters']
+    if sweep_configuration.get('method', 'grid') == 'grid':
+        configs = grid_configurations(parameters)
+    else:
+        num_trials = max_trials or sweep_configuration.get('run_cap')
+        assert num_trials, "A random search needs run_cap in the sweep or max_trials"
+        configs = random_configurations(parameters, num_trials, seed=seed)
+    metric = sweep_configuration.get('metric', {'name': 'overall_validation_loss_per_sample', 'goal': 'minimize'})
+    metric_name = METRIC_ALIASES.get(metric['name'], metric['name'])
+    goal = metric.get('goal', 'minimize')
+
+    check_mkdir(sweep_dir)
+    results_path = os.path.join(sweep_dir, 'sweep_results.jsonl')
+    records = read_results(results_path)
+    done = {config_key(record['config']) for record in records}
+
+    manager = multiprocessing.get_context('spawn').Manager()
+    halving = None
+    early_terminate = sweep_configuration.get('early_terminate')
+    if early_terminate is not None:
+        assert early_terminate.get('type') == 'hyperband', "Only the hyperband early termination is supported"
+        epochs = max(config.get('epochs', 1) for config in configs)
+        rungs = rung_epochs(early_terminate, epochs)
+        # the rungs start from the trials of the earlier runs of the sweep
+        sign = 1 if goal == 'minimize' else -1
+        shared = manager.dict({rung: [sign * record['history'][rung - 1] for record in records if len(record['history']) >= rung and math.isfinite(record['history'][rung - 1])] for rung in rungs})
+        halving = SuccessiveHalving(rungs, early_terminate.get('eta', 3), goal, shared, manager.Lock())
+        print(f"Successive halving at epochs {rungs}")
+
+    todo = [(trial, config) for trial, config in enumerate(configs) if config_key(config) not in done]
+    processes = processes or max(1, (os.cpu_count() or 1) // threads_per_trial)
+    print(f"{len(todo)} of {len(configs)} trials to run in {processes} processes of {threads_per_trial} threads")
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    running = {}  # trial -> (process, config, start time)
+    while todo or running:
+        while todo and len(running) < processes:
+            trial, config = todo.pop(0)
+            process = context.Process(target=run_trial_process, args=(results, trial, config, metric_name, halving, threads_per_trial, wandb_mode, project))
+            process.start()
+            running[trial] = (process, config, time.time())
+        try:
+            record = results.get(timeout=1)
+        except queue.Empty:
+            # a process that exits without its record, e.g. killed for its memory, fails its trial
+            crashed = [trial for trial, (process, _, _) in running.items() if process.exitcode not in (None, 0)]
+            if not crashed:
+                continue
+            process, config, start = running[crashed[0]]
+            record = {'trial': crashed[0], 'config': config, 'status': 'failed', 'error': f"exit code {process.exitcode}",
+                      'epochs': 0, 'history': [], 'seconds': time.time() - start}
+        if record['trial'] not in running:
+            continue  # the late record of a trial that crashed on exit, already recorded as failed
+        running.pop(record['trial'])[0].join()
+        finite = [value for value in record['history'] if math.isfinite(value)]
+        record['best'] = ((min if goal == 'minimize' else max)(finite)) if finite else None
+        with open(results_path, 'a') as results_file:
+            results_file.write(json.dumps(record) + '\n')
+        records.append(record)
+        print(f"Trial {record['trial']} {record['status']} after {record['epochs']} epochs, best {metric_name} {record['best']}")
+    manager.shutdown()
+    return records
+
+
+def best_record(records, goal='minimize'):
+    scored = [record for record in records if record['best'] is not None]
+    if not scored:
+        return None
+    return (min if goal == 'minimize' else max)(scored, key=lambda record: record['best'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a sweep YAML locally in parallel processes, with successive halving.")
+    parser.add_argument('--config', type=str, required=True, help="Sweep YAML, e.g. src/models/config_files/test.yaml")
+    parser.add_argument('--threads_per_trial', type=int, default=1, help="Number of torch threads of every trial.")
+    parser.add_argument('--processes', type=int, default=None, help="Number of trials run at once, defaults to the CPU threads over threads_per_trial.")
+    parser.add_argument('--max_trials', type=int, default=None, help="Number of configurations of a random search.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the random search.")
+    parser.add_argument('--wandb_mode', type=str, default='disabled', help="W&B mode of the trials: disabled or offline.")
+    args = parser.parse_args()
+
+    with open(os.path.join(os.getcwd(), args.config), "r") as yaml_file:
+        sweep_configuration = yaml.safe_load(yaml_file)
+    sweep_name = os.path.splitext(os.path.basename(args.config))[0]
+    sweep_dir = os.path.join(os.getcwd(), "models", "sweeps", sweep_name)
+
+    records = run_sweep(sweep_configuration, sweep_dir, threads_per_trial=args.threads_per_trial, processes=args.processes,
+                        max_trials=args.max_trials, seed=args.seed, wandb_mode=args.wandb_mode, project=sweep_name)
+    goal = sweep_configuration.get('metric', {}).get('goal', 'minimize')
+    best = best_record(records, goal)
+    if best is not None:
+        print(f"Best trial {best['trial']}: {best['best']} with {best['config']}")
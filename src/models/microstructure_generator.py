@@ -0,0 +1,137 @@
+"""
+Procedural generator of the synthetic binary microstructures, as an alternative to the PNG datasets.
+
+MicrostructureGenerator rasterises whole batches of lines, squares or circles directly at the training
+resolution, with the same conventions as the preprocessed LinesDataset / ShapesDataset images:
+background 1, features (phase 0) 0, label 0 for vertical lines / squares and 1 for horizontal lines / circles.
+MicrostructureDataset wraps it in an IterableDataset yielding ready batches:
+
+    generator = MicrostructureGenerator.preset('lines')
+    loader = DataLoader(MicrostructureDataset(generator, batch_size=32, num_batches=100), batch_size=None, num_workers=4)
+
+Every batch is drawn from its own seed, derived from (seed, epoch, batch index), so the data only depends on
+the seed and the epoch, not on the number of workers or on the order they run in.
+"""
+import math
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+def sample_range(value_range, shape, generator, integer=False):
+    """
+    Draws uniformly from value_range, a number or a (low, high) pair (inclusive for integers).
+    """
+    low, high = value_range if isinstance(value_range, (tuple, list)) else (value_range, value_range)
+    if integer:
+        return torch.randint(int(low), int(high) + 1, shape, generator=generator)
+    return low + (high - low) * torch.rand(shape, generator=generator)
+
+
+class MicrostructureGenerator(object):
+    PRESETS = {
+        # approximations of the stored datasets, from their volume fractions (max autocorrelation in pixel_values.txt)
+        'lines': dict(kind='lines', num_features=1, feature_size=9),
+        'multiple_lines': dict(kind='lines', num_features=(2, 5), feature_size=(5, 9)),
+        'shapes': dict(kind='shapes', num_features=1, feature_size=(25, 40)),
+    }
+
+    def __init__(self, kind='lines', size=224, num_features=1, feature_size=9, labels=(0, 1), volume_fraction=None):
+        """
+        kind: 'lines' or 'shapes'
+        size: edge length of the square images
+        num_features: number of lines / shapes per image, a number or a (low, high) range
+        feature_size: line width, or half side of the squares and radius of the circles, in pixels (number or range)
+        labels: the labels to draw from. For lines 0 is vertical and 1 horizontal, for shapes 0 is square and 1 circle.
+        Every line of an image has the same orientation and every shape the same type.
+        volume_fraction: if given (number or range), the fraction of feature pixels to aim for, which then sets
+        the feature size instead of feature_size. Overlapping shapes and lines make the actual fraction lower.
+        """
+        assert kind in ['lines', 'shapes'], "kind should be 'lines' or 'shapes'"
+        self.kind = kind
+        self.size = size
+        self.num_features = num_features
+        self.feature_size = feature_size
+        self.labels = torch.tensor(labels)
+        self.volume_fraction = volume_fraction
+        self.max_features = max(num_features) if isinstance(num_features, (tuple, list)) else num_features
+
+    @classmethod
+    def preset(cls, name, **kwargs):
+        """A generator resembling the 'lines', 'multiple_lines' or 'shapes' dataset, kwargs override the preset."""
+        assert name in cls.PRESETS, f"No preset for {name}, choose among {list(cls.PRESETS)}"
+        return cls(**{**cls.PRESETS[name], **kwargs})
+
+    def feature_sizes(self, counts, generator):
+        """
+        Sizes of the features of every image, Torch tensor of shape (bs, 1).
+        """
+        if self.volume_fraction is None:
+            return sample_range(self.feature_size, (len(counts), 1), generator, integer=True)
+        fraction = sample_range(self.volume_fraction, (len(counts), 1), generator)
+        if self.kind == 'lines':
+            sizes = fraction * self.size / counts.unsqueeze(1)
+        else:
+            # a square of half side s covers 4 s^2 pixels and a circle of radius s pi s^2, size for their average
+            sizes = torch.sqrt(fraction * self.size**2 / counts.unsqueeze(1) / ((4 + math.pi) / 2))
+        return sizes.round().long().clamp(min=1)
+
+    def __call__(self, batch_size, generator=None):
+        """
+        Returns: images, float32 Torch tensor of shape (bs, 1, size, size) of zeros (features) and ones,
+        and labels, int64 Torch tensor of shape (bs,)
+        """
+        labels = self.labels[torch.randint(len(self.labels), (batch_size,), generator=generator)]
+        counts = sample_range(self.num_features, (batch_size,), generator, integer=True)
+        # (bs, max_features) mask of the features that exist, so the whole batch is drawn at once
+        active = torch.arange(self.max_features).unsqueeze(0) < counts.unsqueeze(1)
+        sizes = self.feature_sizes(counts, generator)
+        coords = torch.arange(self.size)
+        if self.kind == 'lines':
+            starts = (torch.rand((batch_size, self.max_features), generator=generator) * (self.size - sizes + 1).clamp(min=1)).long()
+            inside = (coords >= starts.unsqueeze(-1)) & (coords < (starts + sizes).unsqueeze(-1))
+            profile = (inside & active.unsqueeze(-1)).any(dim=1)
+            vertical = profile.unsqueeze(1).expand(-1, self.size, -1)
+            features = torch.where((labels == 0).view(-1, 1, 1), vertical, vertical.transpose(1, 2))
+        else:
+            sizes = sizes.expand(-1, self.max_features)
+            centers = sizes.unsqueeze(-1) + (torch.rand((batch_size, self.max_features, 2), generator=generator) * (self.size - 2 * sizes).clamp(min=0).unsqueeze(-1)).long()
+            dy = (coords.view(1, 1, -1, 1) - centers[..., 0, None, None]).abs()
+            dx = (coords.view(1, 1, 1, -1) - centers[..., 1, None, None]).abs()
+            radius = sizes[..., None, None]
+            square = (dy < radius) & (dx < radius)
+            circle = dy**2 + dx**2 < radius**2
+            inside = torch.where((labels == 0).view(-1, 1, 1, 1), square, circle)
+            features = (inside & active[..., None, None]).any(dim=1)
+        return (~features).unsqueeze(1).float(), labels
+
+
+class MicrostructureDataset(IterableDataset):
+    def __init__(self, generator, batch_size, num_batches, seed=0):
+        """
+        Yields num_batches (images, labels) batches of generator per epoch. Use it with batch_size=None in the DataLoader.
+
+        generator: MicrostructureGenerator
+        seed: base seed, use different ones for the training and validation sets
+        """
+        self.generator = generator
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """Draws different images every epoch, like DistributedSampler.set_epoch."""
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        # the DataLoader takes a batch from every worker in turn, so striding keeps the batch order
+        for batch_idx in range(worker_id, self.num_batches, num_workers):
+            state = np.random.SeedSequence([self.seed, self.epoch, batch_idx]).generate_state(1)[0]
+            yield self.generator(self.batch_size, torch.Generator().manual_seed(int(state)))
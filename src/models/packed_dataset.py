@@ -0,0 +1,139 @@
+"""
+Pre-decoded, bit-packed cache of the binary image datasets.
+
+LinesDataset and ShapesDataset decode a PNG, resize and threshold every image on every epoch although the
+result is a fixed binary image. build_packed_cache preprocesses them once and writes
+    images.npy  uint8 (N, H, ceil(W / 8)), the thresholded images packed 8 pixels per byte
+    labels.npy  int64 (N,)
+    meta.json   image size and the fingerprint of the source files and preprocessing it was built from
+and PackedDataset memory-maps them, so the DataLoader workers share the page cache and only unpack bits.
+
+load_packed_dataset rebuilds the cache when the labels, the images or the preprocessing change.
+To build it ahead of training (run from the repository root):
+    python src/models/packed_dataset.py lines
+"""
+import os
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from lines_dataset import LinesDataset
+from shapes_dataset import ShapesDataset
+from preprocessing import BatchPreprocess, image_transform
+from utils import check_mkdir
+
+
+class PackedDataset(Dataset):
+    def __init__(self, cache_dir):
+        """
+        Reads a cache written by build_packed_cache.
+
+        cache_dir: directory holding images.npy, labels.npy and meta.json
+        """
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.width = self.meta['width']
+        # opened lazily so every DataLoader worker maps the files itself
+        self.cache_dir = cache_dir
+        self.images = None
+        self.labels = np.load(os.path.join(cache_dir, 'labels.npy'))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        if self.images is None:
+            self.images = np.load(os.path.join(self.cache_dir, 'images.npy'), mmap_mode='r')
+        image = np.unpackbits(self.images[idx], axis=-1, count=self.width)
+        return torch.from_numpy(image).unsqueeze(0).float(), int(self.labels[idx])
+
+
+def source_hash(csv_file, img_dir, preprocess):
+    """
+    sha256 of the labels file, of the name, size and modification time of every image it lists and of the
+    preprocessing parameters. The images are only stat'ed, reading them all would cost about as much as
+    the decoding the caches save.
+    """
+    digest = hashlib.sha256()
+    with open(csv_file, 'rb') as f:
+        digest.update(f.read())
+    for img_name in pd.read_csv(csv_file).iloc[:, 0]:
+        stat = os.stat(os.path.join(img_dir, img_name))
+        digest.update(f"{img_name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    digest.update(repr(preprocess).encode())
+    return digest.hexdigest()
+
+
+def build_packed_cache(dataset, cache_dir, digest, collate_fn=None, batch_size=256, num_workers=4):
+    """
+    Preprocesses every image once and writes the packed cache.
+
+    dataset: Dataset yielding (image, label), collated by collate_fn into binary images of shape (bs, 1, H, W)
+    digest: source_hash of the dataset, stored in meta.json
+    """
+    check_mkdir(cache_dir)
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=collate_fn)
+    height, width = next(iter(DataLoader(dataset, batch_size=1, collate_fn=collate_fn)))[0].shape[-2:]
+    # write to temporary files first so an interrupted build never leaves a cache that looks valid
+    images_path = os.path.join(cache_dir, 'images.tmp.npy')
+    images = np.lib.format.open_memmap(images_path, mode='w+', dtype=np.uint8, shape=(len(dataset), height, (width + 7) // 8))
+    labels = np.empty(len(dataset), dtype=np.int64)
+
+    start = 0
+    for X, y in loader:
+        X = X.squeeze(1).numpy()
+        assert np.isin(X, (0, 1)).all(), "The packed cache only holds binary images"
+        images[start:start + len(X)] = np.packbits(X.astype(np.uint8), axis=-1)
+        labels[start:start + len(X)] = y.numpy()
+        start += len(X)
+    images.flush()
+    del images
+
+    np.save(os.path.join(cache_dir, 'labels.npy'), labels)
+    os.replace(images_path, os.path.join(cache_dir, 'images.npy'))
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+        json.dump({'hash': digest, 'num_images': len(dataset), 'height': int(height), 'width': int(width)}, f)
+
+
+def load_packed_dataset(dataset_class, data_dir, preprocess, cache_name='packed', digest=None):
+    """
+    Returns the PackedDataset of data_dir, (re)building it first if it is missing or stale.
+    Its images are already preprocessed, so it is read with the default collate_fn.
+
+    dataset_class: LinesDataset or ShapesDataset
+    data_dir: dataset directory holding labels.csv and images/
+    preprocess: the BatchPreprocess the images are read with
+    digest: source_hash of data_dir and preprocess, computed here if not given
+    """
+    csv_file, img_dir = os.path.join(data_dir, 'labels.csv'), os.path.join(data_dir, 'images')
+    cache_dir = os.path.join(data_dir, cache_name)
+    digest = digest or source_hash(csv_file, img_dir, preprocess)
+
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f)['hash'] == digest:
+                return PackedDataset(cache_dir)
+    print(f"Building the packed dataset cache in {cache_dir}")
+    build_packed_cache(dataset_class(csv_file, img_dir, image_transform()), cache_dir, digest, collate_fn=preprocess.collate)
+    return PackedDataset(cache_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the bit-packed cache of a dataset.")
+    parser.add_argument('dataset_name', type=str, help="lines, multiple_lines or shapes")
+    args = parser.parse_args()
+
+    data_dir = os.path.join(os.getcwd(), f'data/{args.dataset_name}')
+    dataset_class = ShapesDataset if args.dataset_name == 'shapes' else LinesDataset
+    dataset = load_packed_dataset(dataset_class, data_dir, BatchPreprocess(res_size=224, thr_255=240))
+    print(f"{len(dataset)} images of {dataset.meta['height']}x{dataset.meta['width']} in {os.path.join(data_dir, 'packed')}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# Compares float32 and bfloat16 autocast training of the VAE (see training_utils.model_autocast).
+# Run from the repository root: python src/models/precision_benchmark.py --dataset lines
+# Both runs start from the same weights and see the same batches of the dataset's MicrostructureGenerator
+# preset. It prints the training and inference images/s, the peak memory and how far the bfloat16 losses
+# (total and per term) deviate from the float32 ones: on the first batch, where both runs have the same
+# weights, which is the rounding error itself, and along the loss curves, where the two trajectories
+# also drift apart. Tiny terms such as the KLD early on drift the most, relative to their size.
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+import torch
+
+from resnet_vae import ResNet_VAE
+from microstructure_generator import MicrostructureGenerator, MicrostructureDataset
+from training_utils import MaterialSimilarityLoss, run_model, seed_everything
+from backbone_benchmark import peak_rss_mb
+
+
+LOSS_TERMS = ['mse', 'spst', 'kld', 'overall']
+
+
+def train_run(model_precision, dataset_name, backbone, batch_size, steps, seed, num_threads):
+    """
+    Trains a fresh VAE for steps batches, run in its own process so the peak memory is its own.
+
+    Returns: dict of the loss curves (steps + 1,) of LOSS_TERMS, the training and inference images/s and the peak memory
+    """
+    torch.set_num_threads(num_threads)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    seed_everything(seed)
+    # the weights do not change the cost, random ones spare the download
+    vae = ResNet_VAE(CNN_embed_dim=9, device=device, backbone=backbone, pretrained=False).to(device)
+    if backbone != 'small_vae':
+        vae.resnet.requires_grad_(False)
+    optimizer = torch.optim.Adam([param for param in vae.parameters() if param.requires_grad], lr=1e-3)
+    # the normalization constants of the lines dataset, they only scale the spatial stats loss
+    criterion = MaterialSimilarityLoss(device, -1.9e-09, 0.04, spatial_stat_loss_reduction='sum', normalize_spatial_stat_tensors=True)
+    generator = MicrostructureGenerator.preset(dataset_name)
+    batches = [X for X, _ in MicrostructureDataset(generator, batch_size, steps + 1, seed=seed)]
+
+    curves = {term: [] for term in LOSS_TERMS}
+    vae.train()
+    before = peak_rss_mb()
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    start = None
+    for step, X in enumerate(batches):
+        if step == 1:  # the first batch warms up
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        X = X.to(device)
+        X_reconst, z, mu, logvar = run_model(vae, X, device, model_precision)
+        mse, _, _, spst, kld, loss, _, _ = criterion(X, X_reconst, mu, logvar, 0.15, 0, 0, 0.85, 1, return_autocorrs=False)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        for term, value in zip(LOSS_TERMS, (mse, spst, kld, loss)):
+            curves[term].append(value.item())
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    training = batch_size * steps / (time.perf_counter() - start)
+    peak = (torch.cuda.max_memory_allocated() - base) / 2**20 if device.type == 'cuda' else peak_rss_mb() - before
+
+    vae.eval()
+    with torch.no_grad():
+        run_model(vae, batches[0].to(device), device, model_precision)
+        start = time.perf_counter()
+        for X in batches[1:]:
+            run_model(vae, X.to(device), device, model_precision)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        inference = batch_size * steps / (time.perf_counter() - start)
+
+    return {'curves': {term: np.array(values) for term, values in curves.items()}, 'training img/s': training, 'inference img/s': inference, 'peak MB': peak}
+
+
+def curve_deviation(reference, other):
+    """
+    Returns: the mean and max relative deviation of the loss curve other from reference
+    """
+    deviation = np.abs(other - reference) / np.maximum(np.abs(reference), 1e-12)
+    return deviation.mean(), deviation.max()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the speed, memory and loss curves of float32 and bfloat16 autocast training.")
+    parser.add_argument('--dataset', type=str, nargs='*', default=['lines', 'shapes'], help="MicrostructureGenerator presets.")
+    parser.add_argument('--backbone', type=str, default='resnet152', help="Encoder backbone, see backbones.py.")
+    parser.add_argument('--bs', type=int, default=16, help="Batch size.")
+    parser.add_argument('--steps', type=int, default=20, help="Number of timed training steps.")
+    parser.add_argument('--seed', type=int, default=110, help="Seed of the weights and of the batches.")
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(), help="Number of CPU threads.")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    for dataset_name in args.dataset:
+        results = {}
+        for model_precision in ['float32', 'bfloat16']:
+            with context.Pool(1) as pool:
+                results[model_precision] = pool.apply(train_run, (model_precision, dataset_name, args.backbone, args.bs, args.steps, args.seed, args.threads))
+        reference, bf16 = results['float32'], results['bfloat16']
+        print(f"{dataset_name}, {args.backbone}, bs={args.bs}, {args.steps} steps")
+        for model_precision, result in results.items():
+            print(f"  {model_precision}: training {result['training img/s']:.2f} img/s, inference {result['inference img/s']:.2f} img/s, "
+                  f"training peak {result['peak MB']:.0f} MB, final loss {result['curves']['overall'][-1]:.4g}")
+        print(f"  bfloat16 speedup: training {bf16['training img/s'] / reference['training img/s']:.2f}x, inference {bf16['inference img/s'] / reference['inference img/s']:.2f}x")
+        for term in LOSS_TERMS:
+            first, _ = curve_deviation(reference['curves'][term][:1], bf16['curves'][term][:1])
+            mean, worst = curve_deviation(reference['curves'][term][1:], bf16['curves'][term][1:])
+            print(f"  {term} loss relative deviation: first batch {first:.2e}, curve mean {mean:.2e}, max {worst:.2e}")
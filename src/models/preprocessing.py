@@ -0,0 +1,79 @@
+"""
+The image preprocessing shared by the training and evaluation scripts.
+
+The datasets used to run transforms.Compose([ToTensor, Normalize, Resize, ThresholdTransform]) on every
+sample inside the DataLoader workers. Instead they now only convert the PIL images to uint8 tensors
+(image_transform) and BatchPreprocess does the normalize / resize / threshold on the whole batch, as the
+collate_fn of the DataLoader:
+
+    dataset = LinesDataset(csv_file, img_dir, image_transform())
+    preprocess = BatchPreprocess(res_size=224, thr_255=240)
+    loader = DataLoader(dataset, batch_size=32, collate_fn=preprocess.collate)
+
+The output is identical to the per-sample transform, which is still available as sample_transform.
+"""
+import torch
+import torch.nn.functional as F
+from torch.utils.data import default_collate
+from torchvision import transforms
+
+from utils import ThresholdTransform
+
+
+def image_transform():
+    """Per-sample part of the pipeline: PIL image to a uint8 tensor of shape (C, H, W)."""
+    return transforms.PILToTensor()
+
+
+def sample_transform(res_size=224, thr_255=240):
+    """The equivalent per-sample transform, for code that reads single images."""
+    return transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize((0.5,), (0.5,)),
+        transforms.Resize([res_size, res_size], antialias=True),
+        ThresholdTransform(thr_255=thr_255),
+    ])
+
+
+class BatchPreprocess(object):
+    def __init__(self, res_size=224, thr_255=240):
+        """
+        Normalizes to [-1, 1], resizes (bilinear, antialiased) to res_size x res_size and thresholds
+        a batch of uint8 images, like sample_transform does for a single image.
+
+        res_size: edge length of the output images
+        thr_255: threshold on the [0..255] gray level, applied after the normalization as ThresholdTransform does
+        """
+        self.res_size = res_size
+        self.threshold = ThresholdTransform(thr_255=thr_255)
+
+    def __call__(self, imgs):
+        """
+        imgs: uint8 (or bool) Torch tensor of shape (bs, C, H, W)
+
+        Returns: float32 Torch tensor of shape (bs, C, res_size, res_size) of zeros and ones
+        """
+        if imgs.dtype == torch.bool:
+            # ToTensor maps mode '1' images to 0 / 1
+            imgs = imgs.to(torch.uint8) * 255
+        # same operations, in the same order, as ToTensor and Normalize
+        x = imgs.float().div(255)
+        x = x.sub_(0.5).div_(0.5)
+        if tuple(x.shape[-2:]) != (self.res_size, self.res_size):
+            x = F.interpolate(x, size=[self.res_size, self.res_size], mode='bilinear', align_corners=False, antialias=True)
+        return self.threshold(x)
+
+    def collate(self, samples):
+        """
+        collate_fn for datasets yielding (uint8 image, label, ...): preprocesses the stacked images.
+        """
+        images = [sample[0] for sample in samples]
+        batch = default_collate([sample[1:] for sample in samples])
+        if all(image.shape == images[0].shape for image in images):
+            images = self(torch.stack(images, dim=0))
+        else:
+            images = torch.cat([self(image.unsqueeze(0)) for image in images], dim=0)
+        return (images, *batch)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(res_size={self.res_size}, {self.threshold!r})"
@@ -1,12 +1,12 @@
 import numpy as np
 
 import torch
-import torchvision.models as models
 import torch.nn as nn
 from torch.autograd import Variable
 import torch.nn.functional as F
 
 from utils import Normalization
+from backbones import build_backbone
 
 def conv2D_output_size(img_size, padding, kernel_size, stride):
     # compute output shape of conv2D
@@ -23,7 +23,11 @@ def convtrans2D_output_size(img_size, padding, kernel_size, stride):
 
 ## ---------------------- ResNet VAE ---------------------- ##
 class ResNet_VAE(nn.Module):
-    def __init__(self, fc_hidden1=1024, fc_hidden2=1024, drop_p=0.2, CNN_embed_dim=256, device=None):
+    def __init__(self, fc_hidden1=1024, fc_hidden2=1024, drop_p=0.2, CNN_embed_dim=256, device=None, backbone='resnet152', backbone_kwargs=None, pretrained=True):
+        """
+        backbone: name of the encoder backbone in backbones.BACKBONES, with its options backbone_kwargs
+        pretrained: load the ImageNet weights of the backbone
+        """
         super(ResNet_VAE, self).__init__()
 
         self.fc_hidden1, self.fc_hidden2, self.CNN_embed_dim = fc_hidden1, fc_hidden2, CNN_embed_dim
@@ -43,11 +47,13 @@ class ResNet_VAE(nn.Module):
                                        self.cnn_normalization_std,
                                        device)
 
-        # encoding components
-        resnet = models.resnet152(weights="ResNet152_Weights.DEFAULT")
-        modules = list(resnet.children())[:-1]      # delete the last fc layer.
-        self.resnet = nn.Sequential(*modules)
-        self.fc1 = nn.Linear(resnet.fc.in_features, self.fc_hidden1)
+        # encoding components, kept under the name resnet whatever the backbone so checkpoints keep their keys
+        spec = build_backbone(backbone, pretrained=pretrained, **(backbone_kwargs or {}))
+        self.backbone_name = backbone
+        self.backbone_in_channels = spec.in_channels
+        self.backbone_pretrained = spec.pretrained
+        self.resnet = spec.module
+        self.fc1 = nn.Linear(spec.out_features, self.fc_hidden1)
         self.bn1 = nn.BatchNorm1d(self.fc_hidden1, momentum=0.01)
         self.fc2 = nn.Linear(self.fc_hidden1, self.fc_hidden2)
         self.bn2 = nn.BatchNorm1d(self.fc_hidden2, momentum=0.01)
@@ -86,27 +92,66 @@ class ResNet_VAE(nn.Module):
                                padding=self.pd2),
             nn.BatchNorm2d(3, momentum=0.01),
         )
-        self.expand_channels = nn.Conv2d(1, 3, kernel_size=1)
-
-    def encode(self, x):
-        #print(x.shape)
-        x = self.expand_channels(x)
-        x = self.normalize(x)
+        # single channel backbones read the images as they are
+        self.expand_channels = nn.Conv2d(1, 3, kernel_size=1) if self.backbone_in_channels == 3 else nn.Identity()
+        self.backbone_frozen = False
+
+    def freeze_backbone(self):
+        """
+        Freezes expand_channels and resnet and keeps them in eval mode (BatchNorm running statistics) even when
+        the model trains, so the backbone features only depend on the input image. The backbone feature cache
+        requires it. Note that expand_channels is then not trained either, unlike with resnet.requires_grad_(False)
+        alone, where model.train() also puts the resnet BatchNorms in batch statistics mode.
+        Only a pretrained backbone can be frozen, one trained from scratch would keep its random weights.
+        """
+        if not self.backbone_pretrained:
+            raise ValueError("Only a pretrained backbone can be frozen, this one is trained from scratch (small_vae or pretrained=False)")
+        self.backbone_frozen = True
+        self.expand_channels.requires_grad_(False)
+        self.resnet.requires_grad_(False)
+        return self.train(self.training)
+
+    def train(self, mode=True):
+        super(ResNet_VAE, self).train(mode)
+        if self.backbone_frozen:
+            self.expand_channels.eval()
+            self.resnet.eval()
+        return self
+
+    def backbone_features(self, x):
+        """
+        x: Torch tensor of shape (bs, 1, 224, 224)
+
+        Returns: the flattened backbone features, Torch tensor of shape (bs, fc1.in_features), 2048 for ResNet-152
+        """
+        if self.backbone_in_channels == 3:
+            x = self.expand_channels(x)
+            x = self.normalize(x)
         x = self.resnet(x)  # ResNet
-        x = x.view(x.size(0), -1)  # flatten output of conv
+        return x.view(x.size(0), -1)  # flatten output of conv
+
+    def encode(self, x, features=None):
+        # features: precomputed backbone_features(x), see feature_cache.py
+        if features is None:
+            features = self.backbone_features(x)
+        x = features
 
         # FC layers
         x = self.bn1(self.fc1(x))
         x = self.relu(x)
         x = self.bn2(self.fc2(x))
         x = self.relu(x)
-        mu, logvar = self.fc3_mu(x), self.fc3_logvar(x)
+        # the latent heads stay in float32 under bfloat16 autocast, the KLD and the sampling depend on them
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            x = x.float()
+            mu, logvar = self.fc3_mu(x), self.fc3_logvar(x)
         return mu, logvar
 
     def reparameterize(self, mu, logvar):
         if self.training:
             std = logvar.mul(0.5).exp_()
-            eps = Variable(std.data.new(std.size()).normal_())
+            # randn_like rather than normal_ on .data, which vmap (see ensemble.py) cannot batch
+            eps = torch.randn_like(std)
             return eps.mul(std).add_(mu)
         else:
             return mu
@@ -122,8 +167,8 @@ class ResNet_VAE(nn.Module):
         x = self.sigmoid(x) # output element of [0, 1]
         return x
 
-    def forward(self, x):
-        mu, logvar = self.encode(x)
+    def forward(self, x, features=None):
+        mu, logvar = self.encode(x, features)
         z = self.reparameterize(mu, logvar)
         x_reconst = self.decode(z)
 
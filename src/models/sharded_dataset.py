@@ -0,0 +1,205 @@
+"""
+Sharded container format for large binary microstructure datasets.
+
+A dataset directory of loose PNGs plus labels.csv is converted once into a few large shard files:
+    shard-00000.bin, shard-00001.bin, ...  fixed-size records: the preprocessed binary image packed 8 pixels
+                                           per byte followed by its int64 label
+    index.json                             record layout and the number of records of every shard
+Since the records have a fixed size, record i of a shard starts at byte i * record_size and the index
+only needs the shard sizes.
+
+ShardedDataset streams the shards back: shards are shuffled every epoch and split across the DataLoader
+workers. A worker reads each of its shards with one sequential read, shuffles its records and unpacks them by chunks.
+
+Run from the repository root:
+    python src/models/sharded_dataset.py write lines                 # data/lines -> data/lines/shards
+    python src/models/sharded_dataset.py read lines --num_workers 4  # report the read throughput
+"""
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+
+from lines_dataset import LinesDataset
+from shapes_dataset import ShapesDataset
+from preprocessing import BatchPreprocess, image_transform
+from utils import check_mkdir
+
+
+def record_dtype(height, width):
+    return np.dtype([('image', np.uint8, (height, (width + 7) // 8)), ('label', '<i8')])
+
+
+def write_shards(dataset, out_dir, records_per_shard=4096, collate_fn=None, batch_size=256, num_workers=4):
+    """
+    Writes every (image, label) of dataset into shards of records_per_shard records.
+
+    dataset: Dataset yielding (image, label), collated by collate_fn into binary images of shape (bs, 1, H, W)
+
+    Returns: the index, also saved as index.json
+    """
+    check_mkdir(out_dir)
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=collate_fn)
+    shards, shard_file, dtype = [], None, None
+    start, num_bytes = time.perf_counter(), 0
+    for X, y in loader:
+        X = X.squeeze(1).numpy()
+        assert np.isin(X, (0, 1)).all(), "Shards only hold binary images"
+        if dtype is None:
+            height, width = X.shape[-2:]
+            dtype = record_dtype(height, width)
+        records = np.empty(len(X), dtype=dtype)
+        records['image'] = np.packbits(X.astype(np.uint8), axis=-1)
+        records['label'] = y.numpy()
+
+        while len(records):
+            if shard_file is None:
+                shards.append({'file': f'shard-{len(shards):05d}.bin', 'num_records': 0})
+                shard_file = open(os.path.join(out_dir, shards[-1]['file']), 'wb')
+            count = min(len(records), records_per_shard - shards[-1]['num_records'])
+            records[:count].tofile(shard_file)
+            num_bytes += records[:count].nbytes
+            shards[-1]['num_records'] += count
+            records = records[count:]
+            if shards[-1]['num_records'] == records_per_shard:
+                shard_file.close()
+                shard_file = None
+    if shard_file is not None:
+        shard_file.close()
+
+    index = {'height': int(height), 'width': int(width), 'record_size': dtype.itemsize,
+             'num_records': sum(shard['num_records'] for shard in shards), 'shards': shards}
+    # written last, so a directory without index.json is an unfinished conversion
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+    elapsed = time.perf_counter() - start
+    print(f"Wrote {index['num_records']} records in {len(shards)} shards to {out_dir} ({num_bytes / 2**20 / elapsed:.1f} MB/s)")
+    return index
+
+
+def split_shards(root, fraction=0.7, seed=0):
+    """
+    Splits the shards of root in two, e.g. for training and validation, neither of them empty. A dataset
+    that fits in one shard is split by record instead.
+
+    Returns: two lists of shard selections for ShardedDataset, file names or, for a single shard,
+    {'file', 'records'} dicts of the indices of its records
+    """
+    with open(os.path.join(root, 'index.json')) as f:
+        shards = json.load(f)['shards']
+    rng = np.random.default_rng(seed)
+    if len(shards) == 1:
+        num_records = shards[0]['num_records']
+        if num_records < 2:
+            raise ValueError(f"{root} holds a single record, which cannot be split in two")
+        order = rng.permutation(num_records)
+        num_first = min(max(1, int(round(num_records * fraction))), num_records - 1)
+        return ([{'file': shards[0]['file'], 'records': sorted(order[:num_first].tolist())}],
+                [{'file': shards[0]['file'], 'records': sorted(order[num_first:].tolist())}])
+    order = rng.permutation(len(shards))
+    num_first = min(max(1, int(round(len(shards) * fraction))), len(shards) - 1)
+    return [shards[i]['file'] for i in order[:num_first]], [shards[i]['file'] for i in order[num_first:]]
+
+
+class ShardedDataset(IterableDataset):
+    def __init__(self, root, shards=None, shuffle=True, seed=0, chunk_records=256):
+        """
+        Streams the (image, label) records of the shards written by write_shards.
+
+        root: directory holding index.json and the shards
+        shards: the shards to read (see split_shards), as file names or {'file', 'records'} dicts of a subset
+        of their records, all of them if None
+        shuffle: shuffle the shard order and the records within every shard, differently every epoch
+        chunk_records: number of records unpacked at once
+        """
+        with open(os.path.join(root, 'index.json')) as f:
+            self.index = json.load(f)
+        self.root = root
+        if shards is None:
+            shards = [shard['file'] for shard in self.index['shards']]
+        # file name -> indices of the records to read, None for all of them
+        selected = {shard: None for shard in shards if isinstance(shard, str)}
+        selected.update({shard['file']: shard['records'] for shard in shards if not isinstance(shard, str)})
+        self.shards = [dict(shard, records=selected[shard['file']]) for shard in self.index['shards'] if shard['file'] in selected]
+        self.dtype = record_dtype(self.index['height'], self.index['width'])
+        assert self.dtype.itemsize == self.index['record_size'], "Shard record layout does not match the index"
+        self.shuffle = shuffle
+        self.seed = seed
+        self.chunk_records = chunk_records
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return sum(shard['num_records'] if shard['records'] is None else len(shard['records']) for shard in self.shards)
+
+    def worker_shards(self):
+        """Indices of the shards of the current DataLoader worker: every num_workers-th shard of the epoch's shard order."""
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        order = np.arange(len(self.shards))
+        if self.shuffle:
+            order = np.random.default_rng([self.seed, self.epoch]).permutation(len(self.shards))
+        return order[worker_id::num_workers]
+
+    def __iter__(self):
+        width = self.index['width']
+        for shard_idx in self.worker_shards():
+            shard = self.shards[shard_idx]
+            path = os.path.join(self.root, shard['file'])
+            records = np.fromfile(path, dtype=self.dtype, count=shard['num_records'])
+            if shard['records'] is not None:
+                records = records[shard['records']]
+            if self.shuffle:
+                rng = np.random.default_rng([self.seed, self.epoch, shard_idx])
+                records = records[rng.permutation(len(records))]
+            for start in range(0, len(records), self.chunk_records):
+                chunk = records[start:start + self.chunk_records]
+                images = torch.from_numpy(np.unpackbits(chunk['image'], axis=-1, count=width)).unsqueeze(1).float()
+                labels = chunk['label']
+                for image, label in zip(images, labels):
+                    yield image, int(label)
+
+
+def read_throughput(root, batch_size=32, num_workers=4, epochs=1):
+    """
+    Iterates over the whole dataset with a DataLoader and prints the read throughput.
+    """
+    dataset = ShardedDataset(root)
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+    for epoch in range(epochs):
+        dataset.set_epoch(epoch)
+        start, num_records = time.perf_counter(), 0
+        for X, _ in loader:
+            num_records += len(X)
+        elapsed = time.perf_counter() - start
+        mb = num_records * dataset.index['record_size'] / 2**20
+        print(f"epoch {epoch}: {num_records} records in {elapsed:.2f} s, {num_records / elapsed:.0f} images/s, {mb / elapsed:.1f} MB/s of shards")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a dataset to shards, or measure the read throughput of its shards.")
+    parser.add_argument('mode', type=str, choices=['write', 'read'])
+    parser.add_argument('dataset_name', type=str, help="lines, multiple_lines or shapes")
+    parser.add_argument('--records_per_shard', type=int, default=4096, help="Number of images per shard.")
+    parser.add_argument('--bs', type=int, default=32, help="Batch size of the read benchmark.")
+    parser.add_argument('--num_workers', type=int, default=4, help="DataLoader workers of the read benchmark.")
+    args = parser.parse_args()
+
+    data_dir = os.path.join(os.getcwd(), f'data/{args.dataset_name}')
+    shard_dir = os.path.join(data_dir, 'shards')
+    if args.mode == 'write':
+        dataset_class = ShapesDataset if args.dataset_name == 'shapes' else LinesDataset
+        dataset = dataset_class(os.path.join(data_dir, 'labels.csv'), os.path.join(data_dir, 'images'), image_transform())
+        write_shards(dataset, shard_dir, args.records_per_shard, collate_fn=BatchPreprocess(res_size=224, thr_255=240).collate)
+    else:
+        read_throughput(shard_dir, args.bs, args.num_workers)
+
+
+if __name__ == "__main__":
+    main()
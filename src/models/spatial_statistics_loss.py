@@ -1,69 +1,355 @@
+from collections import OrderedDict
+
+import math
+
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 class TwoPointSpatialStatsLoss(nn.Module):
-    def __init__(self, device, min_pixel_value, max_pixel_value, H=2, filtered=False, mask_rad=20, input_size=224, normalize_spatial_stats_tensors=False, reduction='mean', soft_equality_eps=0.25):
+    # Cost model for the lag window algorithm selection, in multiply-adds per image. The direct
+    # correlation costs one pass over the image per lag (+ a per-lag call overhead), the FFT
+    # FFT_COST_FACTOR * H*W*log2(H*W). Calibrated on a single-threaded CPU; rerun
+    # spatial_stats_benchmark.py to print the crossover points of another host. The direct
+    # correlation loops over the lags (a grouped conv2d was slower still, unfold copies the image
+    # once per lag), so it is only offered up to MAX_DIRECT_LAG_RADIUS, the FFT is faster beyond.
+    FFT_COST_FACTOR = 0.75
+    DIRECT_LAG_OVERHEAD = 16384
+    MAX_DIRECT_LAG_RADIUS = 2
+
+    def __init__(self, device, min_pixel_value, max_pixel_value, H=2, filtered=False, mask_rad=20, input_size=224, normalize_spatial_stats_tensors=False, reduction='mean', soft_equality_eps=0.25, precision='float64', autocorr_cache=None, loss_domain='spatial', lag_radius=None, lag_algorithm='auto', phase_pair_weights=None, descriptor=None, fused=False):
+        """
+        precision (str): 'float64' or 'float32', the dtype the FFTs are computed in.
+        float32 is roughly twice as fast and is accurate to ~1e-6 relative to float64.
+        autocorr_cache (AutocorrelationCache): Optional cache of the autocorrelations of the
+        dataset images, used when forward is given their dataset indices.
+        loss_domain (str): 'spatial' computes the MSE between the real-space autocorrelations.
+        'frequency' computes the same MSE from the half power spectra (Parseval), skipping the
+        inverse FFT and the roll; the autocorrelations are then only computed when asked for.
+        lag_radius (int): If given, only the lags with |dy|, |dx| <= lag_radius are computed and compared, so the
+        autocorrelations are (2*lag_radius+1, 2*lag_radius+1) windows around the zero lag instead of full maps.
+        lag_algorithm (str): 'direct', 'fft', or 'auto' to pick the cheaper one for the batch (see select_lag_algorithm).
+        'direct' is only allowed up to lag_radius MAX_DIRECT_LAG_RADIUS.
+        phase_pair_weights (list): If given, an H x H nested list of weights w[iA][iB]. The loss is then the weighted sum
+        of the MSEs of every (iA, iB) auto/cross correlation instead of the phase 0 autocorrelation MSE. Only the upper
+        triangle is computed; C_BA(r) = C_AB(-r) has the same MSE, so w[iB][iA] is added to w[iA][iB].
+        descriptor (nn.Module): If given, maps the autocorrelations (..., H, W) to reduced-order descriptors (..., d)
+        (see spatial_stats_descriptors) and the loss compares the descriptors instead of the full maps.
+        fused (bool): Compute the loss with TwoPointAutocorrMSE, a fused autograd function with an analytic backward that
+        only saves the two half spectra, instead of letting autograd record the FFT chain. The returned autocorrelations
+        are then computed without a graph. Only for the plain full-map loss (no mask, lag window, phase pairs, descriptor or cache).
+        """
         super(TwoPointSpatialStatsLoss, self).__init__()
+        assert precision in ['float64', 'float32'], "precision should be 'float64' or 'float32'"
+        assert loss_domain in ['spatial', 'frequency'], "loss_domain should be 'spatial' or 'frequency'"
+        assert not (filtered and loss_domain == 'frequency'), "The Gaussian mask of the filtered loss has no frequency domain equivalent here"
+        assert lag_algorithm in ['auto', 'direct', 'fft'], "lag_algorithm should be 'auto', 'direct' or 'fft'"
+        assert lag_radius is None or loss_domain == 'spatial', "The lag window is only supported in the spatial loss domain"
+        assert not (lag_algorithm == 'direct' and lag_radius is not None and lag_radius > self.MAX_DIRECT_LAG_RADIUS), \
+            f"lag_algorithm 'direct' is slower than 'fft' beyond lag_radius {self.MAX_DIRECT_LAG_RADIUS}"
+        assert phase_pair_weights is None or loss_domain == 'spatial', "The phase pair loss is only supported in the spatial loss domain"
+        assert descriptor is None or loss_domain == 'spatial', "Descriptors are only supported in the spatial loss domain"
+        self.descriptor = descriptor
+        assert not fused or (not filtered and lag_radius is None and phase_pair_weights is None and descriptor is None and autocorr_cache is None), \
+            "The fused loss only supports the plain full-map autocorrelation MSE"
+        self.fused = fused
+        self.lag_radius = lag_radius
+        self.lag_algorithm = lag_algorithm
+        self.loss_domain = loss_domain
         self.H = H
+        self.dtype = getattr(torch, precision)
+        self.phase_pairs = [(iA, iB) for iA in range(H) for iB in range(iA, H)]  # upper triangle, (0, 0) first
+        self.phase_pair_weights = None
+        if phase_pair_weights is not None:
+            assert len(phase_pair_weights) == H and all(len(row) == H for row in phase_pair_weights), f"phase_pair_weights should be a {H} x {H} matrix"
+            weights = [phase_pair_weights[iA][iB] + (phase_pair_weights[iB][iA] if iA != iB else 0) for iA, iB in self.phase_pairs]
+            self.phase_pair_weights = torch.tensor(weights, dtype=self.dtype, device=device)
         self.mse_loss = nn.MSELoss(reduction=reduction)
         self.filtered = filtered
         if filtered:
             self.mask = self.create_mask(mask_rad, input_size, device)
+            if lag_radius is not None:
+                self.mask = self.crop_lag_window(self.mask)
         self.normalize_spst_tensors = normalize_spatial_stats_tensors
         self.soft_equality_eps = soft_equality_eps
         self.min_fft_pixel_value = min_pixel_value
         self.max_fft_pixel_value = max_pixel_value
+        self.autocorr_cache = autocorr_cache
 
-    def forward(self, input, target):
+    def forward(self, input, target, input_idx=None, return_autocorrs=True):
         """
         Computes the loss between input and target tensors using two-point autocorrelation.
 
         input, target: Torch tensors of shape (bs, 1, H, W)
+        input_idx: Optional dataset indices of the input images, (bs,). When given together with
+        an autocorr_cache, the input autocorrelations are read from the cache and only the target is FFT'd.
+        return_autocorrs: Whether to return the images next to their autocorrelations. Only saves work
+        in the frequency loss domain, where None is returned instead.
 
         Returns:
         nn.Loss, torch tensor (bs, 1, H, W*2)
+        With a lag_radius the lag windows alone are returned, torch tensors (bs, 1, 2*lag_radius+1, 2*lag_radius+1).
+        With phase_pair_weights the phase 0 autocorrelations are the ones returned.
         """
-        input_autocorr = self.calculate_two_point_autocorr_pytorch(input)
-        target_autocorr = self.calculate_two_point_autocorr_pytorch(target)
+        if self.loss_domain == 'frequency':
+            return self.frequency_domain_forward(input, target, input_idx, return_autocorrs)
+        if self.fused:
+            return self.fused_forward(input, target, return_autocorrs)
+
+        if self.autocorr_cache is not None and input_idx is not None:
+            input_autocorr = self.cached_statistic(input, input_idx)
+        else:
+            input_autocorr = self.calculate_spatial_autocorr(input)
+        target_autocorr = self.calculate_spatial_autocorr(target)
 
         if self.filtered:
             input_autocorr = self.mask_tensor(input_autocorr)
             target_autocorr = self.mask_tensor(target_autocorr)
-        diff = self.mse_loss(input_autocorr, target_autocorr)
+        if self.descriptor is not None:
+            input_stats, target_stats = self.descriptor(input_autocorr), self.descriptor(target_autocorr)
+        else:
+            input_stats, target_stats = input_autocorr, target_autocorr
+        if self.phase_pair_weights is not None:
+            diff = self.phase_pair_mse(input_stats, target_stats)
+            input_autocorr, target_autocorr = input_autocorr[:, :1], target_autocorr[:, :1]
+        else:
+            diff = self.mse_loss(input_stats, target_stats)
+        if self.lag_radius is not None:
+            return diff, input_autocorr, target_autocorr
         input_and_input_autocorr = torch.cat([input, input_autocorr], axis=3)
         target_and_target_autocorr = torch.cat([target, target_autocorr], axis=3)
         return diff, input_and_input_autocorr, target_and_target_autocorr
 
+    def frequency_domain_forward(self, input, target, input_idx=None, return_autocorrs=True):
+        """
+        Same as forward, but the loss is computed on the half power spectra from rfft2.
+        """
+        size = target.shape[-2:]
+        if self.autocorr_cache is not None and input_idx is not None:
+            input_spectrum = self.cached_statistic(input, input_idx)
+        else:
+            input_spectrum = self.calculate_power_spectrum(self.generate_torch_microstructure_function(input))
+        target_spectrum = self.calculate_power_spectrum(self.generate_torch_microstructure_function(target))
+
+        diff = self.power_spectrum_mse(input_spectrum, target_spectrum, size)
+        if not return_autocorrs:
+            return diff, None, None
+
+        input_autocorr = self.fft_shift(self.autocorr_from_power_spectrum(input_spectrum.detach(), size))
+        target_autocorr = self.fft_shift(self.autocorr_from_power_spectrum(target_spectrum.detach(), size))
+        input_and_input_autocorr = torch.cat([input, input_autocorr], axis=3)
+        target_and_target_autocorr = torch.cat([target.detach(), target_autocorr], axis=3)
+        return diff, input_and_input_autocorr, target_and_target_autocorr
+
+    def fused_forward(self, input, target, return_autocorrs=True):
+        """
+        Same as forward, but the loss goes through TwoPointAutocorrMSE.
+        """
+        diff = TwoPointAutocorrMSE.apply(input, target, self.soft_equality_eps, self.dtype, self.normalization_range(), self.mse_loss.reduction)
+        if not return_autocorrs:
+            return diff, None, None
+
+        with torch.no_grad():
+            input_autocorr = self.calculate_two_point_autocorr_pytorch(input)
+            target_autocorr = self.calculate_two_point_autocorr_pytorch(target)
+        input_and_input_autocorr = torch.cat([input.detach(), input_autocorr], axis=3)
+        target_and_target_autocorr = torch.cat([target.detach(), target_autocorr], axis=3)
+        return diff, input_and_input_autocorr, target_and_target_autocorr
+
+    def normalization_range(self, eps=1e-6):
+        """The factor normalize divides the autocorrelations by (1 without normalization)."""
+        if self.normalize_spst_tensors:
+            return self.max_fft_pixel_value - self.min_fft_pixel_value + eps
+        return 1.0
+
+    @staticmethod
+    def half_spectrum_weights(num_cols, width, dtype, device):
+        """
+        Weights of the rfft2 half spectrum columns in a sum over the full spectrum: 2 for every column
+        standing for two conjugate-symmetric ones, 1 for DC (and Nyquist, for even widths).
+        """
+        weights = torch.full((num_cols,), 2.0, dtype=dtype, device=device)
+        weights[0] = 1
+        if width % 2 == 0:
+            weights[-1] = 1
+        return weights
+
+    def power_spectrum_mse(self, input_spectrum, target_spectrum, size):
+        """
+        MSE between the autocorrelations of two batches of half power spectra, without the inverse FFT.
+
+        By Parseval, sum_r (a1(r) - a2(r))^2 = 1/S * sum_k (P1(k) - P2(k))^2 over the full spectrum.
+        The half spectrum from rfft2 holds every column except DC (and Nyquist, for even widths) once
+        for two conjugate-symmetric columns, so those are weighted by 2. The roll does not change the MSE.
+
+        Parameters:
+            input_spectrum, target_spectrum (torch.Tensor): Half power spectra of shape (batch_size, 1, H, W//2+1).
+            size (tuple): (H, W) of the autocorrelations.
+
+        Returns:
+            torch.Tensor: The loss, with the same reduction as self.mse_loss.
+        """
+        height, width = size
+        S = height * width
+        weights = self.half_spectrum_weights(input_spectrum.shape[-1], width, input_spectrum.dtype, input_spectrum.device)
+
+        # normalize is affine, so it only scales the difference
+        loss = ((input_spectrum - target_spectrum)**2 * weights).sum() / S / self.normalization_range()**2
+        if self.mse_loss.reduction == 'mean':
+            loss = loss / (input_spectrum.shape[0] * input_spectrum.shape[1] * S)
+        return loss
+
     def calculate_two_point_autocorr_pytorch(self, imgs):
         """
         Computes the two-point autocorrelation for a batch of microstructure images.
 
+        The whole batch goes through a single soft-equality and a single rfft2/irfft2,
+        with |F|^2 used directly as the power spectrum.
+
         Parameters:
             imgs (torch.Tensor): Batch of microstructure images of shape: (batch_size, 1, H, W)
-            H (int): Number of phases.
 
         Returns:
-            torch.Tensor: Batch of two-point autocorrelation tensors.
+            torch.Tensor: Batch of two-point autocorrelation tensors of shape (batch_size, 1, H, W).
+        """
+        microstructure_functions = self.generate_torch_microstructure_function(imgs)
+        autocorrs = self.calculate_2point_torch_spatialstat(microstructure_functions)
+        shifted_autocorrs = self.fft_shift(autocorrs)
+        return shifted_autocorrs
+
+    def phase_pair_mse(self, input_corrs, target_corrs):
+        """
+        Weighted sum of the MSEs of the phase pair correlations, (bs, len(self.phase_pairs), ...) tensors.
+        """
+        losses = torch.stack([self.mse_loss(input_corrs[:, k], target_corrs[:, k]) for k in range(len(self.phase_pairs))])
+        return (self.phase_pair_weights * losses).sum()
+
+    def calculate_spatial_autocorr(self, imgs):
+        """
+        The autocorrelation compared by the spatial domain loss: the full shifted map, or its lag window.
+        With phase_pair_weights, the upper triangle of the phase pair correlations.
+        """
+        if self.phase_pair_weights is not None:
+            corrs = self.fft_shift(self.calculate_phase_pair_spatialstats(self.generate_torch_microstructure_function(imgs)))
+            return corrs if self.lag_radius is None else self.crop_lag_window(corrs)
+        if self.lag_radius is not None:
+            return self.calculate_lag_window_autocorr(imgs)
+        return self.calculate_two_point_autocorr_pytorch(imgs)
+
+    def calculate_lag_window_autocorr(self, imgs, algorithm=None):
+        """
+        Computes the two-point autocorrelation of a batch of microstructure images for the lags
+        |dy|, |dx| <= self.lag_radius only.
+
+        Parameters:
+            imgs (torch.Tensor): Batch of microstructure images of shape (batch_size, 1, H, W)
+            algorithm (str): 'direct' or 'fft', defaults to self.lag_algorithm.
+
+        Returns:
+            torch.Tensor: Batch of lag windows of shape (batch_size, 1, 2*lag_radius+1, 2*lag_radius+1),
+            centered on the zero lag like the shifted full map.
+        """
+        algorithm = algorithm or self.lag_algorithm
+        if algorithm == 'auto':
+            algorithm = self.select_lag_algorithm(*imgs.shape[-2:], self.lag_radius, batch_size=imgs.shape[0])
+        if algorithm == 'fft':
+            return self.crop_lag_window(self.calculate_two_point_autocorr_pytorch(imgs))
+
+        iA = 0
+        mf = self.generate_torch_microstructure_function(imgs)
+        output = self.direct_lag_window_autocorr(mf[:, iA:iA + 1].to(self.dtype), self.lag_radius)
+        if self.normalize_spst_tensors:
+            output = self.normalize(output)
+        return output
+
+    @classmethod
+    def select_lag_algorithm(cls, height, width, lag_radius, batch_size=1):
+        """
+        Returns 'direct' or 'fft', whichever the cost model says is cheaper for the batch, 'fft'
+        beyond MAX_DIRECT_LAG_RADIUS.
+        """
+        if lag_radius > cls.MAX_DIRECT_LAG_RADIUS:
+            return 'fft'
+        num_lags = ((2 * lag_radius + 1)**2 + 1) // 2  # C(-d) = C(d)
+        direct_cost = num_lags * (batch_size * height * width + cls.DIRECT_LAG_OVERHEAD)
+        fft_cost = cls.FFT_COST_FACTOR * batch_size * height * width * math.log2(height * width)
+        return 'direct' if direct_cost < fft_cost else 'fft'
+
+    @staticmethod
+    def direct_lag_window_autocorr(m, lag_radius):
+        """
+        Periodic autocorrelation of m for the lags |dy|, |dx| <= lag_radius by direct correlation:
+        one shifted multiply-sum per lag, for half of the window since C(-d) = C(d).
+
+        Parameters:
+            m (torch.Tensor): Single phase microstructure function of shape (batch_size, 1, H, W)
+
+        Returns:
+            torch.Tensor: Lag windows of shape (batch_size, 1, 2*lag_radius+1, 2*lag_radius+1)
+        """
+        R = lag_radius
+        bs, _, height, width = m.shape
+        assert 2 * R + 1 <= min(height, width), "Lag window is larger than the image"
+        padded = F.pad(m, (R, R, R, R), mode='circular')
+        lags = [(dy, dx) for dy in range(0, R + 1) for dx in range(-R, R + 1) if dy > 0 or dx >= 0]
+        corrs = torch.stack([(m * padded[..., R + dy:R + dy + height, R + dx:R + dx + width]).sum(dim=(-2, -1)) for dy, dx in lags], dim=-1)
+
+        # mirror the half window into the full one
+        lag_index = {lag: i for i, lag in enumerate(lags)}
+        window_index = [lag_index.get((dy, dx), lag_index.get((-dy, -dx))) for dy in range(-R, R + 1) for dx in range(-R, R + 1)]
+        return corrs[..., window_index].view(bs, 1, 2 * R + 1, 2 * R + 1) / (height * width)
+
+    def crop_lag_window(self, t):
+        """Crops the (2*lag_radius+1)^2 window around the zero lag out of shifted full maps (..., H, W)."""
+        H, W = t.shape[-2:]
+        R = self.lag_radius
+        return t[..., H // 2 - R:H // 2 + R + 1, W // 2 - R:W // 2 + R + 1]
+
+    def calculate_cached_statistic(self, imgs):
+        """
+        The per-image statistic held by self.autocorr_cache: the shifted autocorrelation (or its
+        lag window, or the phase pair correlations) in the spatial loss domain, the half power spectrum
+        in the frequency loss domain.
+        """
+        if self.loss_domain == 'frequency':
+            return self.calculate_power_spectrum(self.generate_torch_microstructure_function(imgs))
+        return self.calculate_spatial_autocorr(imgs)
+
+    def cached_statistic(self, imgs, idx):
+        """
+        Looks up the statistics of dataset images in self.autocorr_cache,
+        computing and inserting only the ones that are missing.
+
+        Parameters:
+            imgs (torch.Tensor): Batch of dataset images of shape (batch_size, 1, H, W).
+            idx (torch.Tensor): Dataset indices of imgs, of shape (batch_size,).
+
+        Returns:
+            torch.Tensor: Batch of statistics as returned by calculate_cached_statistic.
         """
-        microstructure_functions = torch.cat([self.generate_torch_microstructure_function(img).unsqueeze(dim=0) for img in imgs], dim=0) 
-        ffts = torch.cat([self.calculate_2point_torch_spatialstat(mf).unsqueeze(dim=0) for mf in microstructure_functions], dim=0) 
-        shifted_ffts = self.fft_shift(ffts) 
-        return shifted_ffts
+        idx = idx.tolist()
+        autocorrs = self.autocorr_cache.lookup(idx)
+        missing = [i for i, autocorr in enumerate(autocorrs) if autocorr is None]
+        if missing:
+            computed = self.calculate_cached_statistic(imgs[missing]).detach()
+            self.autocorr_cache.insert([idx[i] for i in missing], computed)
+            for j, i in enumerate(missing):
+                autocorrs[i] = computed[j]
+        return torch.stack(autocorrs, dim=0).to(imgs.device)
 
     def generate_torch_microstructure_function(self, micr):
         """
-        Generates a microstructure function tensor for a given microstructure image.
+        Generates the microstructure function for a batch of microstructure images.
 
         Parameters:
-            micr (torch.Tensor): Input microstructure image tensor of shape (1, H, W).
-            H (int): Number of phases.
-            el (int): Edge length of the microstructure.
+            micr (torch.Tensor): Input microstructure images of shape (batch_size, 1, H, W).
 
         Returns:
-            torch.Tensor: Microstructure function Torch tensor of shape (2, H, W)
+            torch.Tensor: Microstructure function Torch tensor of shape (batch_size, self.H, H, W)
         """
-        mf_list = [self.soft_equality(micr, h) for h in range(self.H)] # 0.25 gives a nice smooth curve which will prob. help prevent loss of info.
-        return torch.cat(mf_list, dim=0)
+        phases = torch.arange(self.H, dtype=micr.dtype, device=micr.device).view(1, -1, 1, 1)
+        return self.soft_equality(micr, phases) # 0.25 gives a nice smooth curve which will prob. help prevent loss of info.
 
     def soft_equality(self, x, value):
         """
@@ -71,47 +357,111 @@ class TwoPointSpatialStatsLoss(nn.Module):
 
         Parameters:
             x (torch.Tensor): Input tensor.
-            value (float): Value to compare with.
-            epsilon (float): Smoothing parameter.
+            value (float or torch.Tensor): Value(s) to compare with, broadcast against x.
 
         Returns:
-            torch.Tensor: Tensor of the same shape as x with values close to 1 where x is close to value, and close to 0 elsewhere.
+            torch.Tensor: Tensor of the broadcast shape of x and value with values close to 1 where x is close to value, and close to 0 elsewhere.
         """
         return torch.exp(-(x - value)**2 / (2 * self.soft_equality_eps**2))
 
     def calculate_2point_torch_spatialstat(self, mf):
         """
-        Calculates two-point spatial statistics for the microstructure function tensor.
+        Calculates two-point spatial statistics for a batch of microstructure function tensors.
 
         Parameters:
-            mf (torch.Tensor): Microstructure function tensor of shape (num_phases, edge_len, edge_len).
+            mf (torch.Tensor): Microstructure function tensor of shape (batch_size, num_phases, H, W).
 
         Returns:
-            torch.Tensor: Two-point spatial statistics tensor of shape (1, edge_len, edge_len)
+            torch.Tensor: Two-point spatial statistics tensor of shape (batch_size, 1, H, W)
         """
-        el = mf.shape[-1]
-        iA, iB = 0, 0
-        M = torch.zeros((self.H, el, el), dtype=torch.complex128, device=mf.device)
-        for h in range(self.H):
-            M[h, ...] = torch.fft.fftn(mf[h, ...], dim=[0, 1])
+        return self.autocorr_from_power_spectrum(self.calculate_power_spectrum(mf), mf.shape[-2:])
 
-        S = el**2
-        M1, M2 = M[iA, ...], M[iB, ...]
-        term1 = torch.abs(M1) * torch.exp(-1j * torch.angle(M1))
-        term2 = torch.abs(M2) * torch.exp(1j * torch.angle(M2))
+    def calculate_phase_pair_spatialstats(self, mf):
+        """
+        Calculates the two-point auto/cross correlations of the upper triangle phase pairs self.phase_pairs,
+        from a single rfft2 of every phase.
 
-        FFtmp = term1 * term2 / S
+        Parameters:
+            mf (torch.Tensor): Microstructure function tensor of shape (batch_size, num_phases, H, W).
 
-        output = torch.fft.ifftn(FFtmp, [el, el], [0, 1]).real.unsqueeze(0)
+        Returns:
+            torch.Tensor: Unshifted correlations of shape (batch_size, len(self.phase_pairs), H, W)
+        """
+        height, width = mf.shape[-2:]
+        M = torch.fft.rfft2(mf.to(self.dtype))
+        iA = [pair[0] for pair in self.phase_pairs]
+        iB = [pair[1] for pair in self.phase_pairs]
+        FFtmp = M[:, iA].conj() * M[:, iB] / (height * width)
+        output = torch.fft.irfft2(FFtmp, s=(height, width))
 
         if self.normalize_spst_tensors:
             output = self.normalize(output)
-        
+
         return output
-    
+
+    def calculate_multiphase_correlations(self, imgs):
+        """
+        Computes every phase pair auto/cross correlation of a batch of microstructure images.
+
+        Only the upper triangle is transformed; the lower one is mirrored with C_BA(r) = C_AB(-r).
+
+        Parameters:
+            imgs (torch.Tensor): Batch of microstructure images of shape (batch_size, 1, H, W)
+
+        Returns:
+            torch.Tensor: Shifted correlations of shape (batch_size, num_phases, num_phases, H, W),
+            [:, iA, iB] being the correlation of phase iA with phase iB.
+        """
+        upper = self.calculate_phase_pair_spatialstats(self.generate_torch_microstructure_function(imgs))
+        corrs = [[None] * self.H for _ in range(self.H)]
+        for k, (iA, iB) in enumerate(self.phase_pairs):
+            corrs[iA][iB] = upper[:, k]
+            if iA != iB:
+                # negate the lag of the unshifted map: index r -> -r mod size
+                corrs[iB][iA] = torch.roll(torch.flip(upper[:, k], dims=(-2, -1)), shifts=(1, 1), dims=(-2, -1))
+        corrs = torch.stack([torch.stack(row, dim=1) for row in corrs], dim=1)
+        return self.fft_shift(corrs)
+
+    def calculate_power_spectrum(self, mf):
+        """
+        Calculates the half power spectrum |F|^2 / S of the microstructure function.
+
+        Only the phase used by the autocorrelation (iA = iB = 0) is transformed.
+
+        Parameters:
+            mf (torch.Tensor): Microstructure function tensor of shape (batch_size, num_phases, H, W).
+
+        Returns:
+            torch.Tensor: Power spectrum tensor of shape (batch_size, 1, H, W//2+1)
+        """
+        iA = 0
+        height, width = mf.shape[-2:]
+        M = torch.fft.rfft2(mf[:, iA:iA + 1].to(self.dtype))
+
+        S = height * width
+        return (M.real**2 + M.imag**2) / S
+
+    def autocorr_from_power_spectrum(self, power_spectrum, size):
+        """
+        Inverse transforms a half power spectrum into the (unshifted) autocorrelation.
+
+        Parameters:
+            power_spectrum (torch.Tensor): Power spectrum tensor of shape (batch_size, 1, H, W//2+1).
+            size (tuple): (H, W) of the autocorrelation.
+
+        Returns:
+            torch.Tensor: Two-point spatial statistics tensor of shape (batch_size, 1, H, W)
+        """
+        output = torch.fft.irfft2(power_spectrum, s=tuple(size))
+
+        if self.normalize_spst_tensors:
+            output = self.normalize(output)
+
+        return output
+
     def fft_shift(self, input_autocorr):
             """Performs a circular shift on the input autocorrelation tensor."""
-            _, _, H, W = input_autocorr.shape
+            H, W = input_autocorr.shape[-2:]
             return torch.roll(input_autocorr, shifts=(H // 2, W // 2), dims=(-2, -1))
 
     def normalize(self, tensor, eps=1e-6):
@@ -138,6 +488,121 @@ class TwoPointSpatialStatsLoss(nn.Module):
         return t * self.mask
 
 
+class TwoPointAutocorrMSE(torch.autograd.Function):
+    """
+    Fused phase 0 autocorrelation MSE between two batches of images, with an analytic backward.
+
+    With m = soft_equality(x, 0), M = rfft2(m) and P = |M|^2 / S, the autocorrelation is a = irfft2(P) and
+    the loss L = c / rho^2 * sum_r (a_in(r) - a_tg(r))^2, c being 1 / numel for the mean reduction and rho the
+    normalization range. The forward evaluates it from the spectra (Parseval, see power_spectrum_mse).
+    The gradient of an autocorrelation loss is itself a correlation:
+        dL/dm_in = irfft2(4c / (S rho^2) * (P_in - P_tg) * M_in),   dL/dm_tg = -irfft2(4c / (S rho^2) * (P_in - P_tg) * M_tg)
+    and dm/dx = -m * x / eps^2. Only the inputs and their half spectra are saved for backward.
+    """
+
+    @staticmethod
+    def forward(ctx, input, target, soft_equality_eps, dtype, norm_range, reduction):
+        height, width = input.shape[-2:]
+        S = height * width
+        M_in = torch.fft.rfft2(torch.exp(-input.to(dtype)**2 / (2 * soft_equality_eps**2)))
+        M_tg = torch.fft.rfft2(torch.exp(-target.to(dtype)**2 / (2 * soft_equality_eps**2)))
+        D = (M_in.real**2 + M_in.imag**2 - M_tg.real**2 - M_tg.imag**2) / S
+
+        weights = TwoPointSpatialStatsLoss.half_spectrum_weights(D.shape[-1], width, D.dtype, D.device)
+        c = 1.0 / input.numel() if reduction == 'mean' else 1.0
+        loss = c * (D**2 * weights).sum() / S / norm_range**2
+
+        ctx.save_for_backward(input, target, M_in, M_tg)
+        ctx.soft_equality_eps, ctx.dtype, ctx.coeff = soft_equality_eps, dtype, 4 * c / (S * norm_range**2)
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, target, M_in, M_tg = ctx.saved_tensors
+        eps = ctx.soft_equality_eps
+        size = input.shape[-2:]
+        D = (M_in.real**2 + M_in.imag**2 - M_tg.real**2 - M_tg.imag**2) / (size[0] * size[1])
+        scale = grad_output.to(ctx.dtype) * ctx.coeff
+
+        grad_input = grad_target = None
+        if ctx.needs_input_grad[0]:
+            x = input.to(ctx.dtype)
+            grad_m = torch.fft.irfft2(scale * D * M_in, s=size)
+            grad_input = (grad_m * torch.exp(-x**2 / (2 * eps**2)) * (-x / eps**2)).to(input.dtype)
+        if ctx.needs_input_grad[1]:
+            x = target.to(ctx.dtype)
+            grad_m = -torch.fft.irfft2(scale * D * M_tg, s=size)
+            grad_target = (grad_m * torch.exp(-x**2 / (2 * eps**2)) * (-x / eps**2)).to(target.dtype)
+        return grad_input, grad_target, None, None, None, None
+
+
+class AutocorrelationCache:
+    """
+    Stores the autocorrelations (or, for the frequency domain loss, the power spectra)
+    of dataset images keyed by their dataset index.
+
+    The dataset images are fixed thresholded binary images, so their autocorrelations never
+    change across epochs. Entries are either filled lazily by TwoPointSpatialStatsLoss or
+    computed up front with precompute. Once the cache holds more than max_mb megabytes the
+    least recently used entries are evicted.
+    """
+
+    def __init__(self, max_mb=2048):
+        # max_mb: Memory cap in megabytes (float), None for no cap
+        self.max_bytes = None if max_mb is None else int(max_mb * 1024**2)
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, indices):
+        """
+        indices: list of dataset indices (ints)
+
+        Returns: list of autocorrelations (Torch tensors of shape (1, H, W)), None where not cached
+        """
+        autocorrs = []
+        for idx in indices:
+            autocorr = self.entries.get(idx)
+            if autocorr is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(idx)
+            autocorrs.append(autocorr)
+        return autocorrs
+
+    def insert(self, indices, autocorrs):
+        """
+        indices: list of dataset indices (ints)
+        autocorrs: Torch tensor of shape (len(indices), 1, H, W)
+        """
+        for idx, autocorr in zip(indices, autocorrs):
+            if idx in self.entries:
+                continue
+            # clone so an entry doesn't keep the whole batch it was computed in alive
+            autocorr = autocorr.detach().clone()
+            self.entries[idx] = autocorr
+            self.nbytes += autocorr.element_size() * autocorr.nelement()
+        while self.max_bytes is not None and self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.element_size() * evicted.nelement()
+
+    def precompute(self, data_loader, autocorr_func, device):
+        """
+        Fills the cache up front.
+
+        data_loader: DataLoader yielding (image, label, dataset index) batches, e.g. over an IndexedDataset
+        autocorr_func: function mapping a (bs, 1, H, W) batch to its (bs, 1, H, W) autocorrelations
+        """
+        with torch.no_grad():
+            for X, _, idx in data_loader:
+                self.insert(idx.tolist(), autocorr_func(X.to(device)))
+        print(f"Precomputed {len(self)} autocorrelations ({self.nbytes / 1024**2:.1f} MB).")
+
+
 class TwoPointAutocorrelation:
     """
     Warning: 
@@ -146,62 +611,97 @@ class TwoPointAutocorrelation:
     - The reason why backprop won't work here is because of the absense of soft inequality,
     however, it can be used to calulate the exact spatial statistics of microstructure images. 
 
-    - To be used to calculate autocorrelation for single binary image inputs.
+    - forward calculates the autocorrelation of a single image, batch_forward the auto and cross
+    correlations of a whole batch (or dataset) of images in chunks.
     """
 
-    def __init__(self, H=2):
+    def __init__(self, H=2, max_chunk_mb=256):
         # H: Number of phases (int)
+        # max_chunk_mb: Memory budget in megabytes for the intermediate tensors of one chunk of images (float)
         self.H = H
-    
-    def calculate_microstructure_function(self, img):
+        self.max_chunk_mb = max_chunk_mb
+
+    def calculate_microstructure_function(self, imgs, phases):
         """
         Inputs:
-        img: image (Torch tensor of shape (1, H, W))
+        imgs: images (Torch tensor of shape (N, 1, H, W)) of any dtype
+        phases: list of phases (ints)
 
-        Returns: Microstructure function of image (Torch tensor of shape (self.H, H, W))
+        Returns: Microstructure function of the images for the given phases (float32 Torch tensor of shape (N, len(phases), H, W))
         """
-        el = img.shape[-1]
-        mf = torch.zeros((self.H, el, el))
-        for h in range(self.H):
-            mf[h, ...] = img.eq(h).clone()
-        return mf
-    
-    def calculate_2point_torch_spatialstat(self, mf):
+        phases = torch.tensor(phases, dtype=imgs.dtype, device=imgs.device).view(1, -1, 1, 1)
+        return imgs.eq(phases).float()
+
+    def calculate_2point_torch_spatialstat(self, mf, pairs):
         """
-        Calculates two-point spatial statistics for the microstructure function tensor.
+        Calculates two-point spatial statistics for a batch of microstructure function tensors,
+        using one float32 rFFT per phase.
 
         Parameters:
-            mf (torch.Tensor): Microstructure function tensor of shape (num_phases, edge_len, edge_len).
+            mf (torch.Tensor): Microstructure function tensor of shape (N, num_phases, H, W).
+            pairs (list): (iA, iB) index pairs into the phase dimension of mf.
 
         Returns:
-            torch.Tensor: Two-point spatial statistics tensor of shape (1, edge_len, edge_len)
+            torch.Tensor: Two-point spatial statistics tensor of shape (N, len(pairs), H, W)
         """
-        iA, iB = 0, 0
-        el = mf.shape[-1]
-        M = torch.zeros((self.H, el, el), dtype=torch.complex128)
-        for h in range(self.H):
-            M[h, ...] = torch.fft.fftn(mf[h, ...], dim=[0, 1])
-
-        S = el**2
-        M1, M2 = M[iA, ...], M[iB, ...]
-        term1 = torch.abs(M1) * torch.exp(-1j * torch.angle(M1))
-        term2 = torch.abs(M2) * torch.exp(1j * torch.angle(M2))
-
-        FFtmp = term1 * term2 / S
-
-        output = torch.fft.ifftn(FFtmp, [el, el], [0, 1]).real.unsqueeze(0)        
-        return output
+        height, width = mf.shape[-2:]
+        M = torch.fft.rfft2(mf)
+        iA = [pair[0] for pair in pairs]
+        iB = [pair[1] for pair in pairs]
+        FFtmp = M[:, iA].conj() * M[:, iB] / (height * width)
+        return torch.fft.irfft2(FFtmp, s=(height, width))
 
     def fft_shift(self, input_autocorr):
         """
         Performs a circular shift on the input autocorrelation tensor.
-        img: autocorrelation (Torch tensor of shape (1, H, W))
+        img: autocorrelation (Torch tensor of shape (..., H, W))
 
-        Returns: shifted autocorrelation (Torch tensor of shape (1, H, W))
+        Returns: shifted autocorrelation (Torch tensor of shape (..., H, W))
         """
-        _, H, W = input_autocorr.shape
+        H, W = input_autocorr.shape[-2:]
         return torch.roll(input_autocorr, shifts=(H // 2, W // 2), dims=(-2, -1))
 
+    def chunk_size(self, height, width, num_phases, num_pairs):
+        """Number of images per chunk that keeps the float32 intermediates within max_chunk_mb."""
+        # microstructure function + half spectra (complex64) + cross spectra (complex64) + output
+        bytes_per_image = 4 * height * width * (num_phases + num_phases + num_pairs + num_pairs)
+        return max(1, int(self.max_chunk_mb * 1024**2) // bytes_per_image)
+
+    def iter_batch_forward(self, imgs, pairs=((0, 0),)):
+        """
+        Calculates the auto/cross correlations of a batch of images chunk by chunk.
+
+        imgs: Torch tensor or numpy array of shape (N, 1, H, W) of phase labels, e.g. uint8 or bool binary images
+        pairs: (iA, iB) phase pairs to calculate, (0, 0) being the phase 0 autocorrelation
+
+        yields: (start index, Torch float32 tensor of shape (chunk_size, len(pairs), H, W)) per chunk
+        """
+        if isinstance(imgs, np.ndarray):
+            imgs = torch.from_numpy(imgs)
+        if imgs.dtype == torch.bool:
+            imgs = imgs.to(torch.uint8)
+        assert (len(imgs.shape) == 4 and imgs.shape[1] == 1), "Input not a batch of single-channel images!"
+        pairs = [tuple(pair) for pair in pairs]
+        phases = sorted(set(phase for pair in pairs for phase in pair))
+        assert all(0 <= phase < self.H for phase in phases), f"Phases should be between 0 and {self.H - 1}"
+        pair_index = [(phases.index(iA), phases.index(iB)) for iA, iB in pairs]
+
+        height, width = imgs.shape[-2:]
+        chunk = self.chunk_size(height, width, len(phases), len(pairs))
+        for start in range(0, imgs.shape[0], chunk):
+            mf = self.calculate_microstructure_function(imgs[start:start + chunk], phases)
+            yield start, self.fft_shift(self.calculate_2point_torch_spatialstat(mf, pair_index))
+
+    def batch_forward(self, imgs, pairs=((0, 0),)):
+        """
+        calculates the two-point auto/cross correlations of a batch of images
+        imgs: Torch tensor or numpy array of shape (N, 1, H, W) of phase labels, e.g. uint8 or bool binary images
+        pairs: (iA, iB) phase pairs to calculate, (0, 0) being the phase 0 autocorrelation
+
+        out: Torch float32 tensor of shape (N, len(pairs), H, W)
+        """
+        return torch.cat([autocorrs for _, autocorrs in self.iter_batch_forward(imgs, pairs)], dim=0)
+
     def forward(self, img):
         """
         calculates the two-point autocorrelation
@@ -210,8 +710,4 @@ class TwoPointAutocorrelation:
         out: Torch tensor of shape (1, H, W)
         """
         assert (len(img.shape) == 3 and img.shape[0]==1 and img.shape[1]==img.shape[2]), "Input not a single-channel, square, individual image!"
-        mf = self.calculate_microstructure_function(img)
-        autocorr = self.calculate_2point_torch_spatialstat(mf)
-        shifted_autocorr = self.fft_shift(autocorr)
-        return shifted_autocorr
-    
+        return self.batch_forward(img.unsqueeze(0))[0]
@@ -0,0 +1,145 @@
+# Microbenchmark for the two-point spatial statistics loss, its parity is checked in tests/test_spatial_statistics_loss.py.
+# Run from the repository root: python src/models/spatial_stats_benchmark.py
+import time
+import argparse
+
+import torch
+
+from spatial_statistics_loss import TwoPointSpatialStatsLoss
+
+
+def reference_two_point_autocorr(loss, imgs):
+    """
+    The original per-image implementation of TwoPointSpatialStatsLoss.calculate_two_point_autocorr_pytorch,
+    kept here to check the batched path against.
+
+    imgs: Torch tensor of shape (bs, 1, H, W)
+
+    Returns: Torch tensor of shape (bs, 1, H, W)
+    """
+    outputs = []
+    for img in imgs:
+        mf = torch.cat([loss.soft_equality(img, h) for h in range(loss.H)], dim=0)
+        el = mf.shape[-1]
+        M = torch.zeros((loss.H, el, el), dtype=torch.complex128, device=mf.device)
+        for h in range(loss.H):
+            M[h, ...] = torch.fft.fftn(mf[h, ...], dim=[0, 1])
+        M1, M2 = M[0, ...], M[0, ...]
+        term1 = torch.abs(M1) * torch.exp(-1j * torch.angle(M1))
+        term2 = torch.abs(M2) * torch.exp(1j * torch.angle(M2))
+        output = torch.fft.ifftn(term1 * term2 / el**2, [el, el], [0, 1]).real.unsqueeze(0)
+        if loss.normalize_spst_tensors:
+            output = loss.normalize(output)
+        outputs.append(output.unsqueeze(0))
+    return loss.fft_shift(torch.cat(outputs, dim=0))
+
+
+def time_function(func, *args, repeats=5):
+    func(*args)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func(*args)
+    return (time.perf_counter() - start) / repeats
+
+
+def saved_tensor_bytes(func):
+    """
+    Runs func under saved_tensors_hooks and returns the bytes of the distinct tensors autograd saved for backward.
+    """
+    storages = {}
+
+    def pack(tensor):
+        if tensor.layout == torch.strided:
+            storage = tensor.untyped_storage()
+            storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        func()
+    return sum(storages.values())
+
+
+def memory_comparison(batch_sizes, input_size, device, repeats):
+    """
+    Prints the memory autograd keeps for backward (and the CUDA peak, on GPU) and the time of
+    forward+backward of the unfused and the fused loss.
+    """
+    for batch_size in batch_sizes:
+        imgs = torch.rand(batch_size, 1, input_size, input_size, device=device)
+        targets = (torch.rand(batch_size, 1, input_size, input_size, device=device) > 0.5).float()
+        for fused in [False, True]:
+            loss = TwoPointSpatialStatsLoss(device, -1.9e-09, 0.04, fused=fused)
+
+            def forward(x):
+                return loss(x, targets, return_autocorrs=False)[0]
+
+            saved = saved_tensor_bytes(lambda: forward(imgs.clone().requires_grad_(True)))
+            peak = ""
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+                base = torch.cuda.memory_allocated()
+                forward(imgs.clone().requires_grad_(True)).backward()
+                torch.cuda.synchronize()
+                peak = f", CUDA peak {(torch.cuda.max_memory_allocated() - base) / 2**20:.1f} MB"
+            t = time_function(lambda: forward(imgs.clone().requires_grad_(True)).backward(), repeats=repeats)
+            print(f"{'fused' if fused else 'unfused'} loss bs={batch_size}: saved for backward {saved / 2**20:.1f} MB{peak}, forward+backward {t * 1e3:.1f} ms")
+
+
+def benchmark(batch_size, input_size, device, repeats):
+    imgs = torch.rand(batch_size, 1, input_size, input_size, device=device)
+    targets = (torch.rand(batch_size, 1, input_size, input_size, device=device) > 0.5).float()
+    loss = TwoPointSpatialStatsLoss(device, -1.9e-09, 0.04)
+    t_ref = time_function(reference_two_point_autocorr, loss, imgs, repeats=repeats)
+    print(f"reference per-image autocorr: {t_ref * 1e3:.1f} ms")
+    for precision in ['float64', 'float32']:
+        loss = TwoPointSpatialStatsLoss(device, -1.9e-09, 0.04, precision=precision)
+        t = time_function(loss.calculate_two_point_autocorr_pytorch, imgs, repeats=repeats)
+        print(f"batched autocorr ({precision}): {t * 1e3:.1f} ms ({t_ref / t:.1f}x)")
+
+        def forward_backward():
+            x = imgs.clone().requires_grad_(True)
+            diff, _, _ = loss(x, targets)
+            diff.backward()
+        t = time_function(forward_backward, repeats=repeats)
+        print(f"loss forward+backward ({precision}): {t * 1e3:.1f} ms")
+
+
+def lag_window_crossovers(batch_sizes, input_sizes, lag_radii, device, repeats):
+    """
+    Times the direct and FFT lag window algorithms and prints, for every batch and image size,
+    the smallest lag radius at which the FFT becomes faster next to the one the cost model picks.
+    """
+    for precision in ['float64', 'float32']:
+        for input_size in input_sizes:
+            for batch_size in batch_sizes:
+                imgs = torch.rand(batch_size, 1, input_size, input_size, device=device)
+                measured, predicted = None, None
+                timings = []
+                for lag_radius in lag_radii:
+                    loss = TwoPointSpatialStatsLoss(device, -1.9e-09, 0.04, precision=precision, lag_radius=lag_radius)
+                    t_direct = time_function(loss.calculate_lag_window_autocorr, imgs, 'direct', repeats=repeats)
+                    t_fft = time_function(loss.calculate_lag_window_autocorr, imgs, 'fft', repeats=repeats)
+                    timings.append(f"R{lag_radius}:{t_direct / t_fft:.2f}")
+                    if measured is None and t_fft < t_direct:
+                        measured = lag_radius
+                    if predicted is None and loss.select_lag_algorithm(input_size, input_size, lag_radius, batch_size) == 'fft':
+                        predicted = lag_radius
+                print(f"lag window {precision} size={input_size} bs={batch_size}: fft faster from R={measured} (cost model: R={predicted}), direct/fft time {' '.join(timings)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the two-point spatial statistics loss.")
+    parser.add_argument('--bs', type=int, default=32, help="Batch size.")
+    parser.add_argument('--input_size', type=int, default=224, help="Edge length of the square input images.")
+    parser.add_argument('--repeats', type=int, default=5, help="Number of timed repetitions.")
+    parser.add_argument('--memory', action='store_true', help="Also compare the memory of the unfused and fused loss at batch sizes 32/64/128.")
+    parser.add_argument('--crossovers', action='store_true', help="Also print the lag window direct vs FFT crossover points.")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    benchmark(args.bs, args.input_size, device, args.repeats)
+    if args.memory:
+        memory_comparison([32, 64, 128], args.input_size, device, args.repeats)
+    if args.crossovers:
+        lag_window_crossovers([1, 8, args.bs], [64, args.input_size], [1, 2, 3, 5, 8, 12, 20], device, args.repeats)
@@ -0,0 +1,219 @@
+"""
+Reduced-order descriptors of two-point autocorrelations.
+
+A 224x224 autocorrelation map is very redundant. These modules map autocorrelations of shape
+(..., H, W) to a few numbers (..., d) that can be compared instead of the full maps: a PCA basis
+fitted over a dataset, and radially / angularly averaged profiles.
+
+To fit and save the PCA basis of a dataset (run from the repository root):
+    python src/models/spatial_stats_descriptors.py lines --n_components 32
+"""
+import os
+import math
+import argparse
+
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Subset
+
+from lines_dataset import LinesDataset
+from shapes_dataset import ShapesDataset
+from preprocessing import BatchPreprocess, image_transform
+from training_utils import read_pixel_values
+from spatial_statistics_loss import TwoPointSpatialStatsLoss
+
+
+class AutocorrelationPCA(nn.Module):
+    def __init__(self, mean, components, explained_variance_ratio, size, normalized=False):
+        """
+        mean: Torch tensor of shape (H*W,), the mean autocorrelation
+        components: Torch tensor of shape (H*W, k), the principal axes sorted by explained variance
+        explained_variance_ratio: Torch tensor of shape (k,), fraction of the total variance explained by each component
+        size: (H, W) of the autocorrelations
+        normalized: whether the basis was fitted on autocorrelations normalized with the dataset pixel values
+        """
+        super(AutocorrelationPCA, self).__init__()
+        self.register_buffer('mean', mean)
+        self.register_buffer('components', components)
+        self.register_buffer('explained_variance_ratio', explained_variance_ratio)
+        self.size = tuple(size)
+        self.normalized = normalized
+
+    @classmethod
+    def fit(cls, autocorrs, n_components, normalized=False, niter=4):
+        """
+        Fits the basis with a randomized low-rank PCA.
+
+        autocorrs: Torch tensor of shape (N, 1, H, W)
+        n_components: number of principal components to keep (int)
+        """
+        size = autocorrs.shape[-2:]
+        X = autocorrs.reshape(autocorrs.shape[0], -1).float()
+        mean = X.mean(dim=0)
+        q = min(n_components + 10, *X.shape)
+        _, S, V = torch.pca_lowrank(X - mean, q=q, center=False, niter=niter)
+        explained_variance_ratio = S[:n_components]**2 / ((X - mean)**2).sum()
+        return cls(mean, V[:, :n_components].contiguous(), explained_variance_ratio, size, normalized)
+
+    def forward(self, autocorrs):
+        """
+        autocorrs: Torch tensor of shape (..., H, W)
+
+        Returns: PCA coefficients, Torch tensor of shape (..., k)
+        """
+        assert tuple(autocorrs.shape[-2:]) == self.size, f"PCA basis was fitted on {self.size} autocorrelations"
+        flat = autocorrs.flatten(-2)
+        return (flat - self.mean.to(flat.dtype)) @ self.components.to(flat.dtype)
+
+    def save(self, path):
+        torch.save({
+            'mean': self.mean.cpu(),
+            'components': self.components.cpu(),
+            'explained_variance_ratio': self.explained_variance_ratio.cpu(),
+            'size': self.size,
+            'normalized': self.normalized,
+            }, path)
+
+    @classmethod
+    def load(cls, path, n_components=None):
+        """
+        Loads a saved basis, keeping only its top n_components components if given.
+        """
+        state = torch.load(path)
+        k = n_components or state['components'].shape[1]
+        assert k <= state['components'].shape[1], f"{path} only holds {state['components'].shape[1]} components"
+        return cls(state['mean'], state['components'][:, :k].contiguous(), state['explained_variance_ratio'][:k], state['size'], state['normalized'])
+
+
+class RadialProfile(nn.Module):
+    def __init__(self, size, num_bins=None):
+        """
+        Averages autocorrelations over rings of equal lag length around the zero lag (H//2, W//2).
+
+        size: (H, W) of the autocorrelations
+        num_bins: number of rings, None for one ring per integer lag length
+        """
+        super(RadialProfile, self).__init__()
+        height, width = size
+        y, x = torch.meshgrid(torch.arange(height), torch.arange(width), indexing='ij')
+        r = torch.sqrt(((y - height // 2)**2 + (x - width // 2)**2).float())
+        if num_bins is None:
+            bins = r.round().long()
+        else:
+            bins = (r / r.max() * (num_bins - 1)).round().long()
+        num_bins = int(bins.max()) + 1
+        self.register_buffer('bins', bins.view(-1))
+        self.register_buffer('counts', torch.bincount(bins.view(-1), minlength=num_bins).clamp(min=1))
+        self.num_bins = num_bins
+
+    def forward(self, autocorrs):
+        """
+        autocorrs: Torch tensor of shape (..., H, W)
+
+        Returns: Torch tensor of shape (..., num_bins)
+        """
+        flat = autocorrs.flatten(-2)
+        profile = flat.new_zeros(*flat.shape[:-1], self.num_bins).index_add(-1, self.bins, flat)
+        return profile / self.counts.to(flat.dtype)
+
+
+class AngularProfile(nn.Module):
+    def __init__(self, size, num_bins=36, max_radius=None):
+        """
+        Averages autocorrelations over angular sectors around the zero lag, within max_radius.
+        C(r) = C(-r), so the sectors cover [0, pi).
+
+        size: (H, W) of the autocorrelations
+        num_bins: number of sectors
+        max_radius: lag length up to which to average, defaults to min(H, W) // 2
+        """
+        super(AngularProfile, self).__init__()
+        height, width = size
+        max_radius = max_radius or min(height, width) // 2
+        y, x = torch.meshgrid(torch.arange(height), torch.arange(width), indexing='ij')
+        dy, dx = (y - height // 2).float(), (x - width // 2).float()
+        r = torch.sqrt(dy**2 + dx**2)
+        inside = ((r > 0) & (r <= max_radius)).view(-1)
+        angle = torch.remainder(torch.atan2(dy, dx), math.pi).view(-1)
+        bins = (angle / math.pi * num_bins).long().clamp(max=num_bins - 1)
+        self.register_buffer('positions', inside.nonzero().view(-1))
+        self.register_buffer('bins', bins[inside])
+        self.register_buffer('counts', torch.bincount(bins[inside], minlength=num_bins).clamp(min=1))
+        self.num_bins = num_bins
+
+    def forward(self, autocorrs):
+        """
+        autocorrs: Torch tensor of shape (..., H, W)
+
+        Returns: Torch tensor of shape (..., num_bins)
+        """
+        flat = autocorrs.flatten(-2).index_select(-1, self.positions)
+        profile = flat.new_zeros(*flat.shape[:-1], self.num_bins).index_add(-1, self.bins, flat)
+        return profile / self.counts.to(flat.dtype)
+
+
+def build_descriptor(name, size, device, pca_path=None, n_components=None, normalized=False):
+    """
+    name: 'pca', 'radial' or 'angular'
+    size: (H, W) of the autocorrelations the descriptor is applied to
+    pca_path: saved AutocorrelationPCA basis, for 'pca'
+    n_components: top-k PCA components, or number of bins of the profiles (None for their defaults)
+    normalized: whether the loss normalizes its autocorrelations, checked against the PCA basis
+    """
+    if name == 'pca':
+        assert pca_path is not None and os.path.exists(pca_path), f"No PCA basis at {pca_path}, fit one with spatial_stats_descriptors.py"
+        descriptor = AutocorrelationPCA.load(pca_path, n_components)
+        assert descriptor.normalized == normalized, "The PCA basis was fitted with a different autocorrelation normalization"
+    elif name == 'radial':
+        descriptor = RadialProfile(size, n_components)
+    elif name == 'angular':
+        descriptor = AngularProfile(size, n_components or 36)
+    else:
+        raise ValueError(f"Descriptor {name} not recognized.")
+    return descriptor.to(device)
+
+
+def fit_dataset_pca(dataset, autocorr_func, n_components, device, max_samples=2000, batch_size=64, normalized=False, seed=0, collate_fn=None):
+    """
+    Fits an AutocorrelationPCA on the autocorrelations of (a random subset of) a dataset.
+
+    dataset: Dataset yielding (image, label), collated by collate_fn into images of shape (bs, 1, H, W)
+    autocorr_func: function mapping a (bs, 1, H, W) batch to its (bs, 1, H, W) autocorrelations
+    """
+    generator = torch.Generator().manual_seed(seed)
+    indices = torch.randperm(len(dataset), generator=generator)[:max_samples].tolist()
+    loader = DataLoader(Subset(dataset, indices), batch_size=batch_size, num_workers=4, collate_fn=collate_fn)
+    autocorrs = []
+    with torch.no_grad():
+        for X, *_ in loader:
+            autocorrs.append(autocorr_func(X.to(device)).float().cpu())
+    return AutocorrelationPCA.fit(torch.cat(autocorrs, dim=0), n_components, normalized=normalized)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit and save the PCA basis of a dataset's two-point autocorrelations.")
+    parser.add_argument('dataset_name', type=str, help="lines, multiple_lines or shapes")
+    parser.add_argument('--n_components', type=int, default=50, help="Number of principal components to keep.")
+    parser.add_argument('--max_samples', type=int, default=2000, help="Number of images to fit the basis on.")
+    parser.add_argument('--normalize', action='store_true', help="Fit on autocorrelations normalized with pixel_values.txt, for losses with normalize_spatial_stat_tensors.")
+    args = parser.parse_args()
+
+    preprocess = BatchPreprocess(res_size=224, thr_255=240)
+    data_dir = os.path.join(os.getcwd(), f'data/{args.dataset_name}')
+    dataset_class = ShapesDataset if args.dataset_name == 'shapes' else LinesDataset
+    dataset = dataset_class(os.path.join(data_dir, 'labels.csv'), os.path.join(data_dir, 'images'), image_transform())
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    min_pixel_value, max_pixel_value = read_pixel_values(os.path.join(data_dir, 'pixel_values.txt'))
+    autocorr = TwoPointSpatialStatsLoss(device, min_pixel_value, max_pixel_value, normalize_spatial_stats_tensors=args.normalize, precision='float32')
+    pca = fit_dataset_pca(dataset, autocorr.calculate_two_point_autocorr_pytorch, args.n_components, device, max_samples=args.max_samples, normalized=args.normalize, collate_fn=preprocess.collate)
+
+    save_path = os.path.join(data_dir, 'autocorr_pca.pt')
+    pca.save(save_path)
+    explained = pca.explained_variance_ratio.cumsum(0)
+    print(f"The top 10 components explain {100 * explained[min(9, args.n_components - 1)]:.2f}% of the variance, all {args.n_components} {100 * explained[-1]:.2f}%")
+    print(f"PCA basis saved in {save_path}")
+
+
+if __name__ == "__main__":
+    main()
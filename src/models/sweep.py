@@ -6,26 +6,47 @@ import wandb
 from wandb_train import run_training
 
 
+# sweep parameter -> run_training argument. Parameters missing from a sweep keep the run_training default, the
+# others (e.g. wandb_log_interval, save_model_locally) are not passed
+RUN_TRAINING_ARGUMENTS = {
+    'epochs': 'epochs',
+    'a_mse': 'a_mse', 'a_content': 'a_content', 'a_style': 'a_style', 'a_spst': 'a_spst', 'beta_max': 'beta',
+    'content_layer': 'content_layer', 'style_layer': 'style_layer',
+    'learning_rate': 'learning_rate',
+    'spatial_stats_loss_reduction_type': 'spatial_stat_loss_reduction', 'normalize_spatial_stats_tensors': 'normalize_spatial_stat_tensors', 'soft_equality_eps': 'soft_equality_eps',
+    'batch_size': 'batch_size', 'bottleneck_size': 'CNN_embed_dim',
+    'encoder_backbone': 'encoder_backbone', 'encoder_backbone_kwargs': 'encoder_backbone_kwargs',
+    'model_precision': 'model_precision', 'compiled_execution': 'compiled_execution',
+    'resume_training': 'resume_training', 'last_epoch': 'last_epoch', 'checkpoint_every_n_steps': 'checkpoint_every_n_steps',
+    'schedule_KLD': 'schedule_KLD', 'schedule_spst': 'schedule_spst', 'dataset_name': 'dataset_name', 'packed_dataset_cache': 'packed_dataset_cache',
+    'procedural_data': 'procedural_data', 'procedural_batches_per_epoch': 'procedural_batches_per_epoch',
+    'debugging': 'debugging',
+    'backbone_feature_cache': 'backbone_feature_cache',
+    'seed': 'seed', 'ensemble_seeds': 'ensemble_seeds',
+}
+
+
+def run_training_kwargs(config):
+    """
+    config: dict of the parameters of one run of a sweep (see config_files/)
+
+    Returns: the keyword arguments of run_training for it
+    """
+    kwargs = {argument: config[parameter] for parameter, argument in RUN_TRAINING_ARGUMENTS.items() if parameter in config}
+    #beta_max = 1 - (config.a_mse + config.a_content + config.a_style + config.a_spst) # beta is scheduled. it will go from 0.005 to beta_max
+    if 'learning_rate' in config:
+        kwargs['fine_tune_lr'] = config['learning_rate']/2
+    return kwargs
+
+
 def main():
     wandb.init(
         project='sweep-vae-loss-alphas-and-neural-layers',
         settings=wandb.Settings(_service_wait=300)
         )
     
-    config = wandb.config
-    #beta_max = 1 - (config.a_mse + config.a_content + config.a_style + config.a_spst) # beta is scheduled. it will go from 0.005 to beta_max
-    run_training(
-        config.epochs,
-        config.a_mse, config.a_content, config.a_style, config.a_spst, config.beta_max, 
-        config.content_layer, config.style_layer, 
-        learning_rate=config.learning_rate, fine_tune_lr=config.learning_rate/2,
-        spatial_stat_loss_reduction=config.spatial_stats_loss_reduction_type, normalize_spatial_stat_tensors=config.normalize_spatial_stats_tensors, soft_equality_eps=config.soft_equality_eps,
-        batch_size=config.batch_size, CNN_embed_dim=config.bottleneck_size,
-        wandb_log_interval=config.wandb_log_interval, save_model_locally=config.save_model_locally,
-        resume_training=config.resume_training, last_epoch=config.last_epoch,
-        schedule_KLD=config.schedule_KLD, schedule_spst=config.schedule_spst, dataset_name=config.dataset_name,
-        debugging=config.debugging,
-        seed=config.seed) 
+    run_training(**run_training_kwargs(dict(wandb.config)))
+
 if __name__=="__main__":
     parser = argparse.ArgumentParser(description="Use W&B sweeps to sweep over hyperparameters. Put h-params in the sweep_config.yaml file.")
     parser.add_argument('--sweep_id', type=str, required=False, default=None, help="W&B sweep ID")
@@ -2,14 +2,14 @@
 import os
 import torch
 from torch.utils.data import DataLoader
-from torchvision import transforms
 import numpy as np
 import torch.nn.functional as F
 from tqdm import tqdm
 from resnet_vae import ResNet_VAE
 from training_utils import seed_everything, reconstruct_images
 from lines_dataset import LinesDataset
-from utils import ThresholdTransform
+from preprocessing import BatchPreprocess, image_transform
+from autocorr_store import AutocorrelationStore
 from evaluate_outputs import threshold_image
 from spatial_statistics_loss import TwoPointAutocorrelation, TwoPointSpatialStatsLoss
 import matplotlib.pyplot as plt
@@ -32,16 +32,15 @@ vae.load_state_dict(torch.load(model_path))
 
 data_dir = 'multiple_lines'
 dataset_path = '/home/sajad/AI-generated-chemical-materials/data'
-transform = transforms.Compose([
-        transforms.ToTensor(),  # Convert the image to tensor
-        transforms.Normalize((0.5,), (0.5,)), 
-        transforms.Resize([res_size, res_size], antialias=True),
-        ThresholdTransform(thr_255=240),
-    ])
-dataset = LinesDataset(f'{dataset_path}/{data_dir}/labels.csv', f'{dataset_path}/{data_dir}/images', transform)
+preprocess = BatchPreprocess(res_size=res_size, thr_255=240)
+dataset = LinesDataset(f'{dataset_path}/{data_dir}/labels.csv', f'{dataset_path}/{data_dir}/images', image_transform())
 train_dataset, valid_dataset = torch.utils.data.random_split(dataset, [int(len(dataset)*0.7), int(len(dataset)) - int(len(dataset)*0.7)])
-train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=4)
-valid_loader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=False)
+# the autocorrelations of the dataset images, written by transform_to_autocorrs.py
+autocorr_store = None
+if os.path.exists(f'{dataset_path}/{data_dir}/autocorr_store/index.json'):
+    autocorr_store = AutocorrelationStore(f'{dataset_path}/{data_dir}/autocorr_store')
+train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=4, collate_fn=preprocess.collate)
+valid_loader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=False, collate_fn=preprocess.collate)
 
 # display 200 pairs of images
 orig, recon, orig_autocorr, recon_autocorr = reconstruct_images(vae, train_loader, device, num_examples=1)
@@ -137,10 +136,14 @@ for i in tqdm(range(len(orig)), desc="Analyzing Images"):
     most_similar_spatial_stats_image = None
 
     # Iterate over validation set with tqdm for spatial statistics
-    for val_images, y in tqdm(valid_loader, desc=f"Processing Spatial Stats for Image {i}"):
-        for val_image in val_images:
-            val_spatial_stats = autocorr_func.forward(val_image)
-            mse_spatial_stats = F.mse_loss(recon_spst, val_spatial_stats)
+    for batch_idx, (val_images, y) in enumerate(tqdm(valid_loader, desc=f"Processing Spatial Stats for Image {i}")):
+        if autocorr_store is not None:
+            # valid_loader does not shuffle, so its batches follow valid_dataset.indices
+            val_spatial_stats = autocorr_store[valid_dataset.indices[batch_idx * batch_size:batch_idx * batch_size + len(val_images)]]
+        else:
+            val_spatial_stats = autocorr_func.batch_forward(val_images)
+        mse_spatial_stats_batch = ((val_spatial_stats - recon_spst)**2).mean(dim=(1, 2, 3))
+        for val_image, mse_spatial_stats in zip(val_images, mse_spatial_stats_batch):
             spatial_stats_mse_list.append(mse_spatial_stats.item())
             if mse_spatial_stats < min_spatial_stats_mse:
                 min_spatial_stats_mse = mse_spatial_stats
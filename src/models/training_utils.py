@@ -5,43 +5,186 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as dist
 from torchvision.utils import make_grid
 
-from spatial_statistics_loss import TwoPointSpatialStatsLoss, TwoPointAutocorrelation
+from spatial_statistics_loss import TwoPointSpatialStatsLoss, TwoPointAutocorrelation, AutocorrelationCache
 from neural_style_transfer_loss import ContentLoss, StyleLoss
 from loss_coefficients import normal_dist_coefficients
 
 
 class MaterialSimilarityLoss(nn.Module):
 
-    def __init__(self, device, min_fft_pxl_val, max_fft_pxl_val, content_layer=4, style_layer=4, spatial_stat_loss_reduction='mean', normalize_spatial_stat_tensors=False, soft_equality_eps=0.25):
+    def __init__(self, device, min_fft_pxl_val, max_fft_pxl_val, content_layer=4, style_layer=4, spatial_stat_loss_reduction='mean', normalize_spatial_stat_tensors=False, soft_equality_eps=0.25, spatial_stat_precision='float64', cache_input_autocorrs=False, autocorr_cache_max_mb=2048, spatial_stat_loss_domain='spatial', spatial_stat_lag_radius=None, spatial_stat_lag_algorithm='auto', spatial_stat_phase_pair_weights=None, spatial_stat_descriptor=None, spatial_stat_fused=False):
         """
         content_layer (int) is the layer that will be focused on the most;
         Same with the style layer.
         1 <= content_layer <= 5
         1 <= style_layer <= 5
+        cache_input_autocorrs (bool): Cache the autocorrelations of the input images by dataset index,
+        capped at autocorr_cache_max_mb megabytes (None for no cap). Used when forward is given x_idx.
+        spatial_stat_loss_domain (str): 'spatial' or 'frequency', see TwoPointSpatialStatsLoss.
+        spatial_stat_lag_radius (int), spatial_stat_lag_algorithm (str): Only compare the autocorrelation lags
+        within this radius, see TwoPointSpatialStatsLoss.
+        spatial_stat_phase_pair_weights (list): 2 x 2 weights of the phase pair auto/cross correlation MSEs,
+        see TwoPointSpatialStatsLoss. None compares the phase 0 autocorrelation only.
+        spatial_stat_descriptor (nn.Module): Compare reduced-order descriptors of the autocorrelations instead of
+        the full maps, see spatial_stats_descriptors.build_descriptor.
+        spatial_stat_fused (bool): Use the fused autograd function with an analytic backward, see TwoPointAutocorrMSE.
         """
         super(MaterialSimilarityLoss, self).__init__()
         self.device = device
         #self.content_layers = {layer: ContentLoss(f"conv_{layer}", device) for layer in range(1, 6)}
         #self.style_layers = {layer: StyleLoss(f"conv_{layer}", device) for layer in range(1, 6)}
-        self.spst_loss = TwoPointSpatialStatsLoss(device, min_fft_pxl_val, max_fft_pxl_val, filtered=False, normalize_spatial_stats_tensors=normalize_spatial_stat_tensors, reduction=spatial_stat_loss_reduction, soft_equality_eps=soft_equality_eps)
+        autocorr_cache = AutocorrelationCache(max_mb=autocorr_cache_max_mb) if cache_input_autocorrs else None
+        self.spst_loss = TwoPointSpatialStatsLoss(device, min_fft_pxl_val, max_fft_pxl_val, filtered=False, normalize_spatial_stats_tensors=normalize_spatial_stat_tensors, reduction=spatial_stat_loss_reduction, soft_equality_eps=soft_equality_eps, precision=spatial_stat_precision, autocorr_cache=autocorr_cache, loss_domain=spatial_stat_loss_domain, lag_radius=spatial_stat_lag_radius, lag_algorithm=spatial_stat_lag_algorithm, phase_pair_weights=spatial_stat_phase_pair_weights, descriptor=spatial_stat_descriptor, fused=spatial_stat_fused)
         #self.content_layer_coefficients = normal_dist_coefficients(content_layer)
         #self.style_layer_coefficients = normal_dist_coefficients(style_layer)
+        self.compiled_terms = None
 
-    def forward(self, x, recon_x, mu, logvar, a_mse, a_content, a_style, a_spst, beta):
+    def elementwise_terms(self, x, recon_x, mu, logvar):
         MSE = F.mse_loss(x, recon_x, reduction='sum')
+        KLD = -0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp())
+        return MSE, KLD
+
+    def compile_terms(self, mode=None):
+        """
+        Compiles the MSE and KLD terms with torch.compile. The coefficients are applied outside of it, so the
+        scheduled a_spst and beta do not trigger recompilations, and the spatial stats loss stays eager:
+        the inductor backend of torch 2.0 cannot compile its complex FFTs.
+        """
+        self.compiled_terms = torch.compile(self.elementwise_terms, mode=mode)
+
+    def forward(self, x, recon_x, mu, logvar, a_mse, a_content, a_style, a_spst, beta, x_idx=None, return_autocorrs=True):
+        terms = self.compiled_terms if self.compiled_terms is not None else self.elementwise_terms
+        MSE, KLD = terms(x, recon_x, mu, logvar)
+        SPST, input_autocorr, recon_autocorr = self.spst_loss(x, recon_x, input_idx=x_idx, return_autocorrs=return_autocorrs)
         #CONTENTLOSS = sum(self.content_layer_coefficients[i-1] * self.content_layers[i](recon_x, x) for i in range(1, 6))
         #STYLELOSS = sum(self.style_layer_coefficients[i-1] * self.style_layers[i](recon_x, x) for i in range(1, 6))
         #-------DELETE LATER--------
         CONTENTLOSS=torch.Tensor([0]).to(self.device)
         STYLELOSS=torch.Tensor([0]).to(self.device)
         #---------------------------
-        SPST, input_autocorr, recon_autocorr = self.spst_loss(x, recon_x)
-        KLD = -0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp())
         overall_loss = a_mse*MSE + a_spst*SPST + beta*KLD + a_content*CONTENTLOSS + a_style*STYLELOSS 
         return MSE, CONTENTLOSS, STYLELOSS, SPST, KLD, overall_loss, input_autocorr, recon_autocorr
 
+    def per_sample_terms(self, terms, coefficients, num_samples):
+        """
+        The MSE, content, style, SPST, KLD and overall losses of a batch as means per sample, for LossAccumulator.
+        MSE and KLD (and SPST with the 'sum' reduction) are sums over the batch and are divided by its size, the
+        overall loss is then recombined from the per-sample terms.
+
+        terms: MSE, content, style, SPST and KLD as returned by forward
+        coefficients: a_mse, a_content, a_style, a_spst, beta
+        """
+        mse, content, style, spst, kld = terms
+        a_mse, a_content, a_style, a_spst, beta = coefficients
+        mse, kld = mse / num_samples, kld / num_samples
+        if self.spst_loss.mse_loss.reduction == 'sum':
+            spst = spst / num_samples
+        overall_loss = a_mse*mse + a_spst*spst + beta*kld + a_content*content + a_style*style
+        return mse, content, style, spst, kld, overall_loss
+
+
+class LossAccumulator:
+    def __init__(self, num_terms, device):
+        """
+        Accumulates the per-sample losses of an epoch on the device, weighted by the number of samples of each
+        batch, so the training step never waits for the device to read them back.
+
+        num_terms: number of loss terms (MSE, content, style, SPST, KLD and overall in train / validation)
+        """
+        self.totals = torch.zeros(num_terms, dtype=torch.float64, device=device)
+        self.window_totals = torch.zeros_like(self.totals)
+        self.count = 0
+        self.window_count = 0
+        self.pending = None
+
+    def update(self, values, num_samples):
+        """
+        values: the loss terms of a batch as means per sample (see MaterialSimilarityLoss.per_sample_terms),
+        tensors of one element each
+        num_samples: batch size
+        """
+        batch_totals = torch.stack([value.detach().reshape(()) for value in values]).to(torch.float64) * num_samples
+        self.totals += batch_totals
+        self.window_totals += batch_totals
+        self.count += num_samples
+        self.window_count += num_samples
+
+    def log_window(self):
+        """
+        Starts copying the mean losses since the previous call to the host, without waiting for it, and
+        returns the means of the window before (None the first time). The logged values are one log
+        interval late, but by then their copy is long done and reading them does not stall the device.
+        """
+        previous = self.pending
+        means = self.window_totals / max(self.window_count, 1)
+        if means.is_cuda:
+            host = torch.empty(means.shape, dtype=means.dtype, pin_memory=True)
+            host.copy_(means, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+            self.pending = (host, event)
+        else:
+            self.pending = (means, None)
+        self.window_totals = torch.zeros_like(self.totals)
+        self.window_count = 0
+
+        if previous is None:
+            return None
+        host, event = previous
+        if event is not None:
+            event.synchronize()
+        return host.numpy()
+
+    def mean(self):
+        """
+        Sample-weighted mean of every loss term over the epoch, as a NumPy array. Reads the device once.
+        In a distributed run (see distributed.py) it is the mean over the samples of every rank, a collective.
+        """
+        if not (dist.is_available() and dist.is_initialized()):
+            return (self.totals / max(self.count, 1)).cpu().numpy()
+        summed = torch.cat([self.totals, self.totals.new_tensor([self.count])])
+        dist.all_reduce(summed)
+        summed = summed.cpu().numpy()
+        return summed[:-1] / max(summed[-1], 1)
+
+    def state_dict(self):
+        """The accumulated losses, to checkpoint a partial epoch."""
+        return {'totals': self.totals, 'count': self.count, 'window_totals': self.window_totals, 'window_count': self.window_count}
+
+    def load_state_dict(self, state):
+        self.totals = state['totals'].to(self.totals.device)
+        self.window_totals = state['window_totals'].to(self.totals.device)
+        self.count = state['count']
+        self.window_count = state['window_count']
+
+
+MODEL_PRECISIONS = ['float32', 'bfloat16']
+
+
+def model_autocast(device, model_precision='float32'):
+    """
+    Context the VAE runs in. 'bfloat16' autocasts its convolutions and linear layers to bfloat16, which
+    recent Xeon / EPYC CPUs (AVX512-BF16, AMX) and GPUs run much faster. The losses are computed outside
+    of it on the float32 outputs, so the KLD and MSE stay in float32 and the spatial stats FFTs in their
+    own precision.
+    """
+    assert model_precision in MODEL_PRECISIONS, f"model_precision should be one of {MODEL_PRECISIONS}"
+    device_type = torch.device(device).type
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=model_precision == 'bfloat16')
+
+
+def run_model(model, X, device, model_precision='float32', features=None):
+    """
+    Returns: the reconstruction, z, mu and logvar of model(X) (from the cached backbone features if given),
+    run in model_autocast and returned in float32
+    """
+    with model_autocast(device, model_precision):
+        outputs = model(X) if features is None else model(X, features=features)
+    return tuple(output.float() for output in outputs)
+
 
 class ExponentialScheduler:
     def __init__(self, start, max_val, epochs) -> None:
@@ -123,97 +266,116 @@ class LossCoefficientScheduler:
         return np.round(self.value, 3)
 
 
-def train(log_interval, model, criterion, device, train_loader, optimizer, epoch, save_model_path, a_mse, a_content, a_style, a_spst, beta, testing):
+def mark_last(batches):
+    """
+    Yields (batch, is_last) pairs, one batch ahead. len() of a DataLoader is only an estimate for the
+    streamed datasets, whose workers each end on a partial batch.
+    """
+    iterator = iter(batches)
+    batch = next(iterator, None)
+    while batch is not None:
+        next_batch = next(iterator, None)
+        yield batch, next_batch is None
+        batch = next_batch
+
+
+def train(log_interval, model, criterion, device, train_loader, optimizer, epoch, save_model_path, a_mse, a_content, a_style, a_spst, beta, testing, log_autocorrs=True, diagnostics=None, model_precision='float32', start_batch=0, losses=None, step_checkpoint=None):
+    # log_autocorrs: whether the autocorrelations of the last batch are needed (returned as None otherwise
+    # in the frequency domain spatial stats loss)
+    # diagnostics: GradientDiagnostics measuring the gradients of the mse, spst and kl terms on the batches it is
+    # due, and of the total loss after the last step. Its summary is returned as grad_stats ({} without it).
+    # model_precision: 'float32' or 'bfloat16', see model_autocast
+    # start_batch, losses: resume an interrupted epoch at batch start_batch with its LossAccumulator, the
+    # train_loader then only yields the batches left (see utils.ResumableRandomSampler)
+    # step_checkpoint: called as step_checkpoint(batches_done, losses) after the steps it is due, see StepCheckpoint
     # set model as training mode
     model.train()
 
-    losses = []
-    N_count = 0   # counting total trained sample in one epoch
-    mse_grads, spst_grads, kld_grads = [], [], []
+    if losses is None:
+        losses = LossAccumulator(6, device)
+    N_count = losses.count   # counting total trained sample in one epoch
+    num_batches = start_batch + len(train_loader)
+    if diagnostics is not None:
+        diagnostics.reset()
 
-    for batch_idx, (X, y) in enumerate(train_loader):
+    for batch_idx, ((X, y, *extra), is_last) in enumerate(mark_last(train_loader), start=start_batch):
         # distribute data to device
-        X, y = X.to(device), y.to(device).view(-1, )
+        X, y = X.to(device, non_blocking=True), y.to(device, non_blocking=True).view(-1, )
+        X_idx = extra[0] if extra else None  # dataset indices, only yielded by an IndexedDataset / FeatureCacheDataset
+        features = extra[1].to(device, non_blocking=True) if len(extra) > 1 else None  # cached backbone features
         N_count += X.size(0)
+        last_batch = is_last or (testing and batch_idx > 1)
+
+        X_reconst, z, mu, logvar = run_model(model, X, device, model_precision, features)  # VAE
+        mse, content, style, spst, kld, loss, input_autocorr, recon_autocorr = criterion(X, X_reconst, mu, logvar, a_mse, a_content, a_style, a_spst, beta, x_idx=X_idx, return_autocorrs=log_autocorrs and last_batch)
+
+        if diagnostics is not None and diagnostics.due(batch_idx):
+            # track the gradients of every loss term, keeping the graph for the training backward
+            diagnostics.measure({'mse': mse, 'spst': spst, 'kl': kld})
 
-        X_reconst, z, mu, logvar = model(X)  # VAE
-        mse, content, style, spst, kld, loss, input_autocorr, recon_autocorr = criterion(X, X_reconst, mu, logvar, a_mse, a_content, a_style, a_spst, beta)
-        loss_values = (mse.item(), content.item(), style.item(), spst.item(), kld.item(), loss.item())
-
-        #if batch_idx % 100 == 0:
-        if batch_idx < 1:
-            # track the gradients
-            # mse gradients
-            optimizer.zero_grad()
-            mse.backward(retain_graph=True) # source: https://stackoverflow.com/questions/46774641/what-does-the-parameter-retain-graph-mean-in-the-variables-backward-method
-            mse_grads.extend(write_gradient_stats(model))
-
-            # spst grads
-            optimizer.zero_grad()
-            spst.backward(retain_graph=True)
-            spst_grads.extend(write_gradient_stats(model))
-
-            # Backward pass for KL divergence loss
-            optimizer.zero_grad()
-            kld.backward(retain_graph=True)  # No need to retain graph here, unless you have more loss components.
-            kld_grads.extend(write_gradient_stats(model))
-        
         optimizer.zero_grad()
         loss.backward()
         optimizer.step()
 
-        losses.append(loss_values)
-        # show information
+        losses.update(criterion.per_sample_terms((mse, content, style, spst, kld), (a_mse, a_content, a_style, a_spst, beta), X.size(0)), X.size(0))
+        # show information, the running mean loss of the previous log interval so the step does not wait for it
         if (batch_idx + 1) % log_interval == 0:
-            print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
-                epoch + 1, N_count, len(train_loader.dataset), 100. * (batch_idx + 1) / len(train_loader), loss.item()))
+            window = losses.log_window()
+            if window is not None:
+                print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
+                    epoch + 1, N_count, len(train_loader.dataset), 100. * (batch_idx + 1) / num_batches, window[-1]))
+
+        if step_checkpoint is not None and step_checkpoint.due(batch_idx + 1) and not last_batch:
+            step_checkpoint(batch_idx + 1, losses)
         
         if testing and batch_idx > 1:
             break
 
-    losses = np.array(losses)
-    losses = losses.mean(axis=0)
+    losses = losses.mean()
 
-    mse_grads = np.stack(mse_grads, axis=0)
-    spst_grads = np.stack(spst_grads, axis=0)
-    kld_grads = np.stack(kld_grads, axis=0)
+    grad_stats = {}
+    if diagnostics is not None:
+        diagnostics.measure_params('Total')
+        grad_stats = diagnostics.summary()
 
-    return X.data.cpu().numpy(), y.data.cpu().numpy(), z.data.cpu().numpy(), mu.data.cpu().numpy(), logvar.data.cpu().numpy(), losses, input_autocorr, recon_autocorr, mse_grads, spst_grads, kld_grads
+    return X.data.cpu().numpy(), y.data.cpu().numpy(), z.data.cpu().numpy(), mu.data.cpu().numpy(), logvar.data.cpu().numpy(), losses, input_autocorr, recon_autocorr, grad_stats
 
 
-def validation(model, criterion, device, test_loader, a_mse, a_content, a_style, a_spst, beta, testing):
+def validation(model, criterion, device, test_loader, a_mse, a_content, a_style, a_spst, beta, testing, log_autocorrs=True, model_precision='float32'):
     # set model as testing mode
     model.eval()
-    losses = []
+    losses = LossAccumulator(6, device)
     with torch.no_grad():
-        for batch_idx, (X, y) in enumerate(test_loader):
+        for batch_idx, ((X, y, *extra), is_last) in enumerate(mark_last(test_loader)):
             # distribute data to device
-            X, y = X.to(device), y.to(device).view(-1, )
-            X_reconst, z, mu, logvar = model(X)
-
-            mse, content, style, spst, kld, loss, input_autocorr, recon_autocorr = criterion(X, X_reconst, mu, logvar, a_mse, a_content, a_style, a_spst, beta)
-            loss_values = (mse.item(), content.item(), style.item(), spst.item(), kld.item(), loss.item())
-            losses.append(loss_values)
+            X, y = X.to(device, non_blocking=True), y.to(device, non_blocking=True).view(-1, )
+            X_idx = extra[0] if extra else None
+            features = extra[1].to(device, non_blocking=True) if len(extra) > 1 else None
+            last_batch = is_last or (testing and batch_idx > 1)
+            X_reconst, z, mu, logvar = run_model(model, X, device, model_precision, features)
+
+            mse, content, style, spst, kld, loss, input_autocorr, recon_autocorr = criterion(X, X_reconst, mu, logvar, a_mse, a_content, a_style, a_spst, beta, x_idx=X_idx, return_autocorrs=log_autocorrs and last_batch)
+            losses.update(criterion.per_sample_terms((mse, content, style, spst, kld), (a_mse, a_content, a_style, a_spst, beta), X.size(0)), X.size(0))
             
             if testing and batch_idx > 1:
                 break
 
-    losses = np.array(losses)        
-    losses = losses.mean(axis=0)
+    losses = losses.mean()
 
     # show information
     print('\nTest set ({:d} samples): Average loss: {:.4f}\n'.format(len(test_loader.dataset), losses[-1]))
     return X.data.cpu().numpy(), y.data.cpu().numpy(), z.data.cpu().numpy(), mu.data.cpu().numpy(), logvar.data.cpu().numpy(), losses, input_autocorr, recon_autocorr
 
 
-def decoder(model, device, z):
+def decoder(model, device, z, model_precision='float32'):
     """
     To be used only during evaluation
     """
     model.eval()
     
     z = torch.from_numpy(z).to(device)
-    new_images_torch = model.decode(z).data.cpu()
+    with model_autocast(device, model_precision):
+        new_images_torch = model.decode(z).data.float().cpu()
     return new_images_torch
 
 
@@ -227,7 +389,7 @@ def normalize(tensor, eps=1e-6):
     return tensor
 
 
-def generate_from_noise(model, device, num_imgs, two_pt_autocorr_func):
+def generate_from_noise(model, device, num_imgs, two_pt_autocorr_func, model_precision='float32'):
     """
     To be used to evaluate the model's decoding ability.
     To only be used during evaluation.
@@ -235,7 +397,7 @@ def generate_from_noise(model, device, num_imgs, two_pt_autocorr_func):
     generated_images = []
     for _ in range(num_imgs):
         zz = np.random.normal(0, 1, size=(1, model.CNN_embed_dim)).astype(np.float32)
-        img = decoder(model, device, zz)
+        img = decoder(model, device, zz, model_precision)
         img_autocorr = two_pt_autocorr_func(img)
         img, img_autocorr = img.squeeze(1), img_autocorr.squeeze(1)
         img = normalize(img)
@@ -260,24 +422,25 @@ def seed_everything(seed: int):
     torch.cuda.manual_seed(seed)
 
 
-def write_gradient_stats(model):
-    total_grads = []
-    for name, param in model.named_parameters():
-        if param.requires_grad and param.grad is not None:
-            grad_data = param.grad.cpu().clone().view(-1).numpy()
-            total_grads.extend(grad_data)
+def read_pixel_statistics(file_path):
+    """
+    Reads the 'name: value' lines written by transform_to_autocorrs.py into a dict.
+    """
+    with open(file_path, 'r') as file:
+        return {name: float(value) for name, value in (line.strip().split(': ') for line in file if ': ' in line)}
 
-    return np.stack(total_grads, axis=0)
 
 def read_pixel_values(file_path):
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
-        min_pixel_value = float(lines[1].strip().split(': ')[1])
-        max_pixel_value = float(lines[0].strip().split(': ')[1])
-    return min_pixel_value, max_pixel_value
+    statistics = read_pixel_statistics(file_path)
+    return statistics['Min pixel value'], statistics['Max pixel value']
 
 
-def reconstruct_images(vae_model, data_loader, device, num_examples=100):
+def reconstruct_images(vae_model, data_loader, device, num_examples=100, autocorr_store=None, model_precision='float32'):
+    """
+    autocorr_store: AutocorrelationStore of the dataset to read the original autocorrelations from instead of
+    computing them. The data_loader should then yield (X, y, idx), see utils.IndexedDataset.
+    model_precision: 'float32' or 'bfloat16', see model_autocast
+    """
     vae_model.eval()  # Set the model to evaluation mode
     reconstructed_images = []
     original_images = []
@@ -286,28 +449,31 @@ def reconstruct_images(vae_model, data_loader, device, num_examples=100):
     autocorrelation = TwoPointAutocorrelation()
 
     with torch.no_grad():
-        for batch_idx, (X, _) in enumerate(data_loader):
+        for batch_idx, (X, *rest) in enumerate(data_loader):
             # Move the input to the device
             X = X.to(device)
             
-            # Perform the reconstruction
-            X_reconst, _, _, _ = vae_model(X)
+            # Perform the reconstruction, from the cached backbone features if the loader yields them
+            features = rest[2].to(device) if len(rest) > 2 else None
+            X_reconst, _, _, _ = run_model(vae_model, X, device, model_precision, features)
 
             # Collect original and reconstructed images
             original_images.append(X.cpu())
             reconstructed_images.append(X_reconst.cpu())
 
             # Collect original and reconstructed autocorrelations
-            for i in range(len(X)):
-                original_autocorrs.append(autocorrelation.forward(X.cpu()[i]))
-                reconstruct_autocorrs.append(autocorrelation.forward(X_reconst.cpu()[i]))
+            if autocorr_store is not None:
+                original_autocorrs.append(autocorr_store[rest[1]])
+            else:
+                original_autocorrs.append(autocorrelation.batch_forward(X.cpu()))
+            reconstruct_autocorrs.append(autocorrelation.batch_forward(X_reconst.cpu()))
 
-            if len(reconstructed_images) * data_loader.batch_size >= num_examples:
+            if sum(len(images) for images in reconstructed_images) >= num_examples:
                 break
 
     # Convert the list of batches into a single tensor
     original_images = torch.cat(original_images, dim=0)
     reconstructed_images = torch.cat(reconstructed_images, dim=0)
-    original_autocorrs = torch.cat(original_autocorrs, dim=0).unsqueeze(1)
-    reconstruct_autocorrs = torch.cat(reconstruct_autocorrs, dim=0).unsqueeze(1)
+    original_autocorrs = torch.cat(original_autocorrs, dim=0)
+    reconstruct_autocorrs = torch.cat(reconstruct_autocorrs, dim=0)
     return original_images[:num_examples], reconstructed_images[:num_examples], original_autocorrs[:num_examples], reconstruct_autocorrs[:num_examples]
\ No newline at end of file
@@ -1,96 +1,185 @@
+"""
+Computes the statistics of the two-point autocorrelations of a dataset, the normalization constants
+of the spatial stats loss.
+
+The DataLoader workers preprocess their batch, compute its autocorrelations and reduce them to an
+AutocorrStatistics (count, min, max, Welford mean / variance and a fixed-bin histogram). The main
+process only merges these, which is associative, so the work splits over any number of workers.
+
+Run from the repository root:
+    python src/models/transform_to_autocorrs.py lines
+
+The statistics are written to data/<dataset>/pixel_values.txt, readable by training_utils.read_pixel_values,
+and the histogram to data/<dataset>/autocorr_histogram.npz. The per-image autocorrelations are also kept
+in the memory-mapped store data/<dataset>/autocorr_store (see autocorr_store.py), where later runs only
+add the images that are new or changed.
+"""
 import os
 import sys
-import torch
-from torchvision import transforms
-from PIL import Image
+import time
+import argparse
+
 import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
 from shapes_dataset import ShapesDataset
 from lines_dataset import LinesDataset
-from utils import ThresholdTransform
-from tqdm import tqdm
-from torchvision.transforms.functional import to_pil_image
+from preprocessing import BatchPreprocess, image_transform
 from spatial_statistics_loss import TwoPointAutocorrelation
-from PIL import Image
-from torchvision.transforms.functional import to_pil_image
-from PIL import Image
-import torch
-from tqdm import tqdm
+from autocorr_store import update_autocorr_store
+
 
 def normalize(image_np, min_pixel_value, max_pixel_value):
     normalized_image = 255 * (image_np - min_pixel_value) / (max_pixel_value - min_pixel_value)
     normalized_image = normalized_image.clip(0, 255).astype(np.uint8)
     return normalized_image
 
-def transform_and_save(dataset, transform, save_dir):
-    max_pixel_value = -np.inf
-    min_pixel_value = np.inf
-    autocorrelation = TwoPointAutocorrelation()
-    for idx, (image_data, _) in tqdm(enumerate(dataset), total=len(dataset)):
-        if isinstance(image_data, str):
-            image = Image.open(image_data)
-        else:
-            image = image_data
-
-        transformed_image = transform(image)
-        transformed_image = autocorrelation.forward(transformed_image)
-
-        if transformed_image.dim() == 3 and transformed_image.shape[0] == 1:  # If single channel image
-            transformed_image = transformed_image.squeeze(0)
 
-        transformed_image_np = transformed_image.numpy()
+class AutocorrStatistics(object):
+    # the phase 0 autocorrelation of a binary image is a probability, up to FFT round-off
+    VALUE_RANGE = (0.0, 1.0)
+    NUM_BINS = 2**16
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, min_value=np.inf, max_value=-np.inf, histogram=None):
+        """
+        Streaming statistics of a set of values.
+
+        count, mean: number and mean of the values
+        m2: sum of the squared deviations from the mean (Welford)
+        histogram: counts of the values in NUM_BINS equal bins of VALUE_RANGE, the values outside are
+        counted in the first / last bin
+        """
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.min_value = min_value
+        self.max_value = max_value
+        self.histogram = np.zeros(self.NUM_BINS, dtype=np.int64) if histogram is None else histogram
+
+    @classmethod
+    def from_tensor(cls, values):
+        values = values.detach().flatten()
+        # two passes in the input precision with float64 accumulation, cheaper than casting the values
+        mean = values.sum(dtype=torch.float64) / values.numel()
+        m2 = ((values - mean.to(values.dtype))**2).sum(dtype=torch.float64)
+        min_value, max_value = torch.aminmax(values)
+        low, high = cls.VALUE_RANGE
+        histogram = torch.histc(values.clamp(low, high), bins=cls.NUM_BINS, min=low, max=high).long().numpy()
+        return cls(values.numel(), mean.item(), m2.item(), min_value.item(), max_value.item(), histogram)
+
+    def merge(self, other):
+        """
+        Combines the statistics of two disjoint sets of values (Chan et al.'s pairwise update).
+        """
+        count = self.count + other.count
+        if count == 0:
+            return AutocorrStatistics()
+        delta = other.mean - self.mean
+        mean = self.mean + delta * other.count / count
+        m2 = self.m2 + other.m2 + delta**2 * self.count * other.count / count
+        return AutocorrStatistics(count, mean, m2, min(self.min_value, other.min_value), max(self.max_value, other.max_value), self.histogram + other.histogram)
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else float('nan')
+
+    def quantile(self, q):
+        """
+        Approximate q-quantile, linearly interpolated within its histogram bin.
+        """
+        low, high = self.VALUE_RANGE
+        cumulative = np.cumsum(self.histogram)
+        target = q * self.count
+        b = int(np.searchsorted(cumulative, target))
+        before = cumulative[b - 1] if b > 0 else 0
+        fraction = (target - before) / max(self.histogram[b], 1)
+        value = low + (b + fraction) * (high - low) / self.NUM_BINS
+        return float(np.clip(value, self.min_value, self.max_value))
+
+
+class AutocorrStatisticsCollate(object):
+    def __init__(self, preprocess):
+        """
+        collate_fn that reduces a batch of raw samples to the AutocorrStatistics of their autocorrelations,
+        so this work runs in the DataLoader workers.
+        """
+        self.preprocess = preprocess
+        self.autocorrelation = TwoPointAutocorrelation()
+
+    def __call__(self, samples):
+        images, *_ = self.preprocess.collate(samples)
+        return AutocorrStatistics.from_tensor(self.autocorrelation.batch_forward(images))
+
+
+def compute_autocorr_statistics(dataset, preprocess, batch_size=64, num_workers=4):
+    """
+    dataset: Dataset yielding (uint8 image, label), see preprocessing.image_transform
+    preprocess: the BatchPreprocess the images are read with
+
+    Returns: AutocorrStatistics of the autocorrelations of all the images
+    """
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=AutocorrStatisticsCollate(preprocess))
+    stats = AutocorrStatistics()
+    for batch_stats in tqdm(loader, total=len(loader)):
+        stats = stats.merge(batch_stats)
+    return stats
+
+
+def write_pixel_values(stats, file_path, quantiles=(0.001, 0.01, 0.5, 0.99, 0.999)):
+    """
+    Writes the statistics as 'name: value' lines, max and min first as read_pixel_values expects.
+    """
+    with open(file_path, 'w') as f:
+        f.write(f"Max pixel value: {stats.max_value}\n")
+        f.write(f"Min pixel value: {stats.min_value}\n")
+        f.write(f"Mean pixel value: {stats.mean}\n")
+        f.write(f"Std pixel value: {np.sqrt(stats.variance)}\n")
+        f.write(f"Pixel count: {stats.count}\n")
+        for q in quantiles:
+            f.write(f"Quantile {q}: {stats.quantile(q)}\n")
 
-        # Update the max and min values
-        image_max_pixel_value = transformed_image_np.max()
-        image_min_pixel_value = transformed_image_np.min()
-        max_pixel_value = max(max_pixel_value, image_max_pixel_value)
-        min_pixel_value = min(min_pixel_value, image_min_pixel_value)
-
-        # Normalize and convert back to PIL Image for saving
-        #normalized_image_np = normalize(transformed_image_np, image_min_pixel_value, image_max_pixel_value)
-        #normalized_image = Image.fromarray(normalized_image_np)
-        #normalized_image.save(os.path.join(save_dir, f'autocorr_image_{idx}.png'))
-
-    return max_pixel_value, min_pixel_value
 
 def main():
-    if len(sys.argv) != 2:
-        dataset_name = 'lines'
-    else:
-        dataset_name = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Compute the autocorrelation statistics and store of a dataset.")
+    parser.add_argument('dataset_name', type=str, nargs='?', default='lines', help="lines, multiple_lines or shapes")
+    parser.add_argument('--store_dtype', type=str, default='float16', help="float16 or float32, dtype of the autocorrelation store.")
+    parser.add_argument('--no_store', action='store_true', help="Only compute the statistics.")
+    args = parser.parse_args()
+    dataset_name = args.dataset_name
 
-    
     res_size = 224
-    transform = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize((0.5,), (0.5,)), 
-        transforms.Resize([res_size, res_size], antialias=True),
-        ThresholdTransform(thr_255=240),
-    ])
+    preprocess = BatchPreprocess(res_size=res_size, thr_255=240)
 
     if dataset_name == 'lines':
         data_dir = 'lines'
-        dataset = LinesDataset(os.path.join(os.getcwd(), f'data/{data_dir}/labels.csv'), os.path.join(os.getcwd(), f'data/{data_dir}/images'))
+        dataset = LinesDataset(os.path.join(os.getcwd(), f'data/{data_dir}/labels.csv'), os.path.join(os.getcwd(), f'data/{data_dir}/images'), image_transform())
     elif dataset_name == 'shapes':
         data_dir = 'shapes'
-        dataset = ShapesDataset(os.path.join(os.getcwd(), f'data/{data_dir}/labels.csv'), os.path.join(os.getcwd(), f'data/{data_dir}/images'))
+        dataset = ShapesDataset(os.path.join(os.getcwd(), f'data/{data_dir}/labels.csv'), os.path.join(os.getcwd(), f'data/{data_dir}/images'), image_transform())
     elif dataset_name == 'multiple_lines':
         data_dir = 'multiple_lines'
-        dataset = LinesDataset(os.path.join(os.getcwd(), f'data/{data_dir}/labels.csv'), os.path.join(os.getcwd(), f'data/{data_dir}/images'))
+        dataset = LinesDataset(os.path.join(os.getcwd(), f'data/{data_dir}/labels.csv'), os.path.join(os.getcwd(), f'data/{data_dir}/images'), image_transform())
     else:
         print(f"Dataset {dataset_name} not recognized.")
         sys.exit(1)
 
-    save_dir = os.path.join(os.getcwd(), f'data/{data_dir}/2pt_autocorr_images')
-    os.makedirs(save_dir, exist_ok=True)
+    start = time.time()
+    stats = compute_autocorr_statistics(dataset, preprocess)
 
-    max_pixel_value, min_pixel_value = transform_and_save(dataset, transform, save_dir)
+    save_dir = os.path.join(os.getcwd(), f'data/{data_dir}')
+    write_pixel_values(stats, os.path.join(save_dir, 'pixel_values.txt'))
+    low, high = AutocorrStatistics.VALUE_RANGE
+    np.savez(os.path.join(save_dir, 'autocorr_histogram.npz'), counts=stats.histogram, bin_edges=np.linspace(low, high, AutocorrStatistics.NUM_BINS + 1))
 
-    with open(os.path.join(os.path.join(os.getcwd(), f'data/{data_dir}'), 'pixel_values.txt'), 'w') as f:
-        f.write(f"Max pixel value: {max_pixel_value}\n")
-        f.write(f"Min pixel value: {min_pixel_value}\n")
+    print(f"Statistics of {stats.count} autocorrelation values computed in {time.time() - start:.1f} s")
+    print(f"Statistics saved in {save_dir}/pixel_values.txt and {save_dir}/autocorr_histogram.npz")
 
-    print(f"Transformed images saved in {save_dir}")
-    print(f"Max and Min pixel values saved in {save_dir}/pixel_values.txt")
+    if not args.no_store:
+        store_dir = os.path.join(save_dir, 'autocorr_store')
+        num_computed = update_autocorr_store(dataset, os.path.join(save_dir, 'labels.csv'), os.path.join(save_dir, 'images'), store_dir, preprocess, dtype=args.store_dtype)
+        print(f"Autocorrelation store {store_dir} up to date, {num_computed} of {len(dataset)} autocorrelations computed")
 
 if __name__ == "__main__":
     main()
@@ -2,6 +2,7 @@ import os
 
 import torch
 import torch.nn as nn
+from torch.utils.data import Dataset, Sampler
 
 import matplotlib.pyplot as plt
 
@@ -28,12 +29,71 @@ class ThresholdTransform(object):
     def __call__(self, x):
         return (x > self.thr).to(x.dtype)  # do not change the data type
 
+    def __repr__(self):
+        # part of the packed dataset cache hash, so it should not depend on the object address
+        return f"{self.__class__.__name__}(thr={self.thr})"
+
+
+class IndexedDataset(Dataset):
+    """
+    Wraps a dataset so that every sample also returns its index in the wrapped dataset.
+    Wrap the full dataset before random_split so the indices are stable across the splits.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        image, label = self.dataset[idx]
+        return image, label, idx
+
+
+class ResumableRandomSampler(Sampler):
+    """
+    Shuffles like RandomSampler, but the order of an epoch only depends on seed and the epoch, and an epoch
+    can start at any position. Resuming an interrupted epoch then skips the samples it already consumed
+    without loading them.
+
+    With num_replicas > 1 it shards every epoch like DistributedSampler: the permutation is padded with its
+    first samples to a multiple of num_replicas and rank takes every num_replicas-th sample from rank on.
+    """
+    def __init__(self, data_source, seed=0, num_replicas=1, rank=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = -(-len(data_source) // num_replicas)  # per replica
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        """Call it before every epoch, it also starts the epoch from its first sample."""
+        self.epoch = epoch
+        self.start = 0
+
+    def set_start(self, start):
+        """Skips the first start samples (of this replica) of the current epoch."""
+        self.start = start
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed * 1000003 + self.epoch)
+        indices = torch.randperm(len(self.data_source), generator=generator)
+        if self.num_replicas > 1:
+            padding = self.num_samples * self.num_replicas - len(indices)
+            indices = torch.cat([indices, indices[:padding]])[self.rank::self.num_replicas]
+        return iter(indices[self.start:].tolist())
+
 
 def show_tensor(t):
     plt.figure()
     plt.imshow(t.permute(1, 2, 0))
 
 def check_mkdir(dir_name):
-    if not os.path.exists(dir_name):
-        os.mkdir(dir_name)
+    # with its parents, e.g. models/ for the run directories in a fresh working directory
+    os.makedirs(dir_name, exist_ok=True)
     
\ No newline at end of file
@@ -1,11 +1,13 @@
 import os
 import time
+import contextlib
 import argparse
 import wandb
 import numpy as np
 import torch
-from torchvision import transforms
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 from torchvision.utils import make_grid
 
 from resnet_vae import ResNet_VAE
@@ -15,200 +17,495 @@ import sys
 sys.path.insert(1, '../data')
 from shapes_dataset import ShapesDataset
 from lines_dataset import LinesDataset
-from utils import ThresholdTransform, check_mkdir
-from training_utils import train, validation, MaterialSimilarityLoss, ExponentialScheduler, LossCoefficientScheduler, learning_rate_switcher, get_learning_rate, change_learning_rate, seed_everything, generate_from_noise, write_gradient_stats, read_pixel_values, reconstruct_images
+from utils import IndexedDataset, ResumableRandomSampler, check_mkdir
+from preprocessing import BatchPreprocess, image_transform
+from packed_dataset import load_packed_dataset, source_hash
+from feature_cache import load_feature_cache, FeatureCacheDataset
+from microstructure_generator import MicrostructureGenerator, MicrostructureDataset
+from sharded_dataset import ShardedDataset, split_shards
+from gradient_diagnostics import GradientDiagnostics
+from compiled_execution import prepare_compiled_training
+from distributed import init_distributed, main_process_first, gather_per_rank, select_rank
+from ensemble import ModelEnsemble, train_ensemble, validation_ensemble
+from checkpoint_manager import CheckpointManager, StepCheckpoint, rng_state, set_rng_state
+from spatial_stats_descriptors import build_descriptor
+from training_utils import train, validation, LossAccumulator, MaterialSimilarityLoss, ExponentialScheduler, LossCoefficientScheduler, learning_rate_switcher, get_learning_rate, change_learning_rate, seed_everything, generate_from_noise, read_pixel_values, reconstruct_images
 
 def run_training(epochs, a_mse, a_content, a_style, a_spst, beta, 
                 content_layer, style_layer, 
                 learning_rate=1e-3, fine_tune_lr=0.0005, 
-                spatial_stat_loss_reduction='mean', normalize_spatial_stat_tensors=False, soft_equality_eps=0.25,
-                batch_size=32, CNN_embed_dim=256, dropout_p=0.2, 
-                log_interval=2, save_interval=20, resume_training=False, last_epoch=0, 
+                spatial_stat_loss_reduction='mean', normalize_spatial_stat_tensors=False, soft_equality_eps=0.25, spatial_stat_precision='float64', spatial_stat_loss_domain='spatial',
+                spatial_stat_lag_radius=None, spatial_stat_lag_algorithm='auto', spatial_stat_phase_pair_weights=None,
+                spatial_stat_descriptor=None, spatial_stat_descriptor_components=None, spatial_stat_fused=False,
+                batch_size=32, CNN_embed_dim=256, dropout_p=0.2, encoder_backbone='resnet152', encoder_backbone_kwargs=None,
+                log_interval=2, save_interval=20, resume_training=False, last_epoch=0, keep_last_checkpoints=3, keep_best_checkpoints=1, checkpoint_every_n_steps=None,
                 schedule_KLD=False, schedule_spst=False, 
-                dataset_name='shapes',
+                dataset_name='shapes', packed_dataset_cache=False,
+                procedural_data=False, procedural_batches_per_epoch=100, procedural_generator_kwargs=None, sharded_data=False,
+                autocorr_cache=None, autocorr_cache_max_mb=2048, model_precision='float32',
+                compiled_execution=False, compile_mode=None, distributed=False,
+                backbone_feature_cache=False,
+                gradient_diagnostics_every=None,
                 debugging=False,
-                seed=110):
-    
-    seed_everything(seed)
-    
-    save_dir = os.path.join(os.getcwd(), "models")
-    run_name = "resnetVAE_" + f"lr{learning_rate}" + f"bs{batch_size}" +\
-                f"_a_spst_{a_spst}" + f"_KLD_beta_{beta}"+\
-                f"_spst_reduction_loss_{spatial_stat_loss_reduction}" +\
-                f"_KLD_scheduled_{schedule_KLD}" + f"_spatial_stats_loss_scheduled_{schedule_spst}" +\
-                f"_bottleneck_size_{CNN_embed_dim}" +\
-                f"_dataset_name_{dataset_name}" +\
-                f"_seed_{seed}"
-    
-    save_model_path = os.path.join(save_dir, run_name)
-    check_mkdir(save_model_path)    
-
-    # alternatively, you could save in W&B but depending on the network speed, uploading the models can be slow.
-    #save_model_path = wandb.run.dir
-
-    # Detect devices
-    use_cuda = torch.cuda.is_available()   
-    device = torch.device("cuda" if use_cuda else "cpu")
-    if use_cuda:
-        print("Using", torch.cuda.device_count(), "GPU!")
-    else:
-        print("Training on CPU!")
-
-    # Load Data
-    res_size = 224
-    # Define the transformation to apply to the data
-    transform = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize((0.5,), (0.5,)), 
-        transforms.Resize([res_size, res_size], antialias=True),
-        ThresholdTransform(thr_255=240),
-    ])
-
-    # Initialize your Dataset
-    #dataset = CustomDataset('labels.csv', 'images', transformations)
-    if dataset_name=='lines':
-        data_dir = 'lines'
-        dataset = LinesDataset(os.path.join(os.getcwd(), f'data/{data_dir}/labels.csv'), os.path.join(os.getcwd(), f'data/{data_dir}/images'), transform)
-    elif dataset_name=='shapes':
-        data_dir = 'shapes'
-        dataset = ShapesDataset(os.path.join(os.getcwd(), f'data/{data_dir}/labels.csv'), os.path.join(os.getcwd(), f'data/{data_dir}/images'), transform)
-    train_dataset, valid_dataset = torch.utils.data.random_split(dataset, [int(len(dataset)*0.7), int(len(dataset)) - int(len(dataset)*0.7)])
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=4)
-    valid_loader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=False)
-
-    file_path = os.path.join(os.getcwd(), f'data/{data_dir}/pixel_values.txt')
-    min_fft_pixel_value, max_fft_pixel_value = read_pixel_values(file_path)
-
-    # EncoderCNN architecture
-    CNN_fc_hidden1, CNN_fc_hidden2 = 1024, 1024
-    # Build model
-    vae = ResNet_VAE(fc_hidden1=CNN_fc_hidden1, fc_hidden2=CNN_fc_hidden2, drop_p=dropout_p, CNN_embed_dim=CNN_embed_dim, device=device).to(device)
-    vae.resnet.requires_grad_(False)
-
-    #vae = SmallVAE(bottleneck_size=CNN_embed_dim).to(device)
-
-    wandb.watch(vae)
-    model_params = list(vae.parameters())
-    optimizer = torch.optim.Adam(model_params, lr=learning_rate)
-    beta_scheduler = ExponentialScheduler(start=0.005, max_val=beta, epochs=epochs) # start = 256/(224*224) = (latent space dim)/(input dim)
-    loss_function = MaterialSimilarityLoss(
-        device, 
-        min_fft_pixel_value, max_fft_pixel_value,
-        content_layer=content_layer, style_layer=style_layer, 
-        spatial_stat_loss_reduction=spatial_stat_loss_reduction, normalize_spatial_stat_tensors=normalize_spatial_stat_tensors, soft_equality_eps=soft_equality_eps
-        )
-    a_spst_scheduler = LossCoefficientScheduler(a_spst, epochs, mode="sigmoid")
-
-    print({
-        "seed": seed,
-        "run_name": run_name, 
-        #"content_layer_coeffs": loss_function.content_layer_coefficients,
-        #"style_layer_coeffs": loss_function.style_layer_coefficients,
-        })
-    
-    if resume_training:
-        assert last_epoch != None
-        vae.load_state_dict(torch.load(os.path.join(save_model_path,f'model_epoch{last_epoch}.pth')))
-        optimizer.load_state_dict(torch.load(os.path.join(save_model_path,f'optimizer_epoch{last_epoch}.pth')))
-        print("Resuming pretrained model...")
-    else:
-        last_epoch = 0
-
-
-    #start training
-    print("Started training.")
-    for epoch in range(last_epoch, epochs):
-        # schedule the learning rate
-        if epoch > int(epochs*0.9):
-            optimizer = change_learning_rate(optimizer, fine_tune_lr)
-        
-        # schedule beta
-        if schedule_KLD:
-            beta = beta_scheduler.get_beta(epoch)
+                seed=110, ensemble_seeds=None, epoch_callback=None):
+    """
+    resume_training (bool): Resume from the checkpoint of epoch last_epoch in the run directory, the latest one if
+    last_epoch is 0: model, optimizer, loss coefficient schedule, RNG states and train / validation split.
+    With last_epoch 0 it resumes from the step checkpoint instead when that one is more recent.
+    keep_last_checkpoints (int), keep_best_checkpoints (int): Every save_interval epochs a checkpoint is written in
+    the background (see checkpoint_manager.py). The last keep_last_checkpoints (None for all) and the
+    keep_best_checkpoints with the lowest validation loss are kept, the others deleted.
+    checkpoint_every_n_steps (int): Also checkpoint every checkpoint_every_n_steps training batches within the epochs
+    (None for never) to step_checkpoint.pt, overwritten every time: the position of the shuffled training set, the
+    accumulated epoch losses and the rest of the training state. Resuming skips the batches already trained on
+    without loading them. Not for the streamed datasets.
+    encoder_backbone (str): Encoder backbone of the VAE, one of backbones.BACKBONES: 'resnet18', 'resnet34', 'resnet50',
+    'resnet152', 'truncated_resnet' (options depth and num_stages in encoder_backbone_kwargs) or 'small_vae'.
+    Pretrained backbones are frozen, small_vae is trained. See backbone_benchmark.py for their cost.
+    model_precision (str): 'float32' or 'bfloat16'. With 'bfloat16' the convolutions and linear layers of the VAE
+    run under bfloat16 autocast (training, validation and reconstructions), while the losses, the KLD included,
+    are computed in float32 and the spatial stats FFTs in spatial_stat_precision. See precision_benchmark.py.
+    compiled_execution (bool): Train the model in the channels-last memory format, with its forward, the loss terms
+    and their backward compiled by torch.compile (compile_mode, e.g. 'max-autotune'), see compiled_execution.py.
+    The compilation runs on a warm-up batch before the first epoch and is logged as compile_seconds, apart from
+    the epoch times. Falls back to eager channels-last execution when torch.compile is unavailable. Worth it
+    for long runs.
+    packed_dataset_cache (bool): Read the images from the bit-packed cache in data/<dataset>/packed (see packed_dataset.py)
+    instead of decoding and transforming the PNGs every epoch. The cache is written next to the data and (re)built
+    when the sources change (their names, sizes or modification times) or the preprocessing does.
+    procedural_data (bool): Generate the images on the fly with the MicrostructureGenerator preset of dataset_name
+    (see microstructure_generator.py, procedural_generator_kwargs overrides the preset) instead of reading the PNGs:
+    procedural_batches_per_epoch new training batches every epoch and a fixed validation set of 30% as many batches.
+    sharded_data (bool): Stream the images from the shards in data/<dataset>/shards (written with sharded_dataset.py),
+    70% of the shards for training and the rest for validation.
+    backbone_feature_cache (bool): Freeze the backbone (expand_channels and the ResNet, which then stays in eval
+    mode, BatchNorm running statistics included) and compute its features once per dataset into
+    data/<dataset>/backbone_features (see feature_cache.py), so every epoch only runs the heads and the decoder.
+    Unlike the default, expand_channels is not trained and the ResNet BatchNorms do not use batch statistics.
+    Raises a ValueError with a backbone trained from scratch (small_vae), which there is no point in freezing.
+    The cache is rebuilt when the images, the preprocessing or the backbone weights change.
+    gradient_diagnostics_every (int): Log the gradient norm, mean absolute value and std of the mse, spst and kl
+    terms, per top-level module of the trainable heads, every gradient_diagnostics_every batches (None for the
+    first batch of every epoch, 0 to turn them off).
+    autocorr_cache (str): None, 'lazy' or 'precompute'. Caches the autocorrelations of the dataset images
+    by dataset index so the spatial stats loss only FFTs the reconstructions. 'lazy' fills the cache during
+    the first epoch, 'precompute' fills it before training. autocorr_cache_max_mb caps its memory (LRU eviction).
+    spatial_stat_loss_domain (str): 'spatial' or 'frequency'. The frequency domain loss skips the inverse FFT
+    and only computes the autocorrelations on the epochs they are logged.
+    spatial_stat_lag_radius (int): Only compare the autocorrelation lags with |dy|, |dx| <= spatial_stat_lag_radius,
+    computed by direct correlation or FFT according to spatial_stat_lag_algorithm ('auto', 'direct' up to a radius of 2, or 'fft').
+    spatial_stat_phase_pair_weights (list): e.g. [[1, 0.5], [0.5, 1]], compare every phase pair auto/cross
+    correlation with these weights instead of the phase 0 autocorrelation only.
+    spatial_stat_descriptor (str): None, 'pca', 'radial' or 'angular'. Compare reduced-order descriptors of the
+    autocorrelations instead of the full maps: the top spatial_stat_descriptor_components coefficients of the
+    dataset's PCA basis (data/<dataset>/autocorr_pca.pt, fitted with spatial_stats_descriptors.py), or radially /
+    angularly averaged profiles with spatial_stat_descriptor_components bins.
+    distributed (bool): Run as one rank of a data-parallel training on the CPU (see distributed.py), launched with
+    torchrun: joins the gloo process group, trains a DistributedDataParallel replica on its shard of the training
+    set and validates on its shard of the validation set. batch_size is per rank. Rank 0 alone logs, checkpoints
+    and saves the images, the caller should init W&B with mode='disabled' on the other ranks.
+    spatial_stat_fused (bool): Compute the spatial stats loss with a fused autograd function that only keeps the
+    image spectra for its analytic backward, which roughly halves its memory. Only for the plain full-map loss.
+    ensemble_seeds (list): Train one VAE per seed at once in this process (see ensemble.py) instead of the single
+    one of seed. Requires backbone_feature_cache: the replicas share the frozen pretrained backbone of the first
+    seed, expand_channels included, and its cached features. Apart from that backbone, each replica differs from
+    a backbone_feature_cache run of its own seed only by the data: all of them train on the split and order of
+    the first seed. Every seed has its own run directory and checkpoints, and its metrics and images are logged
+    under seed_<seed>/, the losses also as their mean over the seeds without prefix. Not for resuming, nor with
+    the step checkpoints, the gradient diagnostics, compiled_execution or distributed.
+    epoch_callback (callable): Called as epoch_callback(epochs_done, metrics) with the metrics logged after every
+    epoch. The training stops at the end of the epoch when it returns True, e.g. a trial local_sweep.py terminates early.
+    """
+    assert autocorr_cache in [None, 'lazy', 'precompute'], "autocorr_cache should be None, 'lazy' or 'precompute'"
+    assert not ((procedural_data or sharded_data) and autocorr_cache is not None), "Streamed data has no dataset indices to cache autocorrelations by"
+    assert not ((procedural_data or sharded_data) and backbone_feature_cache), "Streamed data has no dataset indices to cache backbone features by"
+    assert not ((procedural_data or sharded_data) and checkpoint_every_n_steps), "Step checkpoints need a map-style dataset to resume the epoch's order from"
+    assert not ((procedural_data or sharded_data) and distributed), "Streamed data has no dataset indices to shard over the ranks"
+    assert not (compiled_execution and distributed), "compiled_execution is not supported with distributed"
+    assert not (ensemble_seeds and (resume_training or checkpoint_every_n_steps or compiled_execution or distributed)), \
+        "ensemble_seeds does not support resume_training, checkpoint_every_n_steps, compiled_execution or distributed"
+    assert not ensemble_seeds or backbone_feature_cache, "ensemble_seeds shares the frozen backbone of backbone_feature_cache, set it too"
+
+    rank, world_size = init_distributed() if distributed else (0, 1)
+    main_process = rank == 0
+    with contextlib.ExitStack() as stack:
+        if not main_process:
+            # rank 0 prints the progress
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+
+        # the seeds of the trained models, the first one seeds the data
+        seeds = list(ensemble_seeds) if ensemble_seeds else [seed]
+        seed = seeds[0]
+        seed_everything(seed)
+
+        save_dir = os.path.join(os.getcwd(), "models")
+        run_names, member_checkpoints = [], []
+        for member_seed in seeds:
+            run_name = "resnetVAE_" + f"lr{learning_rate}" + f"bs{batch_size}" +\
+                        f"_a_spst_{a_spst}" + f"_KLD_beta_{beta}"+\
+                        f"_spst_reduction_loss_{spatial_stat_loss_reduction}" +\
+                        f"_KLD_scheduled_{schedule_KLD}" + f"_spatial_stats_loss_scheduled_{schedule_spst}" +\
+                        f"_bottleneck_size_{CNN_embed_dim}" +\
+                        f"_dataset_name_{dataset_name}" +\
+                        f"_seed_{member_seed}"
+            if encoder_backbone != 'resnet152':
+                run_name += f"_backbone_{encoder_backbone}" + "".join(f"_{key}_{value}" for key, value in sorted((encoder_backbone_kwargs or {}).items()))
+            run_names.append(run_name)
+
+            save_model_path = os.path.join(save_dir, run_name)
+            with main_process_first():
+                check_mkdir(save_model_path)    
+            member_checkpoints.append(CheckpointManager(save_model_path, keep_last=keep_last_checkpoints, keep_best=keep_best_checkpoints, read_only=not main_process))
+        run_name, save_model_path, checkpoints = run_names[0], os.path.join(save_dir, run_names[0]), member_checkpoints[0]
+        # (model state, training state) of the checkpoint to resume from
+        resume_state = checkpoints.load(last_epoch or None) if resume_training else None
+
+        # alternatively, you could save in W&B but depending on the network speed, uploading the models can be slow.
+        #save_model_path = wandb.run.dir
+
+        # Detect devices
+        use_cuda = torch.cuda.is_available() and not distributed  # the data-parallel mode trains on the CPU
+        device = torch.device("cuda" if use_cuda else "cpu")
+        if use_cuda:
+            print("Using", torch.cuda.device_count(), "GPU!")
         else:
-            beta=1
-
-        # train, test model
-        start = time.time()
-        X_train, y_train, z_train, mu_train, logvar_train, training_losses, training_input_autocorr, training_recon_autocorr, mse_grads, spst_grads, kld_grads = train(log_interval, vae, loss_function, device, train_loader, optimizer, epoch, save_model_path, a_mse, a_content, a_style, a_spst, beta, debugging)
-        X_test, y_test, z_test, mu_test, logvar_test, validation_losses, validation_input_autocorr, validation_recon_autocorr = validation(vae, loss_function, device, valid_loader, a_mse, a_content, a_style, a_spst, beta, debugging)
-        mse_training_loss, content_training_loss, style_training_loss, spst_training_loss, kld_training_loss, overall_training_loss = training_losses
-        mse_loss, content_loss, style_loss, spst_loss, kld_loss, overall_loss = validation_losses
-        metrics = {
-            "mse_training_loss": mse_training_loss, 
-            "mse_validation_loss": mse_loss, 
-            "spatial_stats_training_loss": spst_training_loss,
-            "spatial_stats_validation_loss": spst_loss,
-            "KLD_training_loss": kld_training_loss,
-            "KLD_validation_loss": kld_loss,
-            "overall_training_loss": overall_training_loss,
-            "overall_validation_loss": overall_loss,
-            "mu_training": mu_train,
-            "mu_test": mu_test,
-            "logvar_train": logvar_train,
-            "logvar_test": logvar_test,
-            "alpha_mse": a_mse,
-            "alpha_spst": a_spst,
-            "KLD_beta": beta,
-            }
-        wandb.log(metrics)
-
-        # schedule the spst loss value
-        if schedule_spst:
-            a_spst = a_spst_scheduler.step()
-            a_mse = 1 - a_spst
-        
-        save_condition = True if debugging else (epoch + 1) % save_interval == 0
-        if save_condition:
-            torch.save(vae.state_dict(), os.path.join(save_model_path, 'model_epoch{}.pth'.format(epoch + 1)))  # save motion_encoder
-            torch.save(optimizer.state_dict(), os.path.join(save_model_path, 'optimizer_epoch{}.pth'.format(epoch + 1)))      # save optimizer
-            np.save(os.path.join(save_model_path, 'X_train_epoch{}.npy'.format(epoch + 1)), X_train) #save last batch
-            np.save(os.path.join(save_model_path, 'y_train_epoch{}.npy'.format(epoch + 1)), y_train)
-            np.save(os.path.join(save_model_path, 'z_train_epoch{}.npy'.format(epoch + 1)), z_train)
-            print("Data and model-optimizer params saved successfully.")
-            
-            # save 100 pairs of images
-            orig, recon, orig_autocorr, recon_autocorr = reconstruct_images(vae, valid_loader, device, num_examples=100)
-            np.save(os.path.join(save_model_path, 'original_images_epoch{}.npy'.format(epoch + 1)), orig.numpy())
-            np.save(os.path.join(save_model_path, 'reconstructed_images_epoch{}.npy'.format(epoch + 1)), recon.numpy())
-            np.save(os.path.join(save_model_path, 'original_autocorr_epoch{}.npy'.format(epoch + 1)), orig_autocorr.numpy())
-            np.save(os.path.join(save_model_path, 'reconstructed_autocorr_epoch{}.npy'.format(epoch + 1)), recon_autocorr.numpy())
-            print("Original and reconstructed images and their autocorrelations saved successfully.")
-
-            grid = generate_from_noise(vae, device, 16, loss_function.spst_loss.calculate_two_point_autocorr_pytorch)
-            imgs = wandb.Image(grid, caption="(Genearted image for validation, Genearted image autocorrelation)")
-            wandb.log({'Validation generated images from noise': imgs})
-            print("Validation images generated from noise successfully.")
-
-            # training_input_autocorr = training_input_autocorr.unsqueeze(1)
-            # training_recon_autocorr = training_recon_autocorr.unsqueeze(1)
-            training_loss_autocorr_grid = torch.cat([training_input_autocorr, training_recon_autocorr], axis=2)
-            training_loss_autocorr_grid = make_grid(training_loss_autocorr_grid, nrow=8, padding=1)
-            imgs = wandb.Image(training_loss_autocorr_grid, caption="From inside the loss function. top: training input image autocorrelation, bottom: training input reconstructed image autocorrelation")
-            wandb.log({'Training autocorr images from inside the spst loss function': imgs})
-            print("Training autocorr images from inside the spst loss function saved successfully.")
-
-            # validation_input_autocorr = validation_input_autocorr.unsqueeze(1)
-            # validation_recon_autocorr = validation_recon_autocorr.unsqueeze(1)
-            validation_loss_autocorr_grid = torch.cat([validation_input_autocorr, validation_recon_autocorr], axis=2)
-            validation_loss_autocorr_grid = make_grid(validation_loss_autocorr_grid, nrow=8, padding=1)
-            imgs = wandb.Image(validation_loss_autocorr_grid, caption="From inside the loss function. top: validation input image autocorrelation, bottom: validation input reconstructed image autocorrelation")
-            wandb.log({'Validation autocorr images from inside the spst loss function': imgs})
-            print("Validation autocorr images from inside the spst loss function saved successfully.")
-
-        # save gradient stats
-        total_grads = write_gradient_stats(vae)
-        wandb.log({'Total gradients mean': np.abs(total_grads).mean(), "Total gradients std": total_grads.std()})
-        wandb.log({'mse gradients mean': np.mean(np.abs(mse_grads)), "mse gradients std": np.std(mse_grads)})
-        wandb.log({'spst gradients mean': np.mean(np.abs(spst_grads)), "spst gradients std": np.std(spst_grads)})
-        wandb.log({'kl gradients mean': np.mean(np.abs(kld_grads)), "kl gradients std": np.std(kld_grads)})
-        print("Gradients saved successfully.")
-
-        print(f"epoch time elapsed {time.time() - start} seconds")
-        print("-------------------------------------------------")
-
-
-    print(f"Finished training for {run_name}.")
+            print("Training on CPU!")
+
+        # Load Data
+        res_size = 224
+        # the images are normalized, resized and thresholded by batch in the collate_fn of the loaders
+        preprocess = BatchPreprocess(res_size=res_size, thr_255=240)
+        collate_fn = preprocess.collate
+
+        # Initialize your Dataset
+        #dataset = CustomDataset('labels.csv', 'images', transformations)
+        if dataset_name=='lines':
+            data_dir = 'lines'
+            dataset_class = LinesDataset
+        elif dataset_name=='shapes':
+            data_dir = 'shapes'
+            dataset_class = ShapesDataset
+        elif dataset_name=='multiple_lines':
+            data_dir = 'multiple_lines'
+            dataset_class = LinesDataset
+        else:
+            raise ValueError(f"Dataset {dataset_name} not recognized, choose among 'lines', 'multiple_lines' and 'shapes'.")
+        if procedural_data:
+            generator = MicrostructureGenerator.preset(dataset_name, size=res_size, **(procedural_generator_kwargs or {}))
+            train_dataset = MicrostructureDataset(generator, batch_size, procedural_batches_per_epoch, seed=seed)
+            valid_dataset = MicrostructureDataset(generator, batch_size, max(1, int(procedural_batches_per_epoch*0.3)), seed=seed + 1)
+            train_loader = DataLoader(train_dataset, batch_size=None, num_workers=4)
+            valid_loader = DataLoader(valid_dataset, batch_size=None)
+        elif sharded_data:
+            shard_dir = os.path.join(os.getcwd(), f'data/{data_dir}/shards')
+            train_shards, valid_shards = split_shards(shard_dir, 0.7, seed=seed)
+            train_dataset = ShardedDataset(shard_dir, train_shards, shuffle=True, seed=seed)
+            valid_dataset = ShardedDataset(shard_dir, valid_shards, shuffle=False)
+            train_loader = DataLoader(train_dataset, batch_size=batch_size, num_workers=4)
+            valid_loader = DataLoader(valid_dataset, batch_size=batch_size)
+        else:
+            # the fingerprint of the images both caches are checked against
+            data_hash = None
+            if packed_dataset_cache or backbone_feature_cache:
+                data_hash = source_hash(os.path.join(os.getcwd(), f'data/{data_dir}/labels.csv'), os.path.join(os.getcwd(), f'data/{data_dir}/images'), preprocess)
+            if packed_dataset_cache:
+                with main_process_first():
+                    dataset = load_packed_dataset(dataset_class, os.path.join(os.getcwd(), f'data/{data_dir}'), preprocess, digest=data_hash)
+                collate_fn = None
+            else:
+                dataset = dataset_class(os.path.join(os.getcwd(), f'data/{data_dir}/labels.csv'), os.path.join(os.getcwd(), f'data/{data_dir}/images'), image_transform())
+            image_dataset = dataset
+            if autocorr_cache is not None:
+                dataset = IndexedDataset(dataset)
+            if resume_state is not None and resume_state[1]['split'] is not None:
+                split = resume_state[1]['split']
+                train_dataset, valid_dataset = Subset(dataset, split['train']), Subset(dataset, split['valid'])
+            else:
+                train_dataset, valid_dataset = torch.utils.data.random_split(dataset, [int(len(dataset)*0.7), int(len(dataset)) - int(len(dataset)*0.7)])
+            # the order of every epoch follows from the seed, so an interrupted epoch resumes where it stopped. Its own
+            # generator, as starting an epoch would otherwise draw the worker seeds from the global RNG before a step checkpoint
+            train_sampler = ResumableRandomSampler(train_dataset, seed=seed, num_replicas=world_size, rank=rank)
+            train_loader = DataLoader(train_dataset, batch_size=batch_size, sampler=train_sampler, num_workers=4, collate_fn=collate_fn, generator=torch.Generator().manual_seed(seed))
+            valid_sampler = DistributedSampler(valid_dataset, world_size, rank, shuffle=False) if distributed else None
+            valid_loader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=False, sampler=valid_sampler, collate_fn=collate_fn)
+
+        # the streamed datasets split by seed
+        split = {'train': list(train_dataset.indices), 'valid': list(valid_dataset.indices)} if isinstance(train_dataset, Subset) else None
+
+        file_path = os.path.join(os.getcwd(), f'data/{data_dir}/pixel_values.txt')
+        min_fft_pixel_value, max_fft_pixel_value = read_pixel_values(file_path)
+
+        spatial_stat_descriptor_module = None
+        if spatial_stat_descriptor is not None:
+            autocorr_size = (res_size, res_size) if spatial_stat_lag_radius is None else (2 * spatial_stat_lag_radius + 1,) * 2
+            spatial_stat_descriptor_module = build_descriptor(
+                spatial_stat_descriptor, autocorr_size, device,
+                pca_path=os.path.join(os.getcwd(), f'data/{data_dir}/autocorr_pca.pt'),
+                n_components=spatial_stat_descriptor_components, normalized=normalize_spatial_stat_tensors
+                )
+
+        # EncoderCNN architecture
+        CNN_fc_hidden1, CNN_fc_hidden2 = 1024, 1024
+        # Build model
+        vae = ResNet_VAE(fc_hidden1=CNN_fc_hidden1, fc_hidden2=CNN_fc_hidden2, drop_p=dropout_p, CNN_embed_dim=CNN_embed_dim, device=device, backbone=encoder_backbone, backbone_kwargs=encoder_backbone_kwargs).to(device)
+        if vae.backbone_pretrained:
+            vae.resnet.requires_grad_(False)
+        if backbone_feature_cache:
+            vae.freeze_backbone()
+
+        ensemble = None
+        if ensemble_seeds:
+            assert vae.backbone_pretrained, "ensemble_seeds shares a frozen pretrained backbone"
+            # every other replica is initialized as the model of its seed, its backbone dropped for that of the first
+            state = rng_state()
+            replicas = [vae]
+            for member_seed in seeds[1:]:
+                seed_everything(member_seed)
+                replica = ResNet_VAE(fc_hidden1=CNN_fc_hidden1, fc_hidden2=CNN_fc_hidden2, drop_p=dropout_p, CNN_embed_dim=CNN_embed_dim, device=device, backbone=encoder_backbone, backbone_kwargs=encoder_backbone_kwargs, pretrained=False).to(device)
+                # not loaded, the ensemble replaces its backbone with the pretrained one of the first replica
+                replica.backbone_pretrained = True
+                replicas.append(replica.freeze_backbone())
+            set_rng_state(state)
+            ensemble = ModelEnsemble(replicas)
+
+        #vae = SmallVAE(bottleneck_size=CNN_embed_dim).to(device)
+
+        wandb.watch(vae)
+        diagnostics = GradientDiagnostics(vae, every_n_batches=gradient_diagnostics_every) if gradient_diagnostics_every != 0 and ensemble is None else None
+        model_params = list(vae.parameters()) if ensemble is None else list(ensemble.parameters())
+        optimizer = torch.optim.Adam(model_params, lr=learning_rate)
+        beta_scheduler = ExponentialScheduler(start=0.005, max_val=beta, epochs=epochs) # start = 256/(224*224) = (latent space dim)/(input dim)
+        loss_function = MaterialSimilarityLoss(
+            device, 
+            min_fft_pixel_value, max_fft_pixel_value,
+            content_layer=content_layer, style_layer=style_layer, 
+            spatial_stat_loss_reduction=spatial_stat_loss_reduction, normalize_spatial_stat_tensors=normalize_spatial_stat_tensors, soft_equality_eps=soft_equality_eps,
+            spatial_stat_precision=spatial_stat_precision,
+            cache_input_autocorrs=autocorr_cache is not None, autocorr_cache_max_mb=autocorr_cache_max_mb,
+            spatial_stat_loss_domain=spatial_stat_loss_domain,
+            spatial_stat_lag_radius=spatial_stat_lag_radius, spatial_stat_lag_algorithm=spatial_stat_lag_algorithm,
+            spatial_stat_phase_pair_weights=spatial_stat_phase_pair_weights,
+            spatial_stat_descriptor=spatial_stat_descriptor_module,
+            spatial_stat_fused=spatial_stat_fused
+            )
+        if autocorr_cache == 'precompute':
+            loss_function.spst_loss.autocorr_cache.precompute(DataLoader(dataset, batch_size=batch_size, num_workers=4), loss_function.spst_loss.calculate_cached_statistic, device)
+        a_spst_scheduler = LossCoefficientScheduler(a_spst, epochs, mode="sigmoid")
+
+        print({
+            "seed": seed,
+            "run_name": run_name, 
+            #"content_layer_coeffs": loss_function.content_layer_coefficients,
+            #"style_layer_coeffs": loss_function.style_layer_coefficients,
+            })
+
+        # batches done and LossAccumulator of the epoch resumed from a step checkpoint
+        start_batch, resumed_losses = 0, None
+        if resume_state is not None:
+            model_state, training_state = resume_state
+            vae.load_state_dict(model_state)
+            optimizer.load_state_dict(training_state['optimizer'])
+            a_spst_scheduler.__dict__.update(training_state['a_spst_scheduler'])
+            a_mse, a_spst = training_state['a_mse'], training_state['a_spst']
+            last_epoch = training_state['epoch']
+            if 'step' in training_state:
+                start_batch = training_state['step']
+                resumed_losses = LossAccumulator(6, device)
+                resumed_losses.load_state_dict(select_rank(training_state['losses']))
+                print(f"Resuming from the checkpoint of epoch {last_epoch + 1}, batch {start_batch}...")
+            else:
+                print(f"Resuming from the checkpoint of epoch {last_epoch}...")
+        elif resume_training:
+            # runs saved before the checkpoints, only the model and the optimizer
+            assert last_epoch, "No checkpoint to resume from, give the last_epoch of the model_epoch / optimizer_epoch files"
+            vae.load_state_dict(torch.load(os.path.join(save_model_path,f'model_epoch{last_epoch}.pth')))
+            optimizer.load_state_dict(torch.load(os.path.join(save_model_path,f'optimizer_epoch{last_epoch}.pth')))
+            print("Resuming pretrained model...")
+        else:
+            last_epoch = 0
+
+        if backbone_feature_cache:
+            # after resuming, the features are those of the loaded backbone. Same split, loaders now also yield the features
+            with main_process_first():
+                features_path = load_feature_cache(
+                    vae, image_dataset, os.path.join(os.getcwd(), f'data/{data_dir}/backbone_features'), data_hash,
+                    collate_fn, device
+                    )
+            dataset = FeatureCacheDataset(image_dataset, features_path)
+            train_dataset, valid_dataset = Subset(dataset, train_dataset.indices), Subset(dataset, valid_dataset.indices)
+            train_sampler = ResumableRandomSampler(train_dataset, seed=seed, num_replicas=world_size, rank=rank)
+            train_loader = DataLoader(train_dataset, batch_size=batch_size, sampler=train_sampler, num_workers=4, collate_fn=collate_fn, generator=torch.Generator().manual_seed(seed))
+            valid_sampler = DistributedSampler(valid_dataset, world_size, rank, shuffle=False) if distributed else None
+            valid_loader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=False, sampler=valid_sampler, collate_fn=collate_fn)
+
+
+        # the module the batches run through, the compiled vae with compiled_execution (the checkpoints still save vae)
+        runner = vae if ensemble is None else ensemble
+        if compiled_execution:
+            runner, compile_info = prepare_compiled_training(vae, loss_function, train_loader, device, model_precision, mode=compile_mode)
+            print(f"Compiled: {compile_info['compiled']}, compile time {compile_info['compile seconds']:.1f} seconds")
+            wandb.log({'compile_seconds': compile_info['compile seconds']})
+
+        # the module the training batches run through, which averages the gradients over the ranks when distributed
+        train_runner = DistributedDataParallel(runner) if distributed else runner
+
+        if resume_state is not None:
+            # continue the random streams (shuffling, sampling, dropout) where the checkpointed run left them
+            set_rng_state(select_rank(resume_state[1]['rng']))
+            resume_state = None
+
+        step_checkpoint = None
+        if checkpoint_every_n_steps:
+            def step_state(batches_done, losses):
+                # the epoch in progress, so the loss coefficients are still those it started with
+                return vae.state_dict(), {
+                    'epoch': epoch, 'step': batches_done, 'losses': gather_per_rank(losses.state_dict()), 'optimizer': optimizer.state_dict(),
+                    'a_spst_scheduler': dict(vars(a_spst_scheduler)), 'a_mse': a_mse, 'a_spst': a_spst,
+                    'rng': gather_per_rank(rng_state()), 'split': split,
+                    }
+            step_checkpoint = StepCheckpoint(checkpoints, checkpoint_every_n_steps, step_state)
+
+        #start training
+        print("Started training.")
+        for epoch in range(last_epoch, epochs):
+            # schedule the learning rate
+            if epoch > int(epochs*0.9):
+                optimizer = change_learning_rate(optimizer, fine_tune_lr)
+
+            # schedule beta
+            if schedule_KLD:
+                beta = beta_scheduler.get_beta(epoch)
+            else:
+                beta=1
+
+            save_condition = True if debugging else (epoch + 1) % save_interval == 0
+            if procedural_data or sharded_data:
+                train_dataset.set_epoch(epoch)
+            else:
+                train_sampler.set_epoch(epoch)
+                train_sampler.set_start(start_batch * batch_size)
+
+            # train, test model
+            start = time.time()
+            if ensemble is None:
+                training_results = [train(log_interval, train_runner, loss_function, device, train_loader, optimizer, epoch, save_model_path, a_mse, a_content, a_style, a_spst, beta, debugging, log_autocorrs=save_condition, diagnostics=diagnostics, model_precision=model_precision, start_batch=start_batch, losses=resumed_losses, step_checkpoint=step_checkpoint)]
+                start_batch, resumed_losses = 0, None
+                validation_results = [validation(runner, loss_function, device, valid_loader, a_mse, a_content, a_style, a_spst, beta, debugging, log_autocorrs=save_condition, model_precision=model_precision)]
+            else:
+                training_results = train_ensemble(log_interval, ensemble, loss_function, device, train_loader, optimizer, epoch, a_mse, a_content, a_style, a_spst, beta, debugging, log_autocorrs=save_condition, model_precision=model_precision)
+                validation_results = validation_ensemble(ensemble, loss_function, device, valid_loader, a_mse, a_content, a_style, a_spst, beta, debugging, log_autocorrs=save_condition, model_precision=model_precision)
+
+            # the metrics and images of every seed are logged under seed_<seed>/ with ensemble_seeds
+            # the losses are epoch means per sample (see MaterialSimilarityLoss.per_sample_terms), not the batch sums logged before
+            prefixes = [f"seed_{member_seed}/" for member_seed in seeds] if ensemble is not None else [""]
+            metrics = {}
+            for prefix, training_result, validation_result in zip(prefixes, training_results, validation_results):
+                X_train, y_train, z_train, mu_train, logvar_train, training_losses, training_input_autocorr, training_recon_autocorr, grad_stats = training_result
+                X_test, y_test, z_test, mu_test, logvar_test, validation_losses, validation_input_autocorr, validation_recon_autocorr = validation_result
+                mse_training_loss, content_training_loss, style_training_loss, spst_training_loss, kld_training_loss, overall_training_loss = training_losses
+                mse_loss, content_loss, style_loss, spst_loss, kld_loss, overall_loss = validation_losses
+                metrics.update({prefix + name: value for name, value in {
+                    "mse_training_loss_per_sample": mse_training_loss, 
+                    "mse_validation_loss_per_sample": mse_loss, 
+                    "spatial_stats_training_loss_per_sample": spst_training_loss,
+                    "spatial_stats_validation_loss_per_sample": spst_loss,
+                    "KLD_training_loss_per_sample": kld_training_loss,
+                    "KLD_validation_loss_per_sample": kld_loss,
+                    "overall_training_loss_per_sample": overall_training_loss,
+                    "overall_validation_loss_per_sample": overall_loss,
+                    "mu_training": mu_train,
+                    "mu_test": mu_test,
+                    "logvar_train": logvar_train,
+                    "logvar_test": logvar_test,
+                    }.items()})
+            if ensemble is not None:
+                # and their mean over the seeds without prefix, the metric of a sweep over ensembles
+                for name in [name for name in metrics if name.startswith(prefixes[0]) and name.endswith('_loss_per_sample')]:
+                    name = name[len(prefixes[0]):]
+                    metrics[name] = float(np.mean([metrics[prefix + name] for prefix in prefixes]))
+            metrics.update({
+                "alpha_mse": a_mse,
+                "alpha_spst": a_spst,
+                "KLD_beta": beta,
+                })
+            wandb.log(metrics)
+            stop = epoch_callback is not None and epoch_callback(epoch + 1, metrics)
+
+            # schedule the spst loss value
+            if schedule_spst:
+                a_spst = a_spst_scheduler.step()
+                a_mse = 1 - a_spst
+
+            for k, (prefix, training_result, validation_result) in enumerate(zip(prefixes, training_results, validation_results)):
+                X_train, y_train, z_train, mu_train, logvar_train, training_losses, training_input_autocorr, training_recon_autocorr, grad_stats = training_result
+                validation_input_autocorr, validation_recon_autocorr = validation_result[6:]
+                overall_loss = validation_result[5][-1]
+                # the model of this seed, the one the batches run through and the one saved
+                if ensemble is None:
+                    member_runner, member_vae = runner, vae
+                else:
+                    member_runner = member_vae = ensemble.replica(k)
+
+                arrays = {}  # saved with the checkpoint
+                if save_condition and main_process:
+                    # save 100 pairs of images
+                    orig, recon, orig_autocorr, recon_autocorr = reconstruct_images(member_runner, valid_loader, device, num_examples=100, model_precision=model_precision)
+                    arrays = {
+                        'X_train_epoch{}.npy'.format(epoch + 1): X_train, #save last batch
+                        'y_train_epoch{}.npy'.format(epoch + 1): y_train,
+                        'z_train_epoch{}.npy'.format(epoch + 1): z_train,
+                        'original_images_epoch{}.npy'.format(epoch + 1): orig.numpy(),
+                        'reconstructed_images_epoch{}.npy'.format(epoch + 1): recon.numpy(),
+                        'original_autocorr_epoch{}.npy'.format(epoch + 1): orig_autocorr.numpy(),
+                        'reconstructed_autocorr_epoch{}.npy'.format(epoch + 1): recon_autocorr.numpy(),
+                        }
+
+                    grid = generate_from_noise(member_vae, device, 16, loss_function.spst_loss.calculate_two_point_autocorr_pytorch, model_precision)
+                    imgs = wandb.Image(grid, caption="(Genearted image for validation, Genearted image autocorrelation)")
+                    wandb.log({prefix + 'Validation generated images from noise': imgs})
+                    print("Validation images generated from noise successfully.")
+
+                    # training_input_autocorr = training_input_autocorr.unsqueeze(1)
+                    # training_recon_autocorr = training_recon_autocorr.unsqueeze(1)
+                    training_loss_autocorr_grid = torch.cat([training_input_autocorr, training_recon_autocorr], axis=2)
+                    training_loss_autocorr_grid = make_grid(training_loss_autocorr_grid, nrow=8, padding=1)
+                    imgs = wandb.Image(training_loss_autocorr_grid, caption="From inside the loss function. top: training input image autocorrelation, bottom: training input reconstructed image autocorrelation")
+                    wandb.log({prefix + 'Training autocorr images from inside the spst loss function': imgs})
+                    print("Training autocorr images from inside the spst loss function saved successfully.")
+
+                    # validation_input_autocorr = validation_input_autocorr.unsqueeze(1)
+                    # validation_recon_autocorr = validation_recon_autocorr.unsqueeze(1)
+                    validation_loss_autocorr_grid = torch.cat([validation_input_autocorr, validation_recon_autocorr], axis=2)
+                    validation_loss_autocorr_grid = make_grid(validation_loss_autocorr_grid, nrow=8, padding=1)
+                    imgs = wandb.Image(validation_loss_autocorr_grid, caption="From inside the loss function. top: validation input image autocorrelation, bottom: validation input reconstructed image autocorrelation")
+                    wandb.log({prefix + 'Validation autocorr images from inside the spst loss function': imgs})
+                    print("Validation autocorr images from inside the spst loss function saved successfully.")
+
+                if save_condition:
+                    # last, so the RNG states are those the next epoch starts from. Written in the background, by rank 0
+                    training_state = {
+                        'epoch': epoch + 1, 'optimizer': optimizer.state_dict() if ensemble is None else ensemble.replica_optimizer_state_dict(k, optimizer),
+                        'a_spst_scheduler': dict(vars(a_spst_scheduler)), 'a_mse': a_mse, 'a_spst': a_spst,
+                        'rng': gather_per_rank(rng_state()), 'split': split,
+                        }
+                    member_checkpoints[k].save(epoch + 1, member_vae.state_dict(), training_state, metric=float(overall_loss), arrays=arrays)
+                    print("Checkpoint, data and original and reconstructed images queued for saving.")
+
+                # save gradient stats
+                if grad_stats:
+                    wandb.log(grad_stats)
+                    print("Gradients saved successfully.")
+
+            print(f"epoch time elapsed {time.time() - start} seconds")
+            print("-------------------------------------------------")
+            if stop:
+                print(f"Stopped after epoch {epoch + 1}.")
+                break
+
+
+        for member_run_name, member_checkpoint_manager in zip(run_names, member_checkpoints):
+            member_checkpoint_manager.close()
+            print(f"Finished training for {member_run_name}.")
 
 
 
@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from autocorr_store import AutocorrelationStore, update_autocorr_store
+from lines_dataset import LinesDataset
+from preprocessing import BatchPreprocess, image_transform
+from spatial_statistics_loss import TwoPointAutocorrelation
+
+
+def write_images(data_dir, names, size=16, seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(data_dir, 'images'), exist_ok=True)
+    for name in names:
+        Image.fromarray(rng.integers(0, 256, (size, size), dtype=np.uint8), mode='L').save(os.path.join(data_dir, 'images', name))
+
+
+def write_labels(data_dir, names):
+    pd.DataFrame({'image': names, 'line_type': ['Vertical'] * len(names)}).to_csv(os.path.join(data_dir, 'labels.csv'), index=False)
+
+
+def update(data_dir, preprocess, dtype='float32'):
+    csv_file, img_dir = os.path.join(data_dir, 'labels.csv'), os.path.join(data_dir, 'images')
+    dataset = LinesDataset(csv_file, img_dir, image_transform())
+    return update_autocorr_store(dataset, csv_file, img_dir, os.path.join(data_dir, 'autocorr_store'), preprocess,
+                                 dtype=dtype, batch_size=3, num_workers=0)
+
+
+def expected_autocorrs(data_dir, preprocess):
+    dataset = LinesDataset(os.path.join(data_dir, 'labels.csv'), os.path.join(data_dir, 'images'), image_transform())
+    X, _ = next(iter(DataLoader(dataset, batch_size=len(dataset), collate_fn=preprocess.collate)))
+    return TwoPointAutocorrelation().batch_forward(X)
+
+
+def test_store_round_trip(tmp_path):
+    names = [f'img_{i}.png' for i in range(7)]
+    write_images(tmp_path, names)
+    write_labels(tmp_path, names)
+    preprocess = BatchPreprocess(res_size=16, thr_255=128)
+    assert update(tmp_path, preprocess) == 7
+
+    store = AutocorrelationStore(str(tmp_path / 'autocorr_store'))
+    expected = expected_autocorrs(tmp_path, preprocess)
+    assert len(store) == 7
+    assert store[2].shape == (1, 16, 16) and torch.allclose(store[2], expected[2])
+    # unsorted rows come back in the requested order
+    assert torch.allclose(store[[5, 0, 3]], expected[[5, 0, 3]])
+    assert torch.allclose(store[torch.tensor([6, 1])], expected[[6, 1]])
+    assert torch.allclose(store.get(['img_4.png', 'img_2.png']), expected[[4, 2]])
+
+    # float16 rows hold the autocorrelations up to half precision
+    assert update(tmp_path, preprocess, dtype='float16') == 7
+    assert torch.allclose(AutocorrelationStore(str(tmp_path / 'autocorr_store'))[:], expected, atol=1e-3)
+
+
+def test_store_update_computes_only_new_and_changed_images(tmp_path):
+    names = [f'img_{i}.png' for i in range(6)]
+    write_images(tmp_path, names)
+    write_labels(tmp_path, names)
+    preprocess = BatchPreprocess(res_size=16, thr_255=128)
+    assert update(tmp_path, preprocess) == 6
+    assert update(tmp_path, preprocess) == 0
+
+    # one image rewritten, one added, one dropped and the rest reordered
+    write_images(tmp_path, ['img_1.png', 'img_6.png'], seed=1)
+    names = ['img_6.png', 'img_3.png', 'img_1.png', 'img_0.png', 'img_5.png', 'img_2.png']
+    write_labels(tmp_path, names)
+    assert update(tmp_path, preprocess) == 2
+    store = AutocorrelationStore(str(tmp_path / 'autocorr_store'))
+    assert store.names == names
+    assert torch.allclose(store[:], expected_autocorrs(tmp_path, preprocess))
+
+    # other preprocessing recomputes every row
+    assert update(tmp_path, BatchPreprocess(res_size=16, thr_255=64)) == 6
@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+import checkpoint_manager
+from checkpoint_manager import CheckpointManager
+
+
+def model_state(value):
+    return {'weight': torch.full((2, 2), float(value))}
+
+
+def test_keeps_the_last_and_the_best_checkpoints(tmp_path):
+    checkpoints = CheckpointManager(str(tmp_path), keep_last=2, keep_best=1)
+    for epoch, metric in zip(range(1, 6), [5, 1, 4, 3, 2]):
+        checkpoints.save(epoch, model_state(epoch), {'epoch': epoch}, metric=metric, arrays={f'array_{epoch}.npy': np.arange(epoch)})
+    checkpoints.close()
+
+    # the last two, 4 and 5, and the best, 2
+    kept = [2, 4, 5]
+    assert [entry['epoch'] for entry in CheckpointManager(str(tmp_path)).entries] == kept
+    for epoch in range(1, 6):
+        assert os.path.exists(tmp_path / f'model_epoch{epoch}.pth') == (epoch in kept)
+        assert os.path.exists(tmp_path / f'checkpoint_epoch{epoch}.pt') == (epoch in kept)
+        # the arrays are never pruned
+        assert np.array_equal(np.load(tmp_path / f'array_{epoch}.npy'), np.arange(epoch))
+    assert not [name for name in os.listdir(tmp_path) if '.tmp' in name]
+
+    reopened = CheckpointManager(str(tmp_path))
+    model, training = reopened.load()
+    assert torch.equal(model['weight'], model_state(5)['weight']) and training == {'epoch': 5}
+    assert torch.equal(reopened.load(epoch=2)[0]['weight'], model_state(2)['weight'])
+    assert reopened.load(epoch=3) is None
+    reopened.close()
+
+
+def test_saves_a_snapshot_of_the_state(tmp_path):
+    checkpoints = CheckpointManager(str(tmp_path))
+    state = model_state(1)
+    checkpoints.save(1, state, {'epoch': 1})
+    # the training thread goes on changing the model while the checkpoint is written
+    state['weight'].add_(1)
+    assert torch.equal(checkpoints.load()[0]['weight'], model_state(1)['weight'])
+
+    # a step checkpoint within the next epoch is more recent
+    checkpoints.save_step(model_state(7), {'epoch': 1, 'step': 3})
+    model, training = checkpoints.load()
+    assert torch.equal(model['weight'], model_state(7)['weight']) and training['step'] == 3
+    checkpoints.save(2, model_state(2), {'epoch': 2})
+    assert checkpoints.load()[1] == {'epoch': 2}
+    checkpoints.close()
+
+
+def test_interrupted_write_leaves_the_previous_checkpoint(tmp_path, monkeypatch):
+    checkpoints = CheckpointManager(str(tmp_path))
+    checkpoints.save(1, model_state(1), {'epoch': 1})
+    checkpoints.wait()
+
+    save = torch.save
+    def failing_save(obj, path):
+        # the model file of epoch 2 is written, the run dies writing the rest of its state
+        save(obj, path)
+        if os.path.basename(path) == 'checkpoint_epoch2.tmp.pt':
+            raise OSError("disk full")
+    monkeypatch.setattr(checkpoint_manager.torch, 'save', failing_save)
+    checkpoints.save(2, model_state(2), {'epoch': 2})
+    with pytest.raises(RuntimeError):
+        checkpoints.wait()
+    monkeypatch.setattr(checkpoint_manager.torch, 'save', save)
+
+    # the partial file kept its temporary name and the index still ends at epoch 1
+    assert not os.path.exists(tmp_path / 'checkpoint_epoch2.pt')
+    reopened = CheckpointManager(str(tmp_path))
+    assert reopened.latest_epoch() == 1
+    model, training = reopened.load()
+    assert torch.equal(model['weight'], model_state(1)['weight']) and training == {'epoch': 1}
+    reopened.close()
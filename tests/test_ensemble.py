@@ -0,0 +1,136 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+import wandb
+from PIL import Image
+
+import backbones
+from ensemble import ModelEnsemble
+from resnet_vae import ResNet_VAE
+from wandb_train import run_training
+
+
+DEVICE = torch.device('cpu')
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def untrained_resnet(depth, pretrained):
+    # stands in for the ImageNet weights, which are not downloaded here
+    constructor, _ = backbones.RESNETS[depth]
+    return constructor(weights=None)
+
+
+def frozen_replicas(seeds):
+    replicas = []
+    for seed in seeds:
+        torch.manual_seed(seed)
+        vae = ResNet_VAE(fc_hidden1=8, fc_hidden2=8, drop_p=0, CNN_embed_dim=4, device=DEVICE, backbone='resnet18', pretrained=False)
+        vae.backbone_pretrained = True
+        replicas.append(vae.freeze_backbone())
+    # the backbone the ensemble shares, that of the first replica
+    for replica in replicas[1:]:
+        replica.expand_channels.load_state_dict(replicas[0].expand_channels.state_dict())
+        replica.resnet.load_state_dict(replicas[0].resnet.state_dict())
+    return replicas
+
+
+def close(a, b, rtol=1e-3, atol=1e-4):
+    # relative to the norm, the BatchNorms over a few samples blow the rounding of single elements up, and the
+    # gradients of the biases before them are rounding only
+    return (a.float() - b.float()).norm() <= rtol * b.float().norm() + atol
+
+
+def encoder_loss(mu, logvar):
+    # of the encoder outputs, which unlike z do not depend on the sampling
+    return (mu**2).sum() + (logvar.exp() - logvar).sum()
+
+
+def test_ensemble_trains_as_its_members_trained_separately():
+    # the same seeds build the same models
+    separate = frozen_replicas([0, 1])
+    ensemble = ModelEnsemble(frozen_replicas([0, 1]))
+    assert any(name.startswith('stacked_buffer_') for name in ensemble.state_dict())
+    # SGD rather than Adam, which would blow the rounding of the gradients of the biases before the BatchNorms,
+    # next to zero, up to whole steps
+    optimizer = torch.optim.SGD(ensemble.parameters(), lr=1e-2, momentum=0.9)
+    separate_optimizers = [torch.optim.SGD(vae.parameters(), lr=1e-2, momentum=0.9) for vae in separate]
+
+    generator = torch.Generator().manual_seed(0)
+    X = (torch.rand(4, 1, 32, 32, generator=generator) > 0.5).float()
+    # in eval mode z is mu, so every output of a member is that of its model
+    ensemble.eval()
+    with torch.no_grad():
+        outputs = ensemble(X)
+    for k, vae in enumerate(separate):
+        for output, expected in zip(outputs, vae.eval()(X)):
+            assert torch.allclose(output[k], expected, atol=1e-5)
+
+    for _ in range(3):
+        X = (torch.rand(4, 1, 32, 32, generator=generator) > 0.5).float()
+        ensemble.train()
+        _, _, mu, logvar = ensemble(X)
+        optimizer.zero_grad()
+        sum(encoder_loss(mu[k], logvar[k]) for k in range(2)).backward()
+        optimizer.step()
+        for vae, vae_optimizer in zip(separate, separate_optimizers):
+            vae.train()
+            _, _, vae_mu, vae_logvar = vae(X)
+            vae_optimizer.zero_grad()
+            encoder_loss(vae_mu, vae_logvar).backward()
+            vae_optimizer.step()
+
+    ensemble.eval()
+    with torch.no_grad():
+        _, _, mu, logvar = ensemble(X)
+    for k, vae in enumerate(separate):
+        # up to the rounding of the batched and the separate gradients, the weights, the encoder BatchNorm running statistics (those of the decoder follow the sampled z) and
+        # the optimizer state of every member
+        replica_state, separate_state = ensemble.replica(k).state_dict(), vae.state_dict()
+        for name, value in separate_state.items():
+            if name in dict(vae.named_parameters()) or name.split('.')[0] in ['bn1', 'bn2']:
+                assert close(replica_state[name], value), name
+        replica_optimizer_state = ensemble.replica_optimizer_state_dict(k, optimizer)['state']
+        for index, state in separate_optimizers[k].state_dict()['state'].items():
+            assert close(replica_optimizer_state[index]['momentum_buffer'], state['momentum_buffer'])
+        with torch.no_grad():
+            _, _, vae_mu, vae_logvar = vae.eval()(X)
+        assert close(mu[k], vae_mu) and close(logvar[k], vae_logvar)
+
+    # .to() moves the stacked buffers the forward reads
+    ensemble.to(torch.float64)
+    assert all(buffer.dtype == torch.float64 for buffer in ensemble.stacked_buffers.values() if buffer.is_floating_point())
+
+
+def write_lines_dataset(data_dir, num_images=20, size=32, seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(data_dir, 'images'))
+    names = [f'img_{i}.png' for i in range(num_images)]
+    for name in names:
+        Image.fromarray(rng.integers(0, 256, (size, size), dtype=np.uint8), mode='L').save(os.path.join(data_dir, 'images', name))
+    labels = ['Vertical' if i % 2 else 'Horizontal' for i in range(num_images)]
+    pd.DataFrame({'image': names, 'line_type': labels}).to_csv(os.path.join(data_dir, 'labels.csv'), index=False)
+    shutil.copy(os.path.join(REPO_DIR, 'data', 'lines', 'pixel_values.txt'), data_dir)
+
+
+def test_ensemble_run_logs_the_mean_of_its_members(tmp_path, monkeypatch):
+    # 14 training and 6 validation images, whole batches of 2 for the BatchNorms
+    write_lines_dataset(tmp_path / 'data' / 'lines')
+    monkeypatch.setattr(backbones, 'load_resnet', untrained_resnet)
+    monkeypatch.chdir(tmp_path)
+    metrics = []
+    wandb.init(mode='disabled')
+    try:
+        run_training(1, 0.5, 0, 0, 0.5, 1, 1, 1, batch_size=2, CNN_embed_dim=4, encoder_backbone='resnet18', dataset_name='lines',
+                     backbone_feature_cache=True, ensemble_seeds=[0, 1], epoch_callback=lambda epoch, epoch_metrics: metrics.append(epoch_metrics))
+    finally:
+        wandb.finish()
+    [epoch_metrics] = metrics
+    # the metric a sweep over ensembles ranks its trials by
+    for name in ['overall_validation_loss_per_sample', 'mse_training_loss_per_sample']:
+        members = [epoch_metrics[f'seed_{seed}/{name}'] for seed in [0, 1]]
+        assert members[0] != members[1]
+        assert epoch_metrics[name] == pytest.approx(np.mean(members))
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+import torch
+
+from feature_cache import FeatureCacheDataset, load_feature_cache
+from resnet_vae import ResNet_VAE
+
+
+DEVICE = torch.device('cpu')
+
+
+def frozen_vae():
+    torch.manual_seed(0)
+    # stands in for the ImageNet weights, which are not downloaded here
+    vae = ResNet_VAE(fc_hidden1=8, fc_hidden2=8, CNN_embed_dim=4, device=DEVICE, backbone='resnet18', pretrained=False)
+    vae.backbone_pretrained = True
+    return vae.freeze_backbone()
+
+
+@pytest.mark.parametrize('backbone', ['small_vae', 'resnet18'])
+def test_only_a_pretrained_backbone_is_frozen(backbone):
+    vae = ResNet_VAE(fc_hidden1=8, fc_hidden2=8, CNN_embed_dim=4, device=DEVICE, backbone=backbone, pretrained=False)
+    assert not vae.backbone_pretrained
+    with pytest.raises(ValueError):
+        vae.freeze_backbone()
+    assert not vae.backbone_frozen
+
+
+def test_cached_features_are_those_of_the_frozen_backbone(tmp_path):
+    vae = frozen_vae().train()
+    images = (torch.rand(5, 1, 32, 32, generator=torch.Generator().manual_seed(0)) > 0.5).float()
+    dataset = [(image, 0) for image in images]
+
+    features_path = load_feature_cache(vae, dataset, str(tmp_path), 'data', device=DEVICE)
+    with torch.no_grad():
+        expected = vae.backbone_features(images)
+    # the frozen backbone stays in eval mode while the model trains
+    assert vae.training and not vae.resnet.training
+    cached = torch.stack([features for *_, features in FeatureCacheDataset(dataset, features_path)])
+    assert torch.allclose(cached, expected, atol=1e-6)
+
+    # the same backbone and data reuse the cache, other weights rebuild it
+    modified = np.load(features_path)
+    modified[0] = 0
+    np.save(features_path, modified)
+    assert load_feature_cache(vae, dataset, str(tmp_path), 'data', device=DEVICE) == features_path
+    assert not np.load(features_path)[0].any()
+    with torch.no_grad():
+        vae.resnet[0].weight.mul_(2)
+        expected = vae.backbone_features(images)
+    load_feature_cache(vae, dataset, str(tmp_path), 'data', device=DEVICE)
+    assert torch.allclose(torch.from_numpy(np.load(features_path)), expected, atol=1e-6)
@@ -0,0 +1,59 @@
+import pytest
+import torch
+from torch import nn
+
+from gradient_diagnostics import GradientDiagnostics
+
+
+def model_and_losses():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(5, 4), nn.ReLU(), nn.Linear(4, 3))
+    x = torch.randn(6, 5)
+    out = model(x)
+    # the first term reaches only the last layer's bias
+    return model, {'bias': model[2].bias.sum(), 'mse': (out**2).mean()}
+
+
+def grad_statistics(grads):
+    grads = torch.cat([grad.flatten() for grad in grads]).double()
+    return {'norm': grads.norm().item(), 'mean': grads.abs().mean().item(), 'std': grads.std(unbiased=False).item()}
+
+
+def test_statistics_match_the_gradients_of_backward():
+    model, losses = model_and_losses()
+    diagnostics = GradientDiagnostics(model)
+    assert diagnostics.group_names == ['0', '2']
+    diagnostics.measure(losses)
+    summary = diagnostics.summary()
+
+    for term, loss in losses.items():
+        model.zero_grad()
+        loss.backward(retain_graph=True)
+        groups = {'': list(model.parameters()), '/0': list(model[0].parameters()), '/2': list(model[2].parameters())}
+        for group, params in groups.items():
+            if all(param.grad is None for param in params):
+                # the term does not reach the group, which is left out
+                assert (term, group) == ('bias', '/0') and f'{term} gradients{group} norm' not in summary
+                continue
+            # over the elements of the parameters the term reaches
+            expected = grad_statistics([param.grad for param in params if param.grad is not None])
+            for statistic, value in expected.items():
+                assert summary[f'{term} gradients{group} {statistic}'] == pytest.approx(value, rel=1e-6, abs=1e-12)
+
+        # measure_params reads the same sums back from .grad
+        diagnostics.reset()
+        diagnostics.measure_params(term)
+        diagnostics.measure({'measured ' + term: loss})
+        assert torch.allclose(diagnostics.measurements[term][0], diagnostics.measurements['measured ' + term][0])
+
+
+def test_statistics_are_averaged_over_the_measured_batches():
+    model, losses = model_and_losses()
+    diagnostics = GradientDiagnostics(model, every_n_batches=2)
+    assert [diagnostics.due(batch_idx) for batch_idx in range(4)] == [True, False, True, False]
+    diagnostics.measure({'mse': losses['mse']})
+    diagnostics.measure({'mse': 2 * losses['mse']})
+    single = GradientDiagnostics(model)
+    single.measure({'mse': losses['mse']})
+    # twice the loss, twice the norm: the mean of 1x and 2x is 1.5x
+    assert diagnostics.summary()['mse gradients norm'] == pytest.approx(1.5 * single.summary()['mse gradients norm'])
@@ -0,0 +1,46 @@
+import os
+import json
+import math
+import shutil
+
+from local_sweep import run_sweep
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# one epoch of a small VAE on a few procedural batches, no dataset nor pretrained weights needed
+SWEEP = {
+    'method': 'grid',
+    'metric': {'name': 'overall_loss', 'goal': 'minimize'},
+    'parameters': {
+        'epochs': {'value': 1},
+        'batch_size': {'value': 2},
+        'bottleneck_size': {'value': 4},
+        'encoder_backbone': {'value': 'small_vae'},
+        'dataset_name': {'value': 'lines'},
+        'procedural_data': {'value': True},
+        'procedural_batches_per_epoch': {'value': 3},
+        'a_mse': {'value': 0.5}, 'a_content': {'value': 0.0}, 'a_style': {'value': 0.0}, 'a_spst': {'value': 0.5},
+        'beta_max': {'value': 1}, 'content_layer': {'value': 1}, 'style_layer': {'value': 1},
+        },
+    }
+
+
+def test_a_trial_runs_end_to_end(tmp_path, monkeypatch):
+    # run_training reads the pixel values of the dataset and saves the run under the working directory
+    os.makedirs(tmp_path / 'data' / 'lines')
+    shutil.copy(os.path.join(REPO_DIR, 'data', 'lines', 'pixel_values.txt'), tmp_path / 'data' / 'lines')
+    monkeypatch.chdir(tmp_path)
+    sweep_dir = str(tmp_path / 'sweep')
+
+    records = run_sweep(SWEEP, sweep_dir, processes=1)
+    assert len(records) == 1
+    record = records[0]
+    # the trial's DataLoader starts worker processes, which a daemonic trial process could not
+    assert record['status'] == 'completed', record.get('error')
+    assert record['epochs'] == 1 and math.isfinite(record['best'])
+    with open(os.path.join(sweep_dir, 'sweep_results.jsonl')) as results_file:
+        assert [json.loads(line)['status'] for line in results_file] == ['completed']
+
+    # running the sweep again skips the recorded configuration
+    assert run_sweep(SWEEP, sweep_dir, processes=1) == records
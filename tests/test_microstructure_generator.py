@@ -0,0 +1,62 @@
+import os
+import shutil
+
+import pytest
+import torch
+import wandb
+from torch.utils.data import DataLoader
+
+from microstructure_generator import MicrostructureGenerator, MicrostructureDataset
+from wandb_train import run_training
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize('name', list(MicrostructureGenerator.PRESETS))
+def test_presets_draw_binary_images_of_their_kind(name):
+    generator = MicrostructureGenerator.preset(name, size=64)
+    images, labels = generator(8, torch.Generator().manual_seed(0))
+    assert images.shape == (8, 1, 64, 64) and images.dtype == torch.float32
+    assert labels.shape == (8,) and set(labels.tolist()) <= {0, 1}
+    # background 1, features 0, and every image holds some of both
+    assert set(images.unique().tolist()) == {0.0, 1.0}
+    features = images == 0
+    assert features.flatten(1).any(dim=1).all() and (~features).flatten(1).any(dim=1).all()
+    if generator.kind == 'lines':
+        # vertical lines (label 0) span whole columns, horizontal ones whole rows
+        for image, label in zip(features[:, 0], labels):
+            assert (image.all(dim=0).any() if label == 0 else image.all(dim=1).any())
+
+
+def test_batches_depend_only_on_the_seed_and_the_epoch():
+    generator = MicrostructureGenerator.preset('multiple_lines', size=32)
+    dataset = MicrostructureDataset(generator, batch_size=4, num_batches=5, seed=3)
+    serial = list(dataset)
+    assert len(serial) == len(dataset) == 5
+    parallel = list(DataLoader(dataset, batch_size=None, num_workers=2))
+    for (images, labels), (parallel_images, parallel_labels) in zip(serial, parallel):
+        assert torch.equal(images, parallel_images) and torch.equal(labels, parallel_labels)
+
+    dataset.set_epoch(1)
+    assert not torch.equal(next(iter(dataset))[0], serial[0][0])
+    dataset.set_epoch(0)
+    assert torch.equal(next(iter(dataset))[0], serial[0][0])
+    assert not torch.equal(next(iter(MicrostructureDataset(generator, 4, 5, seed=4)))[0], serial[0][0])
+
+
+def test_run_training_on_procedural_multiple_lines(tmp_path, monkeypatch):
+    # the pixel values of the stored lines dataset stand in for those of multiple_lines
+    os.makedirs(tmp_path / 'data' / 'multiple_lines')
+    shutil.copy(os.path.join(REPO_DIR, 'data', 'lines', 'pixel_values.txt'), tmp_path / 'data' / 'multiple_lines')
+    monkeypatch.chdir(tmp_path)
+    metrics = []
+    wandb.init(mode='disabled')
+    try:
+        run_training(1, 0.5, 0, 0, 0.5, 1, 1, 1, batch_size=2, CNN_embed_dim=4, encoder_backbone='small_vae', dataset_name='multiple_lines',
+                     procedural_data=True, procedural_batches_per_epoch=2, epoch_callback=lambda epoch, epoch_metrics: metrics.append(epoch_metrics))
+        with pytest.raises(ValueError):
+            run_training(1, 0.5, 0, 0, 0.5, 1, 1, 1, dataset_name='unknown', procedural_data=True)
+    finally:
+        wandb.finish()
+    assert len(metrics) == 1
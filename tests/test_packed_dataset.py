@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from lines_dataset import LinesDataset
+from packed_dataset import load_packed_dataset, source_hash
+from preprocessing import BatchPreprocess, image_transform
+
+
+def write_dataset(data_dir, num_images=10, size=20, seed=0):
+    """A LinesDataset directory of random gray level PNGs: labels.csv and images/."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(data_dir, 'images'), exist_ok=True)
+    names = [f'img_{i}.png' for i in range(num_images)]
+    for name in names:
+        Image.fromarray(rng.integers(0, 256, (size, size), dtype=np.uint8), mode='L').save(os.path.join(data_dir, 'images', name))
+    labels = ['Vertical' if i % 3 else 'Horizontal' for i in range(num_images)]
+    pd.DataFrame({'image': names, 'line_type': labels}).to_csv(os.path.join(data_dir, 'labels.csv'), index=False)
+
+
+def eager_images(data_dir, preprocess):
+    dataset = LinesDataset(os.path.join(data_dir, 'labels.csv'), os.path.join(data_dir, 'images'), image_transform())
+    return next(iter(DataLoader(dataset, batch_size=len(dataset), collate_fn=preprocess.collate)))
+
+
+def test_packed_dataset_matches_the_decoded_images(tmp_path):
+    write_dataset(tmp_path)
+    # odd size, so the last byte of every packed row is partial
+    preprocess = BatchPreprocess(res_size=13, thr_255=128)
+    packed = load_packed_dataset(LinesDataset, str(tmp_path), preprocess)
+    X, y = eager_images(tmp_path, preprocess)
+    X_packed, y_packed = next(iter(DataLoader(packed, batch_size=len(packed))))
+    assert X_packed.shape == X.shape == (10, 1, 13, 13)
+    assert torch.equal(X_packed, X) and torch.equal(y_packed, y)
+
+
+def test_packed_dataset_is_rebuilt_when_its_sources_change(tmp_path):
+    write_dataset(tmp_path)
+    preprocess = BatchPreprocess(res_size=16, thr_255=128)
+    digest = source_hash(tmp_path / 'labels.csv', tmp_path / 'images', preprocess)
+    load_packed_dataset(LinesDataset, str(tmp_path), preprocess, digest=digest)
+    # the same fingerprint reuses the cache, other preprocessing rebuilds it
+    assert source_hash(tmp_path / 'labels.csv', tmp_path / 'images', preprocess) == digest
+    assert source_hash(tmp_path / 'labels.csv', tmp_path / 'images', BatchPreprocess(res_size=16, thr_255=64)) != digest
+
+    write_dataset(tmp_path, size=24, seed=1)
+    assert source_hash(tmp_path / 'labels.csv', tmp_path / 'images', preprocess) != digest
+    packed = load_packed_dataset(LinesDataset, str(tmp_path), preprocess)
+    X, _ = eager_images(tmp_path, preprocess)
+    assert torch.equal(next(iter(DataLoader(packed, batch_size=len(packed))))[0], X)
@@ -0,0 +1,25 @@
+import numpy as np
+import torch
+from PIL import Image
+
+from preprocessing import BatchPreprocess, image_transform, sample_transform
+
+
+def random_images(sizes, mode='L', seed=0):
+    rng = np.random.default_rng(seed)
+    images = []
+    for size in sizes:
+        pixels = rng.integers(0, 256, (size, size), dtype=np.uint8)
+        images.append(Image.fromarray(pixels, mode='L').convert(mode))
+    return images
+
+
+def test_batch_preprocess_matches_the_per_sample_transform():
+    # equal sizes are preprocessed as one batch, the mixed ones image by image; mode '1' reads as bool
+    for images in [random_images([20, 20, 20]), random_images([20, 31, 12], seed=1), random_images([20, 20], mode='1', seed=2)]:
+        preprocess = BatchPreprocess(res_size=16, thr_255=200)
+        X, y = preprocess.collate([(image_transform()(image), label) for label, image in enumerate(images)])
+        expected = torch.stack([sample_transform(res_size=16, thr_255=200)(image) for image in images])
+        assert X.shape == expected.shape == (len(images), 1, 16, 16)
+        assert torch.equal(X, expected)
+        assert torch.equal(y, torch.arange(len(images)))
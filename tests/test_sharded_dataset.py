@@ -0,0 +1,53 @@
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from sharded_dataset import write_shards, split_shards, ShardedDataset
+from training_utils import mark_last
+
+
+def binary_dataset(num_images, size=10, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    images = (torch.rand(num_images, 1, size, size, generator=generator) > 0.5).float()
+    return [(image, i) for i, image in enumerate(images)]
+
+
+def read_all(dataset, **loader_kwargs):
+    batches = list(DataLoader(dataset, batch_size=4, **loader_kwargs))
+    return torch.cat([X for X, _ in batches]), torch.cat([y for _, y in batches])
+
+
+def test_shards_round_trip(tmp_path):
+    dataset = binary_dataset(11)
+    index = write_shards(dataset, str(tmp_path), records_per_shard=4, num_workers=0)
+    assert [shard['num_records'] for shard in index['shards']] == [4, 4, 3]
+    X, y = read_all(ShardedDataset(str(tmp_path), shuffle=False))
+    assert torch.equal(X, torch.stack([image for image, _ in dataset])) and torch.equal(y, torch.arange(11))
+    # shuffled and read by two workers, every record comes once
+    X, y = read_all(ShardedDataset(str(tmp_path), shuffle=True), num_workers=2)
+    assert sorted(y.tolist()) == list(range(11))
+    assert torch.equal(X, torch.stack([dataset[label][0] for label in y]))
+
+
+@pytest.mark.parametrize('records_per_shard', [4, 100])
+def test_split_leaves_no_side_empty(tmp_path, records_per_shard):
+    write_shards(binary_dataset(11), str(tmp_path), records_per_shard=records_per_shard, num_workers=0)
+    train_shards, valid_shards = split_shards(str(tmp_path), 0.7, seed=0)
+    train, valid = ShardedDataset(str(tmp_path), train_shards), ShardedDataset(str(tmp_path), valid_shards)
+    assert len(train) > 0 and len(valid) > 0 and len(train) + len(valid) == 11
+    if records_per_shard == 100:
+        # a single shard is split by record
+        assert len(train) == 8
+    train_labels, valid_labels = read_all(train)[1].tolist(), read_all(valid)[1].tolist()
+    assert len(train_labels) == len(train) and len(valid_labels) == len(valid)
+    assert sorted(train_labels + valid_labels) == list(range(11))
+
+
+def test_last_batch_of_a_sharded_loader_is_found(tmp_path):
+    write_shards(binary_dataset(11), str(tmp_path), records_per_shard=4, num_workers=0)
+    # every worker ends on a partial batch: 3 workers of one shard each make 2 + 2 + 1 batches, not ceil(11 / 3)
+    loader = DataLoader(ShardedDataset(str(tmp_path)), batch_size=3, num_workers=3)
+    marked = list(mark_last(loader))
+    assert len(marked) == 5 > len(loader)
+    assert [is_last for _, is_last in marked] == [False] * 4 + [True]
+    assert list(mark_last([])) == []
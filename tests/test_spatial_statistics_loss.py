@@ -0,0 +1,176 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from spatial_statistics_loss import TwoPointSpatialStatsLoss, TwoPointAutocorrMSE, TwoPointAutocorrelation, AutocorrelationCache
+from spatial_stats_benchmark import reference_two_point_autocorr
+
+
+DEVICE = torch.device('cpu')
+
+
+def baseline_exact_autocorr(img):
+    """The per-image float64 TwoPointAutocorrelation.forward of the baseline, phase 0 of an (1, H, W) image."""
+    mf = img[0].eq(0).double()
+    M = torch.fft.fftn(mf, dim=[0, 1])
+    output = torch.fft.ifftn(M.conj() * M / mf.numel(), dim=[0, 1]).real.unsqueeze(0)
+    H, W = output.shape[-2:]
+    return torch.roll(output, shifts=(H // 2, W // 2), dims=(-2, -1))
+
+
+@pytest.mark.parametrize('precision', ['float64', 'float32'])
+@pytest.mark.parametrize('normalize', [False, True])
+def test_batched_autocorr_matches_per_image_reference(precision, normalize):
+    torch.manual_seed(0)
+    imgs = torch.rand(3, 1, 16, 16)
+    loss = TwoPointSpatialStatsLoss(DEVICE, -1.9e-09, 0.04, input_size=16, normalize_spatial_stats_tensors=normalize, precision=precision)
+    expected = reference_two_point_autocorr(loss, imgs)
+    actual = loss.calculate_two_point_autocorr_pytorch(imgs)
+    assert actual.shape == expected.shape == (3, 1, 16, 16)
+    # the reference FFTs in complex64 before promoting to complex128, so it is only float32 accurate
+    rel_err = (actual.double() - expected).abs().max() / expected.abs().max()
+    assert rel_err < 1e-5
+
+
+@pytest.mark.parametrize('precision', ['float64', 'float32'])
+@pytest.mark.parametrize('normalize', [False, True])
+@pytest.mark.parametrize('reduction', ['mean', 'sum'])
+def test_loss_matches_per_image_reference(precision, normalize, reduction):
+    torch.manual_seed(0)
+    x, y = torch.rand(2, 3, 1, 16, 16)
+    loss = TwoPointSpatialStatsLoss(DEVICE, -1.9e-09, 0.04, input_size=16, normalize_spatial_stats_tensors=normalize, reduction=reduction, precision=precision)
+    expected = F.mse_loss(reference_two_point_autocorr(loss, x), reference_two_point_autocorr(loss, y), reduction=reduction)
+    actual, _, _ = loss(x, y)
+    assert torch.allclose(actual.double(), expected, rtol=1e-4, atol=0)
+
+
+def test_exact_autocorrelation_is_float32_and_matches_baseline():
+    torch.manual_seed(0)
+    imgs = (torch.rand(4, 1, 16, 16) > 0.5).to(torch.uint8)
+    autocorrs = TwoPointAutocorrelation().batch_forward(imgs)
+    # float32 since the batched version, the baseline returned float64
+    assert autocorrs.dtype == torch.float32
+    assert autocorrs.shape == (4, 1, 16, 16)
+    for img, autocorr in zip(imgs, autocorrs):
+        assert torch.allclose(autocorr.double(), baseline_exact_autocorr(img), atol=1e-6)
+    single = TwoPointAutocorrelation().forward(imgs[0])
+    assert single.dtype == torch.float32
+    assert torch.equal(single, autocorrs[0])
+
+
+def test_lag_window_direct_matches_fft():
+    torch.manual_seed(0)
+    imgs = torch.rand(2, 1, 16, 16)
+    loss = TwoPointSpatialStatsLoss(DEVICE, -1.9e-09, 0.04, input_size=16, lag_radius=5)
+    direct = loss.calculate_lag_window_autocorr(imgs, algorithm='direct')
+    fft = loss.calculate_lag_window_autocorr(imgs, algorithm='fft')
+    assert direct.shape == fft.shape == (2, 1, 11, 11)
+    assert (direct - fft).abs().max() / fft.abs().max() < 1e-10
+
+
+def test_direct_lag_algorithm_is_limited_to_small_radii():
+    limit = TwoPointSpatialStatsLoss.MAX_DIRECT_LAG_RADIUS
+    # full-size images favour the direct correlation at a radius of 1, but never past the limit
+    assert TwoPointSpatialStatsLoss.select_lag_algorithm(224, 224, 1, batch_size=32) == 'direct'
+    assert TwoPointSpatialStatsLoss.select_lag_algorithm(224, 224, limit + 1, batch_size=32) == 'fft'
+    TwoPointSpatialStatsLoss(DEVICE, -1.9e-09, 0.04, input_size=16, lag_radius=limit, lag_algorithm='direct')
+    with pytest.raises(AssertionError):
+        TwoPointSpatialStatsLoss(DEVICE, -1.9e-09, 0.04, input_size=16, lag_radius=limit + 1, lag_algorithm='direct')
+
+
+# even widths have a Nyquist column in the rfft2 half spectrum, which like DC is not doubled
+@pytest.mark.parametrize('width', [8, 9])
+@pytest.mark.parametrize('normalize', [False, True])
+@pytest.mark.parametrize('reduction', ['mean', 'sum'])
+def test_fused_autocorr_mse_gradcheck(width, normalize, reduction):
+    torch.manual_seed(0)
+    fused = TwoPointSpatialStatsLoss(DEVICE, -1.9e-09, 0.04, input_size=8, normalize_spatial_stats_tensors=normalize, reduction=reduction, fused=True)
+    x = torch.rand(2, 1, 8, width, dtype=torch.float64, requires_grad=True)
+    y = torch.rand(2, 1, 8, width, dtype=torch.float64, requires_grad=True)
+    assert torch.autograd.gradcheck(
+        lambda a, b: TwoPointAutocorrMSE.apply(a, b, fused.soft_equality_eps, fused.dtype, fused.normalization_range(), reduction), (x, y))
+
+
+@pytest.mark.parametrize('width', [8, 9])
+@pytest.mark.parametrize('normalize', [False, True])
+@pytest.mark.parametrize('reduction', ['mean', 'sum'])
+def test_fused_and_frequency_losses_match_spatial_loss(width, normalize, reduction):
+    torch.manual_seed(0)
+    kwargs = dict(input_size=8, normalize_spatial_stats_tensors=normalize, reduction=reduction)
+    spatial = TwoPointSpatialStatsLoss(DEVICE, -1.9e-09, 0.04, **kwargs)
+    frequency = TwoPointSpatialStatsLoss(DEVICE, -1.9e-09, 0.04, loss_domain='frequency', **kwargs)
+    fused = TwoPointSpatialStatsLoss(DEVICE, -1.9e-09, 0.04, fused=True, **kwargs)
+    x = torch.rand(2, 1, 8, width, dtype=torch.float64, requires_grad=True)
+    y = torch.rand(2, 1, 8, width, dtype=torch.float64, requires_grad=True)
+
+    expected, _, _ = spatial(x, y)
+    expected_grads = torch.autograd.grad(expected, (x, y))
+    for loss in [frequency, fused]:
+        actual, _, _ = loss(x, y, return_autocorrs=False)
+        actual_grads = torch.autograd.grad(actual, (x, y))
+        assert torch.allclose(actual, expected, rtol=1e-10, atol=0)
+        for actual_grad, expected_grad in zip(actual_grads, expected_grads):
+            assert torch.allclose(actual_grad, expected_grad, rtol=1e-8, atol=1e-12)
+
+
+def test_autocorrelation_cache_counts_hits_and_evicts_least_recently_used():
+    entry = torch.zeros(1, 4, 4)  # 64 bytes
+    cache = AutocorrelationCache(max_mb=3 * 64 / 1024**2)
+    cache.insert([0, 1, 2], torch.stack([entry, entry + 1, entry + 2]))
+    assert len(cache) == 3 and cache.nbytes == 3 * 64
+    hit, miss = cache.lookup([0, 5])
+    assert torch.equal(hit, entry) and miss is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    # 0 was just used, so 1 is the least recently used entry
+    cache.insert([3], (entry + 3).unsqueeze(0))
+    assert list(cache.entries) == [2, 0, 3] and cache.nbytes == 3 * 64
+
+
+@pytest.mark.parametrize('loss_domain', ['spatial', 'frequency'])
+def test_cached_input_statistics_give_the_uncached_loss(loss_domain):
+    torch.manual_seed(0)
+    x, y = torch.rand(2, 4, 1, 16, 16)
+    idx = torch.tensor([7, 3, 9, 1])
+    plain = TwoPointSpatialStatsLoss(DEVICE, -1.9e-09, 0.04, input_size=16, loss_domain=loss_domain)
+    cached = TwoPointSpatialStatsLoss(DEVICE, -1.9e-09, 0.04, input_size=16, loss_domain=loss_domain, autocorr_cache=AutocorrelationCache())
+    expected = plain(x, y)[0]
+    # the first two images miss, then all four are served from the cache
+    cached(x[:2], y[:2], input_idx=idx[:2])
+    assert torch.allclose(cached(x, y, input_idx=idx)[0], expected)
+    assert torch.allclose(cached(x, y, input_idx=idx)[0], expected)
+    assert (cached.autocorr_cache.hits, cached.autocorr_cache.misses) == (6, 4)
+
+
+def definition_correlation(a, b):
+    """C_ab(r) = mean over x of a(x) b(x + r), periodic, of (H, W) maps, shifted like the loss' maps."""
+    H, W = a.shape
+    corr = torch.stack([torch.stack([(a * torch.roll(b, shifts=(-dy, -dx), dims=(0, 1))).mean() for dx in range(W)]) for dy in range(H)])
+    return torch.roll(corr, shifts=(H // 2, W // 2), dims=(0, 1))
+
+
+def test_multiphase_correlations_match_their_definition():
+    torch.manual_seed(0)
+    imgs = torch.rand(2, 1, 6, 7, dtype=torch.float64)
+    loss = TwoPointSpatialStatsLoss(DEVICE, -1.9e-09, 0.04, input_size=6)
+    mf = loss.generate_torch_microstructure_function(imgs)
+    corrs = loss.calculate_multiphase_correlations(imgs)
+    assert corrs.shape == (2, 2, 2, 6, 7)
+    for n in range(2):
+        for iA in range(2):
+            for iB in range(2):
+                assert torch.allclose(corrs[n, iA, iB], definition_correlation(mf[n, iA], mf[n, iB]))
+    # phase 0 with itself is the plain autocorrelation
+    assert torch.allclose(corrs[:, 0, :1], loss.calculate_two_point_autocorr_pytorch(imgs))
+
+
+def test_phase_pair_loss_weights_every_pair_mse():
+    torch.manual_seed(0)
+    x, y = torch.rand(2, 3, 1, 6, 6, dtype=torch.float64)
+    weights = [[1.0, 0.5], [0.25, 2.0]]
+    loss = TwoPointSpatialStatsLoss(DEVICE, -1.9e-09, 0.04, input_size=6, phase_pair_weights=weights)
+    x_corrs, y_corrs = loss.calculate_multiphase_correlations(x), loss.calculate_multiphase_correlations(y)
+    expected = sum(weights[iA][iB] * F.mse_loss(x_corrs[:, iA, iB], y_corrs[:, iA, iB]) for iA in range(2) for iB in range(2))
+    actual, x_autocorr, _ = loss(x, y)
+    assert torch.allclose(actual, expected)
+    # the phase 0 autocorrelations are returned for logging
+    assert torch.allclose(x_autocorr[..., 6:], x_corrs[:, 0, :1])
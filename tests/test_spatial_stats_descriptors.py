@@ -0,0 +1,68 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+from spatial_statistics_loss import TwoPointSpatialStatsLoss
+from spatial_stats_descriptors import AutocorrelationPCA, RadialProfile, AngularProfile
+from spatial_stats_benchmark import reference_two_point_autocorr
+
+
+DEVICE = torch.device('cpu')
+
+
+def profile_by_definition(autocorr, bin_of_lag):
+    """Averages the (H, W) autocorrelation over the lags (dy, dx) from the zero lag sharing bin_of_lag(dy, dx), None for none."""
+    H, W = autocorr.shape
+    values = {}
+    for y in range(H):
+        for x in range(W):
+            b = bin_of_lag(y - H // 2, x - W // 2)
+            if b is not None:
+                values.setdefault(b, []).append(autocorr[y, x].item())
+    return {b: sum(v) / len(v) for b, v in values.items()}
+
+
+def test_profiles_of_the_reference_autocorrelation():
+    torch.manual_seed(0)
+    loss = TwoPointSpatialStatsLoss(DEVICE, -1.9e-09, 0.04, input_size=9)
+    autocorr = reference_two_point_autocorr(loss, torch.rand(1, 1, 9, 9))[0, 0].float()
+
+    radial = RadialProfile((9, 9))(autocorr)
+    expected = profile_by_definition(autocorr, lambda dy, dx: round(math.hypot(dy, dx)))
+    assert radial.shape == (len(expected),)
+    assert torch.allclose(radial, torch.tensor([expected[b] for b in range(len(expected))]))
+
+    # 5 sectors, so no lag lies on a sector boundary
+    angular = AngularProfile((9, 9), num_bins=5)(autocorr)
+    expected = profile_by_definition(autocorr, lambda dy, dx: int(math.atan2(dy, dx) % math.pi / math.pi * 5) if 0 < math.hypot(dy, dx) <= 4 else None)
+    assert torch.allclose(angular, torch.tensor([expected[b] for b in range(5)]))
+
+
+def test_pca_recovers_autocorrelations_of_its_span(tmp_path):
+    torch.manual_seed(0)
+    # autocorrelations spanned by 3 directions around a mean
+    mean, basis = torch.rand(36), torch.linalg.qr(torch.randn(36, 3))[0]
+    coefficients = torch.randn(50, 3) * torch.tensor([3.0, 2.0, 1.0])
+    autocorrs = (mean + coefficients @ basis.T).view(50, 1, 6, 6)
+
+    pca = AutocorrelationPCA.fit(autocorrs, 3)
+    assert pca.explained_variance_ratio.sum() > 1 - 1e-4
+    projected = pca(autocorrs)
+    assert projected.shape == (50, 1, 3)
+    reconstructed = (projected @ pca.components.T + pca.mean).view_as(autocorrs)
+    assert torch.allclose(reconstructed, autocorrs, atol=1e-4)
+
+    pca.save(tmp_path / 'pca.pt')
+    top = AutocorrelationPCA.load(tmp_path / 'pca.pt', n_components=2)
+    assert torch.allclose(top(autocorrs), projected[..., :2])
+
+
+def test_descriptor_loss_compares_the_descriptors_of_the_autocorrelations():
+    torch.manual_seed(0)
+    x, y = torch.rand(2, 3, 1, 9, 9, dtype=torch.float64)
+    descriptor = RadialProfile((9, 9))
+    loss = TwoPointSpatialStatsLoss(DEVICE, -1.9e-09, 0.04, input_size=9, descriptor=descriptor)
+    expected = F.mse_loss(descriptor(reference_two_point_autocorr(loss, x)), descriptor(reference_two_point_autocorr(loss, y)))
+    actual, _, _ = loss(x, y)
+    assert torch.allclose(actual, expected.to(actual.dtype), rtol=1e-4)
@@ -0,0 +1,30 @@
+import pytest
+import torch
+
+from training_utils import MaterialSimilarityLoss, LossAccumulator
+
+
+COEFFICIENTS = (0.3, 0, 0, 0.7, 0.5)  # a_mse, a_content, a_style, a_spst, beta
+
+
+def epoch_means(criterion, batches):
+    losses = LossAccumulator(6, 'cpu')
+    for x, recon_x, mu, logvar in batches:
+        terms = criterion(x, recon_x, mu, logvar, *COEFFICIENTS, return_autocorrs=False)[:5]
+        losses.update(criterion.per_sample_terms(terms, COEFFICIENTS, x.size(0)), x.size(0))
+    return losses.mean()
+
+
+@pytest.mark.parametrize('reduction', ['mean', 'sum'])
+def test_epoch_means_do_not_depend_on_the_batching(reduction):
+    torch.manual_seed(0)
+    criterion = MaterialSimilarityLoss('cpu', -1.9e-09, 0.04, spatial_stat_loss_reduction=reduction)
+    x, recon_x = torch.rand(2, 4, 1, 8, 8)
+    mu, logvar = torch.randn(2, 4, 3)
+
+    whole = epoch_means(criterion, [(x, recon_x, mu, logvar)])
+    # a partial last batch counts for its size
+    split = epoch_means(criterion, [(x[:3], recon_x[:3], mu[:3], logvar[:3]), (x[3:], recon_x[3:], mu[3:], logvar[3:])])
+    assert whole == pytest.approx(split, rel=1e-6)
+    one_by_one = epoch_means(criterion, [(x[i:i + 1], recon_x[i:i + 1], mu[i:i + 1], logvar[i:i + 1]) for i in range(4)])
+    assert whole == pytest.approx(one_by_one, rel=1e-6)
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+import torch
+
+from preprocessing import BatchPreprocess
+from spatial_statistics_loss import TwoPointAutocorrelation
+from transform_to_autocorrs import AutocorrStatistics, compute_autocorr_statistics
+
+
+def test_merged_statistics_match_numpy():
+    rng = np.random.default_rng(0)
+    values = rng.beta(2, 5, size=10000)
+    # uneven chunks, an empty one included, merged in a tree as the workers would be
+    chunks = np.split(values, [1, 7, 7, 2500, 6000])
+    stats = [AutocorrStatistics.from_tensor(torch.from_numpy(chunk)) if len(chunk) else AutocorrStatistics() for chunk in chunks]
+    merged = stats[0].merge(stats[1]).merge(stats[2].merge(stats[3])).merge(stats[4].merge(stats[5]))
+
+    assert merged.count == len(values)
+    assert merged.mean == pytest.approx(values.mean(), rel=1e-12)
+    assert merged.variance == pytest.approx(values.var(), rel=1e-10)
+    assert (merged.min_value, merged.max_value) == (values.min(), values.max())
+    assert merged.histogram.sum() == len(values)
+    # the histogram quantile is the value the cumulative count reaches q at, up to its bin
+    bin_width = 1 / AutocorrStatistics.NUM_BINS
+    for q in [0.01, 0.5, 0.99]:
+        assert merged.quantile(q) == pytest.approx(np.quantile(values, q, method='inverted_cdf'), abs=2 * bin_width)
+
+
+def test_dataset_statistics_of_the_parallel_workers():
+    generator = torch.Generator().manual_seed(0)
+    images = (torch.rand(10, 1, 16, 16, generator=generator) * 255).to(torch.uint8)
+    dataset = [(image, 0) for image in images]
+    preprocess = BatchPreprocess(res_size=16, thr_255=128)
+    stats = compute_autocorr_statistics(dataset, preprocess, batch_size=3, num_workers=2)
+
+    autocorrs = TwoPointAutocorrelation().batch_forward(preprocess(images)).double().numpy()
+    assert stats.count == autocorrs.size
+    assert stats.mean == pytest.approx(autocorrs.mean(), rel=1e-6)
+    assert stats.variance == pytest.approx(autocorrs.var(), rel=1e-5)
+    assert stats.max_value == pytest.approx(autocorrs.max(), rel=1e-6)
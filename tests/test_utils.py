@@ -0,0 +1,39 @@
+import torch
+from torch.utils.data import DataLoader
+
+from utils import ResumableRandomSampler
+
+
+def test_resumed_epoch_continues_the_same_order():
+    dataset = list(range(23))
+    sampler = ResumableRandomSampler(dataset, seed=3)
+    sampler.set_epoch(2)
+    batches = [batch.tolist() for batch in DataLoader(dataset, batch_size=4, sampler=sampler)]
+    assert sorted(sum(batches, [])) == dataset
+
+    # a run interrupted after 3 batches of epoch 2 resumes with the 4th, in a new sampler
+    resumed = ResumableRandomSampler(dataset, seed=3)
+    resumed.set_epoch(2)
+    resumed.set_start(3 * 4)
+    loader = DataLoader(dataset, batch_size=4, sampler=resumed)
+    assert len(loader) == len(batches) - 3
+    assert [batch.tolist() for batch in loader] == batches[3:]
+
+    # the next epoch starts over, in another order
+    resumed.set_epoch(3)
+    assert len(resumed) == 23 and list(resumed) != sum(batches, [])
+    assert list(ResumableRandomSampler(dataset, seed=4)) != list(ResumableRandomSampler(dataset, seed=3))
+
+
+def test_replicas_share_out_every_epoch():
+    dataset = list(range(10))
+    replicas = [ResumableRandomSampler(dataset, seed=0, num_replicas=3, rank=rank) for rank in range(3)]
+    shards = [list(sampler) for sampler in replicas]
+    # padded to 12 with the first samples of the permutation
+    assert [len(shard) for shard in shards] == [4, 4, 4]
+    assert sorted(set(sum(shards, []))) == dataset
+    permutation = torch.randperm(10, generator=torch.Generator().manual_seed(0)).tolist()
+    assert sum(zip(*shards), ()) == tuple(permutation + permutation[:2])
+
+    replicas[1].set_start(2)
+    assert list(replicas[1]) == shards[1][2:]